@@ -1,6 +1,8 @@
 import logging
+import os
 import time
 from dataclasses import dataclass
+from typing import Optional
 
 from lyrid import ActorSystem, Actor, Address, Message, switch, use_switch
 from prometheus_client import CollectorRegistry, multiprocess
@@ -9,34 +11,22 @@ from twisted.internet import reactor
 from twisted.web.resource import Resource
 from twisted.web.server import Site
 
+import introspection
 import metrics
+from local_metrics import batched
+from log_config import hot_path_logger, log_event
 from market_repo import MarketRepository
-from trader import trader_agent
+from price_table import PriceTable
+from scheduler import DirtyMarketScheduler
+from tracing import TraceContext, mark
+from utils import MARKET_MAPPING
 
 logger = logging.getLogger(__name__)
+hot_logger = hot_path_logger(__name__)
 
-
-class SetStack:
-    def __init__(self):
-        self.set = set()
-        self.stack = []
-
-    def add(self, value):
-        if value not in self.set:
-            self.set.add(value)
-            self.stack.append(value)
-        else:
-            self.stack.remove(value)
-            self.stack.append(value)
-
-    def pop(self):
-        if len(self.stack) > 0:
-            value = self.stack.pop()
-            self.set.remove(value)
-            return value
-
-    def __len__(self):
-        return len(self.stack)
+CALC_POLICY = os.environ.get('CALC_POLICY', 'lifo')
+CALC_PARALLELISM = int(os.environ.get('CALC_PARALLELISM', 1))
+CALC_MAX_QUEUE_DELAY = float(os.environ['CALC_MAX_QUEUE_DELAY']) if 'CALC_MAX_QUEUE_DELAY' in os.environ else None
 
 
 @dataclass
@@ -52,25 +42,34 @@ class MarketActor(Actor):
     @switch.message(type=Start)
     def handle_start(self, sender: Address, message: Start):
         logger.info("MarketActor: Handling Start")
-        self.market_repo = MarketRepository(True)
+        price_table = PriceTable.create_shared(MARKET_MAPPING.values())
+        self.market_repo = MarketRepository(True, price_table=price_table)
         self.market_repo.add_callback(self.market_updated)
-        while True:
-            try:
-                self.market_repo.run()
-            except KeyboardInterrupt:
-                break
-            except:
-                pass
-
-    def market_updated(self, market_repo, market_id):
-        logger.info("MARKET UPDATED: %s", str(market_id))
-        self.tell(self.trader, MarketUpdate(self.market_repo.only_data(), market_id=market_id))
+        introspection.start('MarketActor')
+        introspection.register('books', self.market_repo.book_freshness)
+        introspection.register('feed', self.market_repo.feed.status)
+        try:
+            # Reconnects are handled by the repository's FeedSupervisor.
+            self.market_repo.run()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            self.market_repo.close()
+            price_table.close(unlink=True)
+
+    def market_updated(self, market_repo, market_id, trace=None):
+        log_event(hot_logger, 'market_updated', market_id=market_id)
+        mark(trace, 'message_sent')
+        self.tell(self.trader, MarketUpdate(market_id=market_id, seq=market_repo.price_table.seq(market_id),
+                                            trace=trace))
 
 
 @dataclass
 class MarketUpdate(Message):
-    market_repo: MarketRepository
+    """Prices themselves are read from the shared `PriceTable`; `seq` is the row's sequence number."""
     market_id: int
+    seq: int
+    trace: Optional[TraceContext] = None
 
 
 class CalculationDone(Message):
@@ -80,55 +79,106 @@ class CalculationDone(Message):
 @use_switch
 class PositionFinder(Actor):
     def __init__(self):
-        self.busy = False
-        self.queued_markets = SetStack()  # Use stack to handle most updated markets first, maybe we need to change that
-        self.latest_market_data = None
+        self.in_flight = 0
+        self.queued_markets = DirtyMarketScheduler(CALC_POLICY, max_delay=CALC_MAX_QUEUE_DELAY)
+        self.price_table = None
+        self.calculator = None
         self.market_update_count = 0
+        # Latest trace per queued market; superseded updates are not traced to the end.
+        self.pending_traces = {}
+        # Copy of the queue taken on the actor thread, for `introspect`.
+        self.queue_snapshot = ()
+        self.queue_delay_metric = None
+        self.queue_length_metric = None
+        self.queue_dropped_metric = None
+
+    @property
+    def busy(self):
+        return self.in_flight >= CALC_PARALLELISM
 
     @switch.message(type=MarketUpdate)
     def handle_market_update(self, sender: Address, message: MarketUpdate):
-        logger.info("Handling market update")
-        self.latest_market_data = message.market_repo
-        if self.busy:
-            logger.info("Busy! Put in queue")
-            self.queued_markets.add(message.market_id)
-        else:
-            logger.info("Running calc in bg")
-            self.busy = True
-            self.run_in_background(self.calculate, args=(message.market_id,))
+        hot_logger.debug("Handling market update")
+        if self.price_table is None:
+            from calculator import TriangleCalculator
+            self.price_table = PriceTable.attach(MARKET_MAPPING.values())
+            self.calculator = TriangleCalculator()
+            # Bound here rather than in __init__, since the actor is pickled into its process.
+            self.queue_delay_metric = batched(metrics.calc_queue_delay)
+            self.queue_length_metric = batched(metrics.calc_queue_length)
+            self.queue_dropped_metric = batched(metrics.calc_queue_dropped)
+            introspection.start('PositionFinder')
+            introspection.register('position_finder', self.introspect)
+            self.calculator.trader_agent.start()
+        mark(message.trace, 'message_received')
+        self.queued_markets.mark(message.market_id)
+        self.pending_traces[message.market_id] = message.trace
+        self.run_queued_tasks()
 
     @switch.background_task_exited(exception=None)
-    def calc_done(self):
-        logger.info("bg task done")
+    def calc_done(self, result):
+        hot_logger.debug("bg task done")
+        market_id, edge = result
+        self.queued_markets.evaluated(market_id, edge)
+        self.in_flight -= 1
         self.try_running_queued_tasks()
 
     def try_running_queued_tasks(self):
         self.market_update_count += 1
-        if self.market_update_count % 25 == 0:
-            try:
-                trader_agent.update_orders_and_wallet()
-            except:
-                pass
-
-        if self.queued_markets:
-            market_id = self.queued_markets.pop()
-            logger.info("running another")
-            self.run_in_background(self.calculate, args=(market_id,))
-        else:
-            self.busy = False
+        self.run_queued_tasks()
+
+    def run_queued_tasks(self):
+        while not self.busy:
+            task = self.queued_markets.pop()
+            if task is None:
+                break
+            market_id, queue_delay = task
+            self.queue_delay_metric.observe(queue_delay)
+            hot_logger.debug("Running calc in bg")
+            trace = self.pending_traces.pop(market_id, None)
+            mark(trace, 'dequeued')
+            self.in_flight += 1
+            self.run_in_background(self.calculate, args=(market_id, trace))
+
+        for market_id in self.queued_markets.take_dropped():
+            self.pending_traces.pop(market_id, None)
+        self.queue_length_metric.set(len(self.queued_markets))
+        self.queue_dropped_metric.set(self.queued_markets.dropped)
+        if introspection.ENABLED:
+            self.queue_snapshot = self.queued_markets.pending()
 
     @switch.background_task_exited(exception=Exception)
     def calc_done_exc(self, exception: Exception):
         logger.info("bg task done with exception %s", exception)
+        self.in_flight -= 1
         self.try_running_queued_tasks()
 
-    def calculate(self, market_id: int):
-        from calculator import TriangleCalculator
+    def introspect(self) -> dict:
+        """
+        Queue state for `/debug/state`. Runs on the introspection thread, so it
+        only reads the queue snapshot the actor published and plain counters.
+        """
+        now = time.monotonic()
+        queue = self.queue_snapshot
+        return {
+            'queued_markets': len(queue),
+            'waiting': {market_id: now - queued_at for market_id, queued_at in queue},
+            'busy': self.busy,
+            'in_flight': self.in_flight,
+            'dropped': self.queued_markets.dropped,
+            'market_update_count': self.market_update_count,
+        }
+
+    def calculate(self, market_id: int, trace: Optional[TraceContext] = None):
         with metrics.calc_duration.time():
-            TriangleCalculator().calculate(self.latest_market_data, market_id=market_id)
+            edge = self.calculator.calculate(self.price_table, market_id=market_id, trace=trace)
+        if trace is not None:
+            trace.finish()
+        return market_id, edge
 
 
 def run():
+    introspection.clear()
     system = ActorSystem(n_nodes=4)
     trader = system.spawn(actor=PositionFinder())
     market_actor = system.spawn(actor=MarketActor(trader=trader), key='market')
@@ -144,4 +194,11 @@ def run():
 
     factory = Site(root)
     reactor.listenTCP(8000, factory)
+
+    if introspection.ENABLED:
+        introspection.start('main')
+        debug_root = Resource()
+        debug_root.putChild(b'debug', introspection.debug_resource())
+        reactor.listenTCP(introspection.DEBUG_PORT, Site(debug_root), interface='127.0.0.1')
+        logger.info("Serving /debug on 127.0.0.1:%d", introspection.DEBUG_PORT)
     reactor.run()
@@ -0,0 +1,162 @@
+import asyncio
+import logging
+import os
+import threading
+from typing import List, Literal, Optional
+
+import aiohttp
+
+import metrics
+from bitpin_proxy import AUTH_RETRY_BACKOFF, BitpinProxy, OrderRejected, build_order_payload, get_bitpin_proxy
+from log_config import hot_path_logger, log_event
+from rate_limiter import Priority
+from tracing import TraceContext, mark
+
+POOL_SIZE = 16
+KEEPALIVE_TIMEOUT = 60
+REQUEST_TIMEOUT = 10
+
+logger = logging.getLogger(__name__)
+hot_logger = hot_path_logger(__name__)
+
+
+class AsyncBitpinProxy:
+    """
+    aiohttp based proxy for the latency sensitive calls. It keeps one pooled
+    keep-alive session on a dedicated event loop thread and shares tokens and
+    the rate limit scheduler with the synchronous `BitpinProxy`, which still
+    owns login and refresh.
+    """
+
+    def __init__(self, sync_proxy: BitpinProxy):
+        self.sync_proxy = sync_proxy
+        self.loop = asyncio.new_event_loop()
+        self._session = None
+        self._thread = threading.Thread(target=self.loop.run_forever, name='async-bitpin-proxy', daemon=True)
+        self._thread.start()
+
+    async def _get_session(self) -> aiohttp.ClientSession:
+        if self._session is None or self._session.closed:
+            connector = aiohttp.TCPConnector(limit=POOL_SIZE, keepalive_timeout=KEEPALIVE_TIMEOUT)
+            self._session = aiohttp.ClientSession(
+                connector=connector,
+                timeout=aiohttp.ClientTimeout(total=REQUEST_TIMEOUT),
+            )
+        return self._session
+
+    async def _send_request(self, path, method='get', body=None, authenticated=False, priority=Priority.ORDER):
+        hot_logger.debug("Sending async request. path=(%s) method=(%s) auth=(%s)", path, method, authenticated)
+
+        retries = 0
+        while True:
+            headers = {}
+            if authenticated:
+                headers['Authorization'] = f'Bearer {self.sync_proxy.access_token}'
+
+            status, resp_body = await self._send_with_failover(path, method, body, headers, priority, retries)
+
+            if not authenticated or status not in [401, 403] or retries >= 3:
+                return status, resp_body
+
+            logger.info("Request failed. Refreshing token and retrying...")
+            await self.loop.run_in_executor(None, self.sync_proxy.auth.renew, headers['Authorization'][len('Bearer '):])
+            await asyncio.sleep(AUTH_RETRY_BACKOFF * (2 ** retries - 1))
+            retries += 1
+
+    async def _send_with_failover(self, path, method, body, headers, priority, retry):
+        """Same host selection and failover as `BitpinProxy._send_with_failover`."""
+        session = await self._get_session()
+        scheduler = self.sync_proxy.scheduler
+        attempts = len(scheduler.hosts)
+        for attempt in range(attempts):
+            # Only order priority is sent from here, and it never blocks in `acquire`.
+            host = scheduler.acquire(path, priority)
+            try:
+                async with session.request(method.upper(), f'{host}{path}', json=body, headers=headers) as resp:
+                    status = resp.status
+                    resp_headers = resp.headers
+                    resp_body = await resp.json(content_type=None)
+            except (aiohttp.ClientConnectionError, asyncio.TimeoutError):
+                scheduler.host_failed(host)
+                if attempt == attempts - 1:
+                    raise
+                continue
+            log_event(hot_logger, 'response_received', path=path, status=status)
+            metrics.proxy_requests.labels(path=path, method=method, status_code=status, retry=retry).inc()
+            scheduler.record(host, path, status, resp_headers)
+            if status != 429:
+                break
+        return status, resp_body
+
+    async def place_order(
+            self,
+            market_id: int,
+            base_amount: float,
+            price: float,
+            side: Literal['buy', 'sell'],
+            mode='limit',
+            identifier=None,
+    ):
+        """The placed order; raises `OrderRejected` when the exchange does not accept it."""
+        payload = build_order_payload(market_id, base_amount, price, side, mode, identifier)
+        status, resp_body = await self._send_request('/v1/odr/orders/', method='post', body=payload,
+                                                     authenticated=True)
+        if status >= 300:
+            raise OrderRejected(status, resp_body)
+        return resp_body
+
+    async def place_orders(self, orders: List[dict], trace: Optional[TraceContext] = None) -> list:
+        """Submits every order concurrently. Failed and rejected legs are returned as exceptions, in order."""
+        mark(trace, 'legs_sent')
+        return await asyncio.gather(*(self._place_leg(i, order, trace) for i, order in enumerate(orders)),
+                                    return_exceptions=True)
+
+    async def _place_leg(self, leg: int, order: dict, trace: Optional[TraceContext]):
+        try:
+            return await self.place_order(**order)
+        finally:
+            mark(trace, f'leg{leg}_acked')
+
+    def run(self, coroutine):
+        """Runs `coroutine` on the proxy's loop and blocks until it is done."""
+        return asyncio.run_coroutine_threadsafe(coroutine, self.loop).result()
+
+    def place_orders_sync(self, orders: List[dict], trace: Optional[TraceContext] = None) -> list:
+        # Only blocks when there is no valid token yet; renewals happen in the background.
+        self.sync_proxy._ensure_access()
+        return self.run(self.place_orders(orders, trace))
+
+    def close(self):
+        if self._session is not None:
+            self.run(self._session.close())
+        self.loop.call_soon_threadsafe(self.loop.stop)
+
+
+_async_bitpin_proxy: Optional[AsyncBitpinProxy] = None
+_async_bitpin_proxy_lock = threading.Lock()
+
+
+def get_async_bitpin_proxy() -> AsyncBitpinProxy:
+    """The process wide async proxy around `get_bitpin_proxy()`, created on first use."""
+    global _async_bitpin_proxy
+    if _async_bitpin_proxy is None:
+        with _async_bitpin_proxy_lock:
+            if _async_bitpin_proxy is None:
+                _async_bitpin_proxy = AsyncBitpinProxy(get_bitpin_proxy())
+    return _async_bitpin_proxy
+
+
+def set_async_bitpin_proxy(proxy):
+    global _async_bitpin_proxy
+    _async_bitpin_proxy = proxy
+
+
+def _after_fork():
+    # The event loop thread does not survive a fork; a child creates its own proxy on first use.
+    global _async_bitpin_proxy, _async_bitpin_proxy_lock
+    _async_bitpin_proxy_lock = threading.Lock()
+    if isinstance(_async_bitpin_proxy, AsyncBitpinProxy):
+        _async_bitpin_proxy = None
+
+
+os.register_at_fork(after_in_child=_after_fork)
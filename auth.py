@@ -0,0 +1,192 @@
+import base64
+import contextlib
+import fcntl
+import hashlib
+import json
+import logging
+import os
+import random
+import threading
+import time
+from typing import Optional
+
+# Base path of the token cache; every account and endpoint gets its own file (see `cache_key`).
+TOKEN_CACHE_PATH = os.environ.get('TOKEN_CACHE_PATH', '.bitpin_tokens.json')
+# Lifetime assumed for tokens whose expiry cannot be decoded.
+DEFAULT_TOKEN_LIFETIME = 900.
+REFRESH_AHEAD = 60.
+REFRESH_JITTER = 30.
+RETRY_BACKOFF = 1.
+MAX_RETRY_BACKOFF = 60.
+
+logger = logging.getLogger(__name__)
+
+
+def jwt_expiry(token: str) -> Optional[float]:
+    """The `exp` claim of a JWT as a unix timestamp, without verifying the signature."""
+    try:
+        payload = token.split('.')[1]
+        claims = json.loads(base64.urlsafe_b64decode(payload + '=' * (-len(payload) % 4)))
+        return float(claims['exp'])
+    except (IndexError, KeyError, TypeError, ValueError):
+        return None
+
+
+def cache_key(api_key: Optional[str], base_url: str) -> str:
+    """Identifies the account and endpoint tokens belong to, without storing the API key itself."""
+    return hashlib.sha256(f'{api_key}@{base_url}'.encode()).hexdigest()[:16]
+
+
+class AuthManager:
+    """
+    Owns the access and refresh tokens of a `BitpinProxy`.
+
+    A background thread renews the access token ahead of its expiry, with
+    jitter so several processes do not renew at once. Renewed tokens are
+    written to `cache_path`, guarded by a file lock, so every process
+    sharing the account picks up the same tokens instead of logging in on
+    its own. Requests only renew synchronously when no valid token exists,
+    or when the server rejected the one they sent (`renew(stale_token)`).
+    Processes of other accounts or endpoints use a different file, and
+    cached tokens whose `key` does not match are ignored.
+    """
+
+    def __init__(self, proxy, key: str, cache_path: Optional[str] = TOKEN_CACHE_PATH):
+        self.proxy = proxy
+        self.key = key
+        self.cache_path = f'{cache_path}.{key}' if cache_path else None
+        self.access_token = ''
+        self.refresh_token = ''
+        self.issued_at = 0.
+        self.expires_at = 0.
+        self.refresh_at = 0.
+        self._lock = threading.RLock()
+        self._wakeup = threading.Event()
+        self._stopped = False
+        self._thread = None
+        self._pid = None
+
+    def start(self):
+        # Also restarts the refresher in a forked child, which does not inherit the thread.
+        if self._thread is not None and self._pid == os.getpid():
+            return self
+        self._pid = os.getpid()
+        self._stopped = False
+        self._load_cache()
+        self._thread = threading.Thread(target=self._refresh_loop, name='auth-refresher', daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._stopped = True
+        self._wakeup.set()
+
+    def set_tokens(self, access_token: str, refresh_token: Optional[str] = None):
+        now = time.time()
+        with self._lock:
+            self.access_token = access_token
+            if refresh_token is not None:
+                self.refresh_token = refresh_token
+            self.issued_at = now
+            self.expires_at = jwt_expiry(access_token) or now + DEFAULT_TOKEN_LIFETIME
+            self._schedule_refresh()
+        self._wakeup.set()
+
+    def _schedule_refresh(self):
+        lifetime = max(self.expires_at - self.issued_at, 0.)
+        ahead = min(REFRESH_AHEAD, lifetime / 4)
+        jitter = random.uniform(0, min(REFRESH_JITTER, lifetime / 8))
+        self.refresh_at = self.expires_at - ahead - jitter
+
+    def valid(self, margin: float = 0.) -> bool:
+        return bool(self.access_token) and time.time() + margin < self.expires_at
+
+    def ensure(self):
+        """Makes sure a valid access token exists. Only blocks if there is none yet, or it expired."""
+        self.start()
+        if not self.valid():
+            self.renew()
+
+    def renew(self, stale_token: Optional[str] = None):
+        """
+        Renews the access token, unless another thread or process already did.
+        With `stale_token`, only renews if that is still the current token.
+        """
+        with self._lock, self._process_lock():
+            self._load_cache()
+            if stale_token is not None:
+                if self.access_token != stale_token and self.valid():
+                    return
+            elif self.valid() and time.time() < self.refresh_at:
+                return
+
+            refresh_expiry = jwt_expiry(self.refresh_token) if self.refresh_token else None
+            if self.refresh_token and (refresh_expiry is None or refresh_expiry > time.time()):
+                self.proxy.refresh()
+            else:
+                self.proxy.login()
+            self._save_cache()
+
+    def _refresh_loop(self):
+        failures = 0
+        while not self._stopped:
+            if failures:
+                timeout = min(RETRY_BACKOFF * 2 ** (failures - 1), MAX_RETRY_BACKOFF)
+            else:
+                timeout = max(self.refresh_at - time.time(), 0.)
+            self._wakeup.wait(timeout)
+            self._wakeup.clear()
+            if self._stopped or (not failures and time.time() < self.refresh_at):
+                continue
+            try:
+                self.renew()
+                failures = 0
+            except Exception as e:
+                failures += 1
+                logger.warning("Renewing the access token failed (%d): %s", failures, e)
+
+    @contextlib.contextmanager
+    def _process_lock(self):
+        if not self.cache_path:
+            yield
+            return
+        with open(f'{self.cache_path}.lock', 'w') as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    def _load_cache(self):
+        if not self.cache_path:
+            return
+        try:
+            with open(self.cache_path) as f:
+                cached = json.load(f)
+        except (FileNotFoundError, ValueError):
+            return
+        if cached.get('key') != self.key:
+            logger.warning("Ignoring token cache %s of another account or endpoint", self.cache_path)
+            return
+        with self._lock:
+            if cached['expires_at'] > self.expires_at:
+                self.access_token = cached['access']
+                self.refresh_token = cached['refresh']
+                self.issued_at = cached['issued_at']
+                self.expires_at = cached['expires_at']
+                self._schedule_refresh()
+
+    def _save_cache(self):
+        if not self.cache_path:
+            return
+        tmp_path = f'{self.cache_path}.tmp'
+        fd = os.open(tmp_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+        with os.fdopen(fd, 'w') as f:
+            json.dump({
+                'key': self.key,
+                'access': self.access_token,
+                'refresh': self.refresh_token,
+                'issued_at': self.issued_at,
+                'expires_at': self.expires_at,
+            }, f)
+        os.replace(tmp_path, self.cache_path)
@@ -0,0 +1,234 @@
+"""
+Benchmarks of the tick-to-decision hot path on synthetic order books.
+
+    python benchmark.py [--tokens 50] [--depth 20] [--open-orders 100] [--iterations 2000] [--actors]
+                        [--output result.json] [--compare previous.json]
+
+Everything runs offline against a stubbed BitpinProxy. Results are printed
+as JSON (latencies in seconds) and tagged with the current git commit so
+runs of different commits can be compared with --compare.
+"""
+import argparse
+import json
+import logging
+import random
+import subprocess
+import time
+from typing import Dict, List, Tuple
+
+import log_config
+from actor import MarketUpdate, PositionFinder
+from latency_stats import summarize
+from order import Order
+from replay import install_stub_proxy
+
+USDT_IRT_PRICE = 60000.
+
+
+class ProbePositionFinder(PositionFinder):
+    """PositionFinder that reports when each calculation is done."""
+
+    def __init__(self, done_queue):
+        super().__init__()
+        self.done_queue = done_queue
+
+    def calculate(self, market_id: int, trace=None):
+        result = super().calculate(market_id, trace)
+        self.done_queue.put((market_id, time.time()))
+        return result
+
+
+def synthetic_market_mapping(n_tokens: int) -> Dict[Tuple[str, str], int]:
+    """USDT/IRT plus a TOKEN/IRT and a TOKEN/USDT market per token, i.e. `n_tokens` triangles."""
+    mapping = {('USDT', 'IRT'): 5}
+    for i in range(n_tokens):
+        mapping[(f'T{i}', 'IRT')] = 10000 + 2 * i
+        mapping[(f'T{i}', 'USDT')] = 10001 + 2 * i
+    return mapping
+
+
+def use_synthetic_markets(n_tokens: int) -> Dict[Tuple[str, str], int]:
+    """Replaces the traded markets in place, so every module importing MARKET_MAPPING sees them."""
+    from market_registry import Market
+    from utils import MARKET_MAPPING, market_registry
+
+    mapping = synthetic_market_mapping(n_tokens)
+    MARKET_MAPPING.clear()
+    MARKET_MAPPING.update(mapping)
+    for (base, quote), market_id in mapping.items():
+        market_registry.add(Market(market_id, base, quote))
+    return mapping
+
+
+def synthetic_book(mid_price: float, depth: int, rng: random.Random, spread: float = 0.002):
+    tick = mid_price * 0.0005
+    best_bid = mid_price * (1 - spread / 2)
+    best_ask = mid_price * (1 + spread / 2)
+    buy = [{'price': f'{best_bid - i * tick:.10g}', 'remain': f'{rng.uniform(0.1, 10):.6f}'} for i in range(depth)]
+    sell = [{'price': f'{best_ask + i * tick:.10g}', 'remain': f'{rng.uniform(0.1, 10):.6f}'} for i in range(depth)]
+    return buy, sell
+
+
+def synthetic_frames(mapping, depth: int, count: int, seed: int = 0) -> List[dict]:
+    """`market_update` events with mid prices random-walking around a consistent cross rate."""
+    rng = random.Random(seed)
+    usdt_prices = {base: rng.uniform(0.1, 1000) for base, quote in mapping if base != 'USDT'}
+
+    def mid_price(base, quote):
+        if base == 'USDT':
+            return USDT_IRT_PRICE
+        return usdt_prices[base] * (USDT_IRT_PRICE if quote == 'IRT' else 1.)
+
+    markets = list(mapping.items())
+    frames = []
+    for _ in range(count):
+        (base, quote), market_id = rng.choice(markets)
+        mid = mid_price(base, quote) * (1 + rng.gauss(0, 0.002))
+        buy, sell = synthetic_book(mid, depth, rng)
+        frames.append({
+            'event': 'market_update',
+            'market': {'id': market_id, 'code': f'{base}_{quote}'},
+            'buy': buy,
+            'sell': sell,
+        })
+    return frames
+
+
+def synthetic_open_orders(mapping, count: int, seed: int = 0) -> List[Order]:
+    rng = random.Random(seed)
+    markets = list(mapping)
+    return [
+        Order(market=rng.choice(markets), side=rng.choice(['buy', 'sell']), amount=rng.uniform(0.01, 1),
+              price=rng.uniform(1, 1000), identifier=f'synthetic-{i}')
+        for i in range(count)
+    ]
+
+
+def _timed(fn, iterations: int) -> dict:
+    samples = []
+    started = time.perf_counter()
+    for i in range(iterations):
+        start = time.perf_counter()
+        fn(i)
+        samples.append(time.perf_counter() - start)
+    return summarize(samples, time.perf_counter() - started)
+
+
+def bench_hot_path(args) -> dict:
+    from calculator import TriangleCalculator
+    from market_repo import MarketRepository
+    from opportunity_log import OpportunityLog
+    from trader import get_trader_agent
+
+    trader_agent = get_trader_agent()
+    mapping = use_synthetic_markets(args.tokens)
+    frames = synthetic_frames(mapping, args.depth, args.iterations + len(mapping))
+    market_ids = [frame['market']['id'] for frame in frames]
+
+    repo = MarketRepository()
+    # Warm every book first so the measured updates are diffs against a full book.
+    for frame in frames[:len(mapping)]:
+        repo.handle_market_update_event(frame)
+    frames = frames[len(mapping):]
+
+    calculator = TriangleCalculator(OpportunityLog('benchmark_opportunities.csv'))
+    wallet = {token: 1e12 for pair in mapping for token in pair}
+    trader_agent.apply_snapshot(wallet, synthetic_open_orders(mapping, args.open_orders))
+    tokens = sorted(wallet)
+
+    results = {
+        'handle_market_update_event': _timed(lambda i: repo.handle_market_update_event(frames[i]), args.iterations),
+        'price_table_snapshot': _timed(lambda i: repo.price_table.snapshot(), args.iterations),
+        'calculate': _timed(lambda i: calculator.calculate(repo.price_table, market_id=market_ids[i]),
+                            args.iterations),
+        'get_tradable_balance': _timed(lambda i: trader_agent.get_tradable_balance(tokens[i % len(tokens)]),
+                                       args.iterations),
+    }
+    calculator.opportunity_log.close()
+    return results
+
+
+def bench_actors(args) -> dict:
+    """MarketUpdate -> decision latency through a real lyrid ActorSystem."""
+    import multiprocessing as mp
+
+    from lyrid import ActorSystem
+
+    from market_repo import MarketRepository
+    from price_table import PriceTable
+    from utils import MARKET_MAPPING
+
+    mapping = use_synthetic_markets(args.tokens)
+    frames = synthetic_frames(mapping, args.depth, args.iterations + len(mapping))
+    table = PriceTable.create_shared(MARKET_MAPPING.values())
+    repo = MarketRepository(price_table=table)
+    for frame in frames[:len(mapping)]:
+        repo.handle_market_update_event(frame)
+
+    done_queue = mp.Manager().Queue()
+    system = ActorSystem(n_nodes=2)
+    try:
+        finder = system.spawn(actor=ProbePositionFinder(done_queue))
+        samples = []
+        started = time.perf_counter()
+        for frame in frames[len(mapping):]:
+            repo.handle_market_update_event(frame)
+            market_id = frame['market']['id']
+            sent_at = time.time()
+            system.tell(finder, MarketUpdate(market_id=market_id, seq=table.seq(market_id)))
+            _, done_at = done_queue.get(timeout=30)
+            samples.append(done_at - sent_at)
+        return {'market_update_to_decision': summarize(samples, time.perf_counter() - started)}
+    finally:
+        system.force_stop()
+        table.close(unlink=True)
+
+
+def _git_commit() -> str:
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'], text=True).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return 'unknown'
+
+
+def compare(current: dict, previous: dict) -> dict:
+    """p50/p99 ratio current/previous per benchmark; below 1 means faster."""
+    ratios = {}
+    for name, stats in current['results'].items():
+        before = previous.get('results', {}).get(name)
+        if not before or 'p50' not in stats or 'p50' not in before:
+            continue
+        ratios[name] = {q: stats[q] / before[q] for q in ('p50', 'p99') if before[q]}
+    return ratios
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--tokens', type=int, default=50, help='Synthetic tokens; each adds two markets and a triangle.')
+    parser.add_argument('--depth', type=int, default=20, help='Levels per book side.')
+    parser.add_argument('--open-orders', type=int, default=100)
+    parser.add_argument('--iterations', type=int, default=2000)
+    parser.add_argument('--actors', action='store_true', help='Also run the end-to-end lyrid actor benchmark.')
+    parser.add_argument('--output', help='Also write the JSON result to this file.')
+    parser.add_argument('--compare', help='JSON result of a previous run to compare against.')
+    args = parser.parse_args()
+
+    log_config.configure(level=logging.WARNING)
+    install_stub_proxy()
+
+    report = {
+        'commit': _git_commit(),
+        'params': vars(args),
+        'results': bench_hot_path(args),
+    }
+    if args.actors:
+        report['results'].update(bench_actors(args))
+    if args.compare:
+        with open(args.compare) as f:
+            report['comparison'] = compare(report, json.load(f))
+
+    output = json.dumps(report, indent=2)
+    print(output)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(output)
@@ -1,103 +1,183 @@
 import logging
 import os
-from typing import Literal
+import threading
+import time
+from typing import Literal, Optional
 
 import requests
 
 import metrics
-from utils import get_market_base_and_quote
+from auth import AuthManager, cache_key
+from log_config import hot_path_logger, log_event
+from rate_limiter import Priority, RequestScheduler
+from utils import get_market_base_and_quote, get_market_scale
 from order import Order
 
-BITPIN_URL = 'https://api.bitpin.org'
+BITPIN_URL = os.environ.get('BITPIN_URL', 'https://api.bitpin.org')
+# Set to an empty string to disable failing over, e.g. against the simulator.
+BITPIN_FALLBACK_URL = os.environ.get('BITPIN_FALLBACK_URL', 'https://api.bitpin.ir')
+AUTH_RETRY_BACKOFF = 0.1
 BITPIN_API_KEY = os.environ.get('BITPIN_API_KEY')
 BITPIN_SECRET_KEY = os.environ.get('BITPIN_SECRET_KEY')
 
-logging.basicConfig(level=logging.INFO,  format='%(asctime)s %(message)s')
 logger = logging.getLogger(__name__)
+hot_logger = hot_path_logger(__name__)
+
+
+class OrderRejected(Exception):
+    """The exchange answered an order with a non-2xx status; nothing was placed."""
+
+    def __init__(self, status: int, body):
+        super().__init__(f'rejected with {status}: {body}')
+        self.status = status
+        self.body = body
+
+
+def build_order_payload(
+        market_id: int,
+        base_amount: float,
+        price: float,
+        side: Literal['buy', 'sell'],
+        mode='limit',
+        identifier=None,
+) -> dict:
+    if mode not in ['limit', 'market']:
+        raise NotImplementedError
+
+    # Snapped to the market's lot and tick; the floats serialize to their exact decimal strings.
+    scale = get_market_scale(market_id)
+    price = scale.snap_price(price)
+    payload = {
+        'market': market_id,
+        'amount1': scale.snap_amount(base_amount),
+        # 'amount2': 0,
+        'price': price,
+        'mode': mode,
+        'type': side,
+        'price_limit': price,
+        # 'price_stop': 0,
+        # 'price_limit_oco': 0,
+    }
+
+    if mode == 'market':
+        payload.pop('price_limit')
+
+    if identifier is not None:
+        payload['identifier'] = identifier
+
+    return payload
 
 
 class BitpinProxy:
-    def __init__(self):
-        self.base_url = BITPIN_URL
-        self.access_token = ''
-        self.refresh_token = ''
+    def __init__(self, hosts=(BITPIN_URL, BITPIN_FALLBACK_URL)):
+        hosts = [host for host in hosts if host]
+        self.base_url = hosts[0]
+        self.session = requests.Session()
+        self.scheduler = RequestScheduler(hosts)
+        self.auth = AuthManager(self, cache_key(BITPIN_API_KEY, self.base_url))
 
-    def _send_request(self, path, method='get', body=None, authenticated=False, base_url=None):
-        if base_url is None:
-            base_url = self.base_url
-        logger.info("Sending request. path=(%s) method=(%s) auth=(%s)", path, method, str(authenticated))
-        url = f'{base_url}{path}'
+    @property
+    def access_token(self) -> str:
+        return self.auth.access_token
 
-        request_method = getattr(requests, method.lower())
+    def _send_request(self, path, method='get', body=None, authenticated=False, timeout=None,
+                      priority=Priority.SNAPSHOT):
+        hot_logger.debug("Sending request. path=(%s) method=(%s) auth=(%s)", path, method, authenticated)
 
         headers = {}
         if authenticated:
             self._ensure_access()
             headers['Authorization'] = f'Bearer {self.access_token}'
-            logger.info("Auth Headers: %s", headers['Authorization'][:30])
-
-        resp = request_method(url, json=body, headers=headers)
-        logger.info("Response received [%d]: %s", resp.status_code, resp.text[:120])
-
-        metrics.proxy_requests.labels(path=path, method=method, status_code=resp.status_code, retry=0).inc()
 
-        if resp.status_code == 429 and base_url.endswith('org'):
-            self._send_request(path, method, body, authenticated, base_url.replace('.org', '.ir'))
+        resp = self._send_with_failover(path, method, body, headers, timeout, priority, retry=0)
 
         retries = 0
         while resp.status_code in [401, 403] and retries < 3:
             logger.info("Request failed. Retrying...")
             if authenticated:
-                self.refresh()
+                self.auth.renew(stale_token=headers['Authorization'][len('Bearer '):])
                 headers['Authorization'] = f'Bearer {self.access_token}'
-            logger.info("Resending request. path=(%s)", path)
-            resp = request_method(url, json=body, headers=headers)
-            logger.info("Response received [%d]: %s", resp.status_code, resp.text[:120])
+            # The first retry goes out right after the refresh; repeated failures back off.
+            time.sleep(AUTH_RETRY_BACKOFF * (2 ** retries - 1))
             retries += 1
-            metrics.proxy_requests.labels(path=path, method=method, status_code=resp.status_code, retry=retries).inc()
+            hot_logger.debug("Resending request. path=(%s)", path)
+            resp = self._send_with_failover(path, method, body, headers, timeout, priority, retry=retries)
 
         return resp
 
+    def _send_with_failover(self, path, method, body, headers, timeout, priority, retry):
+        """
+        Sends the request to the host picked by the scheduler. A 429 or a
+        connection failure moves on to the next host; the last response or
+        error is returned or raised once every host has been tried.
+        """
+        request_method = getattr(self.session, method.lower())
+        attempts = len(self.scheduler.hosts)
+        for attempt in range(attempts):
+            host = self.scheduler.acquire(path, priority, timeout)
+            try:
+                resp = request_method(f'{host}{path}', json=body, headers=headers, timeout=timeout)
+            except (requests.ConnectionError, requests.Timeout):
+                self.scheduler.host_failed(host)
+                if attempt == attempts - 1:
+                    raise
+                continue
+            log_event(hot_logger, 'response_received', path=path, status=resp.status_code)
+            if hot_logger.isEnabledFor(logging.DEBUG):
+                hot_logger.debug("Response body: %s", resp.text[:120])
+            metrics.proxy_requests.labels(path=path, method=method, status_code=resp.status_code, retry=retry).inc()
+            self.scheduler.record(host, path, resp.status_code, resp.headers)
+            if resp.status_code != 429:
+                break
+        return resp
+
     def _ensure_access(self):
-        if not self.access_token:
-            if self.refresh_token:
-                self.refresh()
-            else:
-                self.login()
+        self.auth.ensure()
 
     def login(self):
         logger.info("Calling login.")
+        # Login and refresh run at order priority, since order legs wait on them.
         resp_body = self._send_request('/v1/usr/api/login/', method='post', body={
             'api_key': BITPIN_API_KEY,
             'secret_key': BITPIN_SECRET_KEY,
-        }).json()
+        }, priority=Priority.ORDER).json()
 
-        self.access_token = resp_body['access']
-        self.refresh_token = resp_body['refresh']
+        self.auth.set_tokens(resp_body['access'], resp_body['refresh'])
 
     def refresh(self):
         logger.info("Calling refresh.")
         resp = self._send_request('/v1/usr/refresh_token/', method='post', body={
-            'refresh': self.refresh_token,
-        })
+            'refresh': self.auth.refresh_token,
+        }, priority=Priority.ORDER)
 
         if resp.status_code >= 300:
             logger.info(f"Refresh failed({resp.status_code}). Logging in again.")
             self.login()
         else:
-            self.access_token = resp.json()['access']
+            self.auth.set_tokens(resp.json()['access'])
 
-    def get_open_orders(self, market_id, order_type: Literal['buy', 'sell'] = 'buy'):
+    def get_open_orders(self, market_id, order_type: Literal['buy', 'sell'] = 'buy', timeout=None):
         url_tmpl = f'/v2/mth/actives/{market_id}/?type={order_type}'
 
-        return self._send_request(url_tmpl).json()
+        return self._send_request(url_tmpl, timeout=timeout).json()
+
+    def get_markets(self):
+        markets = []
+        path = '/v1/mkt/markets/'
+        while path:
+            resp = self._send_request(path).json()
+            markets.extend(resp['results'])
+            next_url = resp.get('next')
+            path = next_url[next_url.index('/v1/'):] if next_url else None
+        return markets
 
     def get_my_open_orders(self):
         orders = []
-        resp = self._send_request('/v1/odr/orders/?state=active', authenticated=True).json()
+        resp = self._send_request('/v1/odr/orders/?state=active', authenticated=True,
+                                  priority=Priority.ORDER_STATUS).json()
         for order in resp['results']:
             orders.append(Order(
-                market=get_market_base_and_quote(order['market']['id']),
+                market=get_market_base_and_quote(int(order['market']['id'])),
                 identifier=order['identifier'],
                 amount=float(order['remain_amount']),
                 price=float(order['price']),
@@ -107,7 +187,7 @@ class BitpinProxy:
 
     def get_wallet_info(self):
         path = '/v1/wlt/wallets/'
-        resp = self._send_request(path, authenticated=True).json()
+        resp = self._send_request(path, authenticated=True, priority=Priority.WALLET).json()
         wallet = {}
 
         toman_value = 0
@@ -133,34 +213,30 @@ class BitpinProxy:
             mode='limit',
             identifier=None,
     ):
-        logger.info("Posting order")
-        if mode not in ['limit', 'market']:
-            raise NotImplementedError
-
         url = '/v1/odr/orders/'
-        payload = {
-            'market': market_id,
-            'amount1': round(base_amount, 9),
-            # 'amount2': 0,
-            'price': round(price, 9),
-            'mode': mode,
-            'type': side,
-            # 'identifier': '',  # TODO: we may need this later
-            'price_limit': round(price, 9),
-            # 'price_stop': 0,
-            # 'price_limit_oco': 0,
-        }
-
-        if mode == 'market':
-            payload.pop('price_limit')
-
-        if identifier is not None:
-            payload['identifier'] = identifier
-
-        resp = self._send_request(url, method='post', body=payload, authenticated=True)
-
-        # TODO: Error handling
+        payload = build_order_payload(market_id, base_amount, price, side, mode, identifier)
+
+        resp = self._send_request(url, method='post', body=payload, authenticated=True, priority=Priority.ORDER)
+        if resp.status_code >= 300:
+            raise OrderRejected(resp.status_code, resp.text)
         return resp.json()
 
 
-bitpin_proxy = BitpinProxy()
+_bitpin_proxy: Optional[BitpinProxy] = None
+_bitpin_proxy_lock = threading.Lock()
+
+
+def get_bitpin_proxy() -> BitpinProxy:
+    """The process wide proxy, created on first use. Creating it does not touch the network."""
+    global _bitpin_proxy
+    if _bitpin_proxy is None:
+        with _bitpin_proxy_lock:
+            if _bitpin_proxy is None:
+                _bitpin_proxy = BitpinProxy()
+    return _bitpin_proxy
+
+
+def set_bitpin_proxy(proxy):
+    """Makes `get_bitpin_proxy` return `proxy`, e.g. a stub for offline runs."""
+    global _bitpin_proxy
+    _bitpin_proxy = proxy
@@ -1,18 +1,21 @@
-import csv
 import logging
-from typing import List
+from typing import List, Tuple
 
+from log_config import hot_path_logger, log_event
+from market_graph import build_market_index, discover_triangles
 from market_repo import MarketRepository
+from opportunity_log import OpportunityLog
 from order import Order
-from trader import trader_agent
-from utils import get_market_base_and_quote
+from price_table import PriceTable
+from tracing import mark
+from trader import TraderAgent, get_trader_agent
+from triangle_engine import SELL_MAIN, TriangleEngine
+from utils import MARKET_MAPPING, get_market_scale
 
-CURRENCY_SAFETY_MARGIN = 0.995
 MINIMUM_ACCEPTED_PROFIT = 10
 
-logging.basicConfig(level=logging.INFO,  format='%(asctime)s %(message)s')
-
 logger = logging.getLogger(__name__)
+hot_logger = hot_path_logger(__name__)
 
 
 class Triangle:
@@ -20,11 +23,18 @@ class Triangle:
         self.main_token = main_token
         self.secondary_token = secondary_token
         self.base_token = base_token
+        # Fixed-point scales of the (base, main), (base, secondary) and (secondary, main) markets.
+        self.scales = tuple(get_market_scale(MARKET_MAPPING.get(market)) for market in self.markets)
 
     @property
     def tokens(self) -> List[str]:
         return [self.main_token, self.secondary_token, self.base_token]
 
+    @property
+    def markets(self) -> List[Tuple[str, str]]:
+        return [(self.base_token, self.main_token), (self.base_token, self.secondary_token),
+                (self.secondary_token, self.main_token)]
+
     def get_profit_market(self, market_repo: MarketRepository):
         p1 = market_repo.get_price(self.main_token, self.secondary_token)
         p2 = market_repo.get_price(self.secondary_token, self.base_token)
@@ -44,117 +54,99 @@ class Triangle:
         #     print(
         #         f"NONPROFIT! {profit * 1e6} {self.main_token}->{self.secondary_token}={p1} {self.secondary_token}->{self.base_token}={p2} {self.base_token}->{self.main_token}={p3}")
 
-    def get_profit_ask_bid(self, market_repo: MarketRepository):
-        a1 = market_repo.get_market_ask(self.base_token, self.main_token)
-        a2 = market_repo.get_market_ask(self.base_token, self.secondary_token)
-        a3 = market_repo.get_market_ask(self.secondary_token, self.main_token)
-        b1 = market_repo.get_market_bid(self.base_token, self.main_token)
-        b2 = market_repo.get_market_bid(self.base_token, self.secondary_token)
-        b3 = market_repo.get_market_bid(self.secondary_token, self.main_token)
-
-        if b1 and a2 and a3 and float(b1.get('price')) - float(a2.get('price')) * float(a3.get('price')) > 0:
-            profit_per_unit = float(b1.get('price')) - float(a2.get('price')) * float(a3.get('price'))
-            amount = min(float(b1.get('remain')), float(a2.get('remain')))
-
-            amount = min(amount, trader_agent.get_tradable_balance(self.base_token))
-            tether_amount = trader_agent.get_tradable_balance(self.main_token) / float(a3.get('price'))
-            tether_amount = min(tether_amount, trader_agent.get_tradable_balance(self.secondary_token))
-            tether_amount *= CURRENCY_SAFETY_MARGIN
-            amount = min(amount, tether_amount / float(a2.get('price')))
-
-            profit = profit_per_unit * amount
-
-            return {"base": self.base_token,
-                    "main_market_optimal_position": "sell",
-                    "main_market_order_amount": amount,
-                    "main_market_price": float(b1.get('price')),
-                    "secondary_market_optimal_position": "buy",
-                    "secondary_market_order_amount": amount,
-                    "secondary_market_price": float(a2.get('price')),
-                    "secondary_quote_optimal_position": "buy",
-                    "secondary_quote_order_amount": amount * float(a2.get('price')),
-                    "secondary_quote_price": float(a3.get('price')),
-                    "expected_profit": profit}
-
-        elif a1 and b2 and b3 and -float(a1.get('price')) + float(b2.get('price')) * float(b3.get('price')) > 0:
-            profit_per_unit = -float(a1.get('price')) + float(b2.get('price')) * float(b3.get('price'))
-            amount = min(float(a1.get('remain')), float(b2.get('remain')))
-
-            amount = min(amount, trader_agent.get_tradable_balance(self.base_token))
-            rial_amount = trader_agent.get_tradable_balance(self.secondary_token) * float(b3.get('price'))
-            rial_amount = min(rial_amount, trader_agent.get_tradable_balance(self.main_token))
-            rial_amount *= CURRENCY_SAFETY_MARGIN
-            amount = min(amount, rial_amount / float(a1.get('price')))
-
-            profit = profit_per_unit * amount
-
-            return {"base": self.base_token,
-                    "main_market_optimal_position": "buy",
-                    "main_market_order_amount": amount,
-                    "main_market_price": float(a1.get('price')),
-                    "secondary_market_optimal_position": "sell",
-                    "secondary_market_order_amount": amount,
-                    "secondary_market_price": float(b2.get('price')),
-                    "secondary_quote_optimal_position": "sell",
-                    "secondary_quote_order_amount": amount * float(b2.get('price')),
-                    "secondary_quote_price": float(b3.get('price')),
-                    "expected_profit": profit}
+    def build_result(self, opportunity) -> dict:
+        """
+        Converts a row of `TriangleEngine.evaluate` into the order set description
+        of this triangle, with order amounts rounded down to the markets' lots.
+        """
+        main_scale, secondary_scale, quote_scale = self.scales
+        # Both base legs trade the same amount, so it has to fit the coarser of their lots.
+        amount = float(opportunity['amount'])
+        amount = min(main_scale.snap_amount(amount), secondary_scale.snap_amount(amount))
+        main_price = float(opportunity['main_price'])
+        secondary_price = float(opportunity['secondary_price'])
+        quote_price = float(opportunity['quote_price'])
+
+        if opportunity['direction'] == SELL_MAIN:
+            positions = ("sell", "buy", "buy")
+        else:
+            positions = ("buy", "sell", "sell")
+
+        return {"base": self.base_token,
+                "main_market_optimal_position": positions[0],
+                "main_market_order_amount": amount,
+                "main_market_price": main_price,
+                "secondary_market_optimal_position": positions[1],
+                "secondary_market_order_amount": amount,
+                "secondary_market_price": secondary_price,
+                "secondary_quote_optimal_position": positions[2],
+                "secondary_quote_order_amount": quote_scale.snap_amount(amount * secondary_price),
+                "secondary_quote_price": quote_price,
+                "expected_profit": float(opportunity['profit_per_unit']) * amount}
 
 
 class TriangleCalculator:
-    def __init__(self):
-        self.log_file = open('log_file.csv', mode='a')
-        self.triangles = [
-            Triangle('IRT', 'USDT', 'NOT'),
-            Triangle('IRT', 'USDT', 'DOGE'),
-            Triangle('IRT', 'USDT', 'TON'),
-            Triangle('IRT', 'USDT', 'BTC'),
-            Triangle('IRT', 'USDT', 'ETH'),
-        ]
-
-    def calculate(self, market_repo: MarketRepository, **kwargs):
-        logger.info("Calculating triangles")
-        writer = csv.writer(self.log_file)
-        for triangle in self.triangles:
-            logger.info("Checking triangle (%s)", " -> ".join(triangle.tokens))
-            market_id = kwargs.get('market_id')
-            if market_id:
-                market_sides = get_market_base_and_quote(market_id)
-                if market_sides[0] is not None:
-                    if market_sides[0] not in triangle.tokens or market_sides[1] not in triangle.tokens:
-                        logger.info("Sides not in market update, skipping.")
-                        continue
-            res = triangle.get_profit_ask_bid(market_repo)
-
-            if res is not None:
-                logger.info("Profitable trade: %s", str(res))
-
-                o1 = Order(
-                    market=(triangle.base_token, triangle.main_token),
-                    side=res['main_market_optimal_position'],
-                    amount=res['main_market_order_amount'],
-                    price=res['main_market_price'],
-                )
-
-                o2 = Order(
-                    market=(triangle.base_token, triangle.secondary_token),
-                    side=res['secondary_market_optimal_position'],
-                    amount=res['secondary_market_order_amount'],
-                    price=res['secondary_market_price'],
-                )
-
-                o3 = Order(
-                    market=(triangle.secondary_token, triangle.main_token),
-                    side=res['secondary_quote_optimal_position'],
-                    amount=res['secondary_quote_order_amount'],
-                    price=res['secondary_quote_price'],
-                )
-
-                order_set = [o1, o2, o3]
-                if res['expected_profit'] > MINIMUM_ACCEPTED_PROFIT:
-                    logger.info("Placing orders...")
-                    trader_agent.place_order_set(order_set)
-
-                writer.writerow(res.values())
-
-        self.log_file.flush()
+    def __init__(self, opportunity_log: OpportunityLog = None, trader_agent: TraderAgent = None):
+        self.opportunity_log = opportunity_log if opportunity_log is not None else OpportunityLog()
+        self.trader_agent = trader_agent if trader_agent is not None else get_trader_agent()
+        self.triangles = [Triangle(*tokens) for tokens in discover_triangles(MARKET_MAPPING)]
+        self.market_triangles = build_market_index([t.tokens for t in self.triangles], MARKET_MAPPING)
+        self.engine = None
+
+    def _get_engine(self, price_table: PriceTable) -> TriangleEngine:
+        if self.engine is None:
+            self.engine = TriangleEngine(
+                [triangle.tokens for triangle in self.triangles],
+                price_table.index,
+                MARKET_MAPPING,
+            )
+        return self.engine
+
+    def calculate(self, price_table: PriceTable, **kwargs) -> float:
+        """Evaluates the triangles touched by `market_id` and returns the best expected profit seen."""
+        hot_logger.debug("Calculating triangles")
+        market_id = kwargs.get('market_id')
+        trace = kwargs.get('trace')
+        subset = None
+        if market_id:
+            subset = self.market_triangles.get(market_id, [])
+
+        engine = self._get_engine(price_table)
+        balances = engine.balance_vector(self.trader_agent.get_tradable_balance)
+        opportunities = engine.evaluate(price_table.snapshot(), balances, subset)
+        mark(trace, 'evaluated')
+
+        for opportunity in opportunities:
+            triangle = self.triangles[opportunity['triangle']]
+            res = triangle.build_result(opportunity)
+            log_event(logger, 'opportunity', triangle=triangle.tokens, **res)
+
+            o1 = Order(
+                market=(triangle.base_token, triangle.main_token),
+                side=res['main_market_optimal_position'],
+                amount=res['main_market_order_amount'],
+                price=res['main_market_price'],
+            )
+
+            o2 = Order(
+                market=(triangle.base_token, triangle.secondary_token),
+                side=res['secondary_market_optimal_position'],
+                amount=res['secondary_market_order_amount'],
+                price=res['secondary_market_price'],
+            )
+
+            o3 = Order(
+                market=(triangle.secondary_token, triangle.main_token),
+                side=res['secondary_quote_optimal_position'],
+                amount=res['secondary_quote_order_amount'],
+                price=res['secondary_quote_price'],
+            )
+
+            order_set = [o1, o2, o3]
+            if res['expected_profit'] > MINIMUM_ACCEPTED_PROFIT and res['secondary_quote_order_amount'] > 0:
+                logger.info("Placing orders...")
+                self.trader_agent.place_order_set(order_set, trace)
+
+            self.opportunity_log.log(res, market_id=market_id)
+
+        return float(opportunities['expected_profit'][0]) if len(opportunities) else 0.
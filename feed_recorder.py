@@ -0,0 +1,113 @@
+import atexit
+import glob
+import gzip
+import logging
+import os
+import queue
+import struct
+import threading
+import time
+import zlib
+from typing import Iterator, List, Optional, Tuple
+
+FEED_RECORD_PATH = os.environ.get('FEED_RECORD_PATH')
+FLUSH_INTERVAL = 5.
+
+# Every record is a receive timestamp and a payload length followed by the raw frame.
+RECORD_HEADER = struct.Struct('<dI')
+
+logger = logging.getLogger(__name__)
+
+_STOP = object()
+
+
+def segment_path(path: str, started_at: float = None) -> str:
+    """Segment of the recording `path` written by a run started at `started_at`."""
+    stem, gz, _ = path.partition('.gz')
+    stamp = time.strftime('%Y%m%d-%H%M%S', time.localtime(started_at if started_at is not None else time.time()))
+    return f'{stem}.{stamp}-{os.getpid()}{gz or ".gz"}'
+
+
+def recording_files(path: str) -> List[str]:
+    """`path` itself if it is a file, otherwise the segments recorded under it in recording order."""
+    if os.path.isfile(path):
+        return [path]
+    stem, gz, _ = path.partition('.gz')
+    return sorted(glob.glob(f'{glob.escape(stem)}.*-*{gz or ".gz"}'))
+
+
+class FeedRecorder:
+    """
+    Writes raw websocket frames with their receive time to a gzip file.
+    `record` only enqueues; compression and I/O happen on a writer thread.
+    Every run writes its own segment next to `path` (see `segment_path`), so
+    a run that dies without closing its file leaves the earlier ones readable.
+    """
+
+    def __init__(self, path: str):
+        self.path = segment_path(path)
+        self._queue = queue.SimpleQueue()
+        self._thread = threading.Thread(target=self._run, name='feed-recorder', daemon=True)
+        self._thread.start()
+        atexit.register(self.close, timeout=FLUSH_INTERVAL)
+
+    def record(self, raw, received_at: Optional[float] = None):
+        self._queue.put((received_at if received_at is not None else time.time(), raw))
+
+    def close(self, timeout: Optional[float] = None):
+        """Writes what is queued and ends the gzip stream; safe to call more than once."""
+        if self._thread.is_alive():
+            self._queue.put(_STOP)
+            self._thread.join(timeout)
+
+    def _run(self):
+        logger.info("Recording the market feed to %s", self.path)
+        with gzip.open(self.path, 'xb') as f:
+            last_flush = time.monotonic()
+            while True:
+                try:
+                    item = self._queue.get(timeout=FLUSH_INTERVAL)
+                except queue.Empty:
+                    item = None
+                if item is _STOP:
+                    break
+
+                if item is not None:
+                    received_at, raw = item
+                    if isinstance(raw, str):
+                        raw = raw.encode()
+                    f.write(RECORD_HEADER.pack(received_at, len(raw)))
+                    f.write(raw)
+
+                if time.monotonic() - last_flush >= FLUSH_INTERVAL:
+                    f.flush()
+                    last_flush = time.monotonic()
+
+
+def _read_segment(path: str) -> Iterator[Tuple[float, bytes]]:
+    with gzip.open(path, 'rb') as f:
+        while True:
+            header = f.read(RECORD_HEADER.size)
+            if len(header) < RECORD_HEADER.size:
+                if header:
+                    logger.warning("Recording %s ends with a truncated frame", path)
+                return
+            received_at, length = RECORD_HEADER.unpack(header)
+            raw = f.read(length)
+            if len(raw) < length:
+                logger.warning("Recording %s ends with a truncated frame", path)
+                return
+            yield received_at, raw
+
+
+def read_frames(path: str) -> Iterator[Tuple[float, bytes]]:
+    """
+    Yields `(received_at, raw frame)` of the recording `path` (a file, or the
+    `FEED_RECORD_PATH` its segments were written under) in recording order.
+    A segment that is truncated or corrupt is read up to the damage.
+    """
+    for segment in recording_files(path):
+        try:
+            yield from _read_segment(segment)
+        except (EOFError, zlib.error, gzip.BadGzipFile) as e:
+            logger.warning("Recording %s is damaged, skipping its remainder: %s", segment, e)
@@ -0,0 +1,238 @@
+import logging
+import os
+import random
+import threading
+import time
+from typing import Callable, Dict, List, Optional, Sequence
+
+import websocket
+
+import metrics
+
+MIN_BACKOFF = float(os.environ.get('FEED_MIN_BACKOFF', 0.1))
+MAX_BACKOFF = float(os.environ.get('FEED_MAX_BACKOFF', 30))
+# A connection that delivered neither data nor pings/pongs for this long is considered dead.
+HEARTBEAT_TIMEOUT = float(os.environ.get('FEED_HEARTBEAT_TIMEOUT', 15))
+# websocket-client sends its first ping two intervals after connecting, so a
+# connection of quiet markets gets its first pong well within the timeout.
+PING_INTERVAL = HEARTBEAT_TIMEOUT / 3
+PING_TIMEOUT = PING_INTERVAL / 2
+# Markets whose book has not been updated for this long are resynced.
+STALE_AFTER = float(os.environ.get('FEED_STALE_AFTER', 60))
+# Grace period after (re)connecting for the websocket to refresh a market before it is resynced over REST.
+RESYNC_DELAY = float(os.environ.get('FEED_RESYNC_DELAY', 1))
+WATCHDOG_INTERVAL = 0.5
+
+# Comma separated websocket endpoints. With several, every market is subscribed on each of them.
+FEED_ENDPOINTS = [addr.strip() for addr in os.environ.get('FEED_ENDPOINTS', '').split(',') if addr.strip()]
+# Number of connections per endpoint the markets are spread over.
+FEED_SHARDS = int(os.environ.get('FEED_SHARDS', 1))
+
+logger = logging.getLogger(__name__)
+
+
+class FeedSupervisor:
+    """
+    Keeps one market websocket connected, subscribed to `market_ids`.
+
+    Reconnects back off exponentially with jitter, reset once a connection
+    delivers a message or was heard from for `HEARTBEAT_TIMEOUT` after
+    opening, so a peer that accepts and then closes or goes silent is not
+    reconnected to in a tight loop. `check_heartbeat` drops connections that delivered neither
+    messages nor pings/pongs lately, so a shard of quiet markets stays up.
+    `on_disconnected` is called once every time the connection is lost or
+    declared dead.
+    """
+
+    def __init__(self, market_repo, ws_addr: str, market_ids: Sequence[int],
+                 on_disconnected: Callable[['FeedSupervisor'], None] = None):
+        self.market_repo = market_repo
+        self.ws_addr = ws_addr
+        self.market_ids = list(market_ids)
+        self.on_disconnected = on_disconnected
+        self.ws: Optional[websocket.WebSocketApp] = None
+        self.failures = 0
+        self.connected_at: Optional[float] = None
+        self.last_message_at: Optional[float] = None
+        self._stopped = threading.Event()
+
+    def run(self):
+        """Connects and reconnects until `stop` is called."""
+        while not self._stopped.is_set():
+            self.ws = websocket.WebSocketApp(
+                self.ws_addr,
+                on_open=self._on_open,
+                on_message=self._on_message,
+                on_error=self._on_error,
+                on_close=self._on_close,
+                on_ping=self._on_alive,
+                on_pong=self._on_alive,
+            )
+            self.ws.run_forever(ping_interval=PING_INTERVAL, ping_timeout=PING_TIMEOUT,
+                                ping_payload='{ "message" : "PING"}')
+            self._disconnected()
+            if self._stopped.is_set():
+                break
+            delay = self.backoff()
+            logger.warning("Market websocket %s disconnected, reconnecting in %.2fs", self.ws_addr, delay)
+            self._stopped.wait(delay)
+
+    def stop(self):
+        self._stopped.set()
+        if self.ws is not None:
+            self.ws.close()
+
+    def backoff(self) -> float:
+        """Exponential back off with jitter over the attempts since a connection was last healthy."""
+        delay = min(MAX_BACKOFF, MIN_BACKOFF * 2 ** self.failures)
+        self.failures += 1
+        return random.uniform(delay / 2, delay)
+
+    def check_heartbeat(self, now: float):
+        if self.connected_at is not None and now - self.last_message_at > HEARTBEAT_TIMEOUT:
+            logger.warning("Nothing received from %s for %.1fs, dropping the connection",
+                           self.ws_addr, now - self.last_message_at)
+            # Stop relying on it right away; the close handshake with a dead peer can take a while.
+            self._disconnected()
+            self.ws.close()
+
+    def _on_open(self, ws):
+        now = time.time()
+        logger.info("Market websocket %s connected", self.ws_addr)
+        self.connected_at = self.last_message_at = now
+        self.market_repo.subscribe(ws, self.market_ids)
+
+    def _on_message(self, ws, message):
+        self.last_message_at = time.time()
+        if self.failures:
+            self.failures = 0
+        self.market_repo._on_message(ws, message, source=self.ws_addr)
+
+    def _on_alive(self, ws, payload):
+        self.last_message_at = time.time()
+
+    def _on_error(self, ws, error: Exception):
+        logger.warning("Market websocket %s error: %s", self.ws_addr, error)
+
+    def _on_close(self, ws, close_status_code, close_msg):
+        logger.info("Market websocket %s closed (%s): %s", self.ws_addr, close_status_code, close_msg)
+
+    def _disconnected(self):
+        """Called once the connection is lost or declared dead; repeated calls do nothing."""
+        if self.connected_at is None:
+            return
+        if self.last_message_at - self.connected_at >= HEARTBEAT_TIMEOUT:
+            self.failures = 0
+        self.connected_at = None
+        metrics.feed_disconnects.labels(endpoint=self.ws_addr).inc()
+        if self.on_disconnected is not None:
+            self.on_disconnected(self)
+
+
+def shard(market_ids: Sequence[int], n_shards: int) -> List[List[int]]:
+    """Spreads `market_ids` round robin over at most `n_shards` non-empty groups."""
+    n_shards = max(1, min(n_shards, len(market_ids)))
+    return [list(market_ids[i::n_shards]) for i in range(n_shards)]
+
+
+class FeedManager:
+    """
+    Runs one `FeedSupervisor` per shard of the markets and per endpoint, so
+    several connections are read in parallel and, with more than one
+    endpoint, every market arrives on each of them. The ingestion pipeline
+    keeps the first arrival of each update.
+
+    A market is marked stale, which takes it out of evaluation, when no
+    connected connection covers it any more. Markets are fresh again once a
+    newer frame arrives for them; those that stay stale for `RESYNC_DELAY`
+    after a covering connection is up, or whose book was not updated for
+    `STALE_AFTER`, are resynced from the order list endpoint. The time until
+    every market is fresh again is measured.
+    """
+
+    def __init__(self, market_repo, endpoints: Sequence[str], n_shards: int = FEED_SHARDS):
+        self.market_repo = market_repo
+        self.connections = [
+            FeedSupervisor(market_repo, ws_addr, market_ids, on_disconnected=self._connection_lost)
+            for market_ids in shard(market_repo.price_table.market_ids, n_shards)
+            for ws_addr in endpoints
+        ]
+        self.coverage: Dict[int, List[FeedSupervisor]] = {}
+        for connection in self.connections:
+            for market_id in connection.market_ids:
+                self.coverage.setdefault(market_id, []).append(connection)
+        self.disconnected_at: Optional[float] = None
+        self._resyncing = threading.Lock()
+        self._stopped = threading.Event()
+
+    def run(self):
+        """Runs every connection and the watchdog until `stop` is called."""
+        threads = [threading.Thread(target=connection.run, name=f'feed-{i}', daemon=True)
+                   for i, connection in enumerate(self.connections)]
+        for thread in threads:
+            thread.start()
+        while not self._stopped.wait(WATCHDOG_INTERVAL):
+            try:
+                self.check()
+            except Exception:
+                logger.exception("Feed watchdog check failed")
+
+    def stop(self):
+        self._stopped.set()
+        for connection in self.connections:
+            connection.stop()
+
+    def _connected_at(self, market_id: int) -> Optional[float]:
+        """Earliest connect time of the live connections covering `market_id`."""
+        times = [c.connected_at for c in self.coverage.get(market_id, ()) if c.connected_at is not None]
+        return min(times) if times else None
+
+    def _connection_lost(self, connection: FeedSupervisor):
+        now = time.time()
+        uncovered = [market_id for market_id in connection.market_ids if self._connected_at(market_id) is None]
+        if uncovered:
+            if self.disconnected_at is None:
+                self.disconnected_at = now
+            self.market_repo.mark_stale(uncovered, since=now)
+
+    def check(self):
+        now = time.time()
+        repo = self.market_repo
+        for connection in self.connections:
+            connection.check_heartbeat(now)
+
+        quiet = repo.markets_not_updated_since(now - STALE_AFTER)
+        if quiet:
+            repo.mark_stale(quiet, since=now)
+
+        stale = repo.stale_markets()
+        metrics.feed_stale_markets.set(len(stale))
+
+        if self.disconnected_at is not None and not stale:
+            recovery = now - self.disconnected_at
+            logger.info("All markets fresh %.2fs after the disconnect", recovery)
+            metrics.feed_recovery_duration.observe(recovery)
+            self.disconnected_at = None
+
+        due = []
+        for market_id, since in stale.items():
+            connected_at = self._connected_at(market_id)
+            if connected_at is not None and now - max(since, connected_at) >= RESYNC_DELAY:
+                due.append(market_id)
+        if due and self._resyncing.acquire(blocking=False):
+            threading.Thread(target=self._resync, args=(due,), name='feed-resync', daemon=True).start()
+
+    def status(self) -> List[dict]:
+        now = time.time()
+        return [{'endpoint': c.ws_addr, 'markets': len(c.market_ids), 'connected': c.connected_at is not None,
+                 'failures': c.failures,
+                 'last_message_age': now - c.last_message_at if c.last_message_at is not None else None}
+                for c in self.connections]
+
+    def _resync(self, market_ids):
+        try:
+            logger.info("Resyncing %d stale markets", len(market_ids))
+            metrics.feed_resyncs.inc(len(market_ids))
+            self.market_repo.resync(market_ids)
+        finally:
+            self._resyncing.release()
@@ -0,0 +1,91 @@
+"""
+Scaled integer prices and amounts. A market's `MarketScale` is derived from
+its tick and lot sizes: prices are counted in units of 10**-price_decimals
+and amounts in units of 10**-amount_decimals, so every valid price or
+amount is an integer and book levels compare exactly. Exchange strings are
+parsed into units once at ingestion; floats are only produced for the
+price table and the calculator, and order values are snapped back to the
+market's increments before they are sent.
+"""
+import math
+from dataclasses import dataclass, field
+from decimal import ROUND_DOWN, Decimal
+from functools import lru_cache
+from typing import Optional, Tuple
+
+# Used for markets without known tick or lot sizes; matches the 9 decimals orders used to be rounded to.
+DEFAULT_DECIMALS = 9
+# Float values within this many units of a step boundary are taken to be on it when flooring.
+SNAP_TOLERANCE = 1e-6
+
+
+def _decimals_and_step(step: Optional[float]) -> Tuple[int, int]:
+    if not step:
+        return DEFAULT_DECIMALS, 1
+    normalized = Decimal(repr(float(step))).normalize()
+    decimals = max(0, -normalized.as_tuple().exponent)
+    return decimals, int(normalized.scaleb(decimals))
+
+
+# Snapshots repeat most price and amount strings between ticks, so parsing is memoized.
+@lru_cache(maxsize=1 << 15)
+def parse_units(text: str, decimals: int) -> int:
+    """Decimal string `text` in units of 10**-decimals. Digits beyond `decimals` are truncated."""
+    if not isinstance(text, str):
+        text = repr(text)
+    if 'e' in text or 'E' in text:
+        return int(Decimal(text).scaleb(decimals).to_integral_value(ROUND_DOWN))
+    whole, _, fraction = text.partition('.')
+    return int((whole or '0') + fraction[:decimals].ljust(decimals, '0'))
+
+
+@dataclass(frozen=True)
+class MarketScale:
+    price_decimals: int = DEFAULT_DECIMALS
+    amount_decimals: int = DEFAULT_DECIMALS
+    # Tick and lot size, in units.
+    price_step: int = 1
+    amount_step: int = 1
+    price_denominator: int = field(init=False, repr=False, compare=False)
+    amount_denominator: int = field(init=False, repr=False, compare=False)
+
+    def __post_init__(self):
+        object.__setattr__(self, 'price_denominator', 10 ** self.price_decimals)
+        object.__setattr__(self, 'amount_denominator', 10 ** self.amount_decimals)
+
+    @classmethod
+    def from_steps(cls, tick_size: Optional[float], lot_size: Optional[float]) -> 'MarketScale':
+        price_decimals, price_step = _decimals_and_step(tick_size)
+        amount_decimals, amount_step = _decimals_and_step(lot_size)
+        return cls(price_decimals, amount_decimals, price_step, amount_step)
+
+    def parse_price(self, text: str) -> int:
+        return parse_units(text, self.price_decimals)
+
+    def parse_amount(self, text: str) -> int:
+        return parse_units(text, self.amount_decimals)
+
+    def price(self, units: int) -> float:
+        # Division by an exact power of ten rounds correctly, unlike multiplying by its inverse.
+        return units / self.price_denominator
+
+    def amount(self, units: int) -> float:
+        return units / self.amount_denominator
+
+    def price_units(self, price: float) -> int:
+        """`price` rounded to the nearest tick, in units."""
+        return round(price * self.price_denominator / self.price_step) * self.price_step
+
+    def amount_units(self, amount: float) -> int:
+        """`amount` rounded down to a whole number of lots, in units."""
+        lots = math.floor(amount * self.amount_denominator / self.amount_step + SNAP_TOLERANCE)
+        return max(lots, 0) * self.amount_step
+
+    def snap_price(self, price: float) -> float:
+        return self.price(self.price_units(price))
+
+    def snap_amount(self, amount: float) -> float:
+        return self.amount(self.amount_units(amount))
+
+
+DEFAULT_SCALE = MarketScale()
@@ -0,0 +1,154 @@
+import logging
+import queue
+import threading
+import time
+from typing import Callable, Dict, List, NamedTuple, Optional, Set, Tuple
+
+try:
+    import orjson
+
+    _loads = orjson.loads
+except ImportError:  # pragma: no cover
+    import json
+
+    _loads = json.loads
+
+import metrics
+from local_metrics import batched
+from tracing import TraceContext, mark, parse_event_time
+
+logger = logging.getLogger(__name__)
+
+
+class MarketFrame(NamedTuple):
+    market_id: int
+    market_code: str
+    buy: List[dict]
+    sell: List[dict]
+    event_time: Optional[str]
+    received_at: float
+    trace: Optional[TraceContext] = None
+
+
+def decode_market_frame(raw, received_at: float = None, trace: TraceContext = None) -> Optional[MarketFrame]:
+    """Decodes a websocket frame, returning None for anything but a `market_update` event."""
+    data = _loads(raw)
+    if data.get('event') != 'market_update':
+        return None
+    market = data['market']
+    return MarketFrame(
+        market_id=int(market['id']),
+        market_code=market.get('code'),
+        buy=data['buy'],
+        sell=data['sell'],
+        event_time=data.get('event_time'),
+        received_at=received_at if received_at is not None else time.time(),
+        trace=trace,
+    )
+
+
+class IngestionPipeline:
+    """
+    Reader -> decoder -> processor stages for market frames.
+
+    `submit` is called on the websocket threads and only enqueues the raw
+    frame. The decoder drops frames whose `event_time` is older than the
+    last one seen for the market, or equal to it with a payload already
+    seen. That merges redundant connections into the first arrival of each
+    update without losing distinct updates that share a timestamp. It keeps
+    one pending frame per market, so a frame that has not been processed
+    yet is replaced by a newer one for the same market; the processor
+    always handles the newest known state.
+    """
+
+    def __init__(self, handler: Callable[[MarketFrame], None]):
+        self.handler = handler
+        self.superseded = 0
+        self.superseded_metric = batched(metrics.superseded_market_updates)
+        self.duplicates = 0
+        self.duplicates_metric = batched(metrics.duplicate_market_updates)
+        self._first_arrival_metrics = {}
+        # market id -> latest event time and the payloads seen with it
+        self._latest_event: Dict[int, Tuple[float, Set[int]]] = {}
+        self._raw = queue.SimpleQueue()
+        self._pending: Dict[int, MarketFrame] = {}
+        self._pending_cond = threading.Condition()
+        self._threads = []
+
+    def start(self):
+        if self._threads:
+            return
+        self._threads = [
+            threading.Thread(target=self._decode_loop, name='ingestion-decoder', daemon=True),
+            threading.Thread(target=self._process_loop, name='ingestion-processor', daemon=True),
+        ]
+        for thread in self._threads:
+            thread.start()
+
+    def submit(self, raw, received_at: Optional[float] = None, source: Optional[str] = None):
+        self._raw.put((raw, received_at if received_at is not None else time.time(), source, TraceContext.start()))
+
+    def _is_duplicate(self, frame: MarketFrame, raw) -> bool:
+        if not frame.event_time:
+            return False
+        event_time = parse_event_time(frame.event_time)
+        payload = hash(raw)
+        latest = self._latest_event.get(frame.market_id)
+        if latest is not None:
+            latest_time, payloads = latest
+            if event_time < latest_time:
+                return True
+            if event_time == latest_time:
+                if payload in payloads:
+                    return True
+                payloads.add(payload)
+                return False
+        self._latest_event[frame.market_id] = (event_time, {payload})
+        return False
+
+    def _count_first_arrival(self, source: str):
+        metric = self._first_arrival_metrics.get(source)
+        if metric is None:
+            metric = self._first_arrival_metrics[source] = batched(metrics.feed_first_arrivals, endpoint=source)
+        metric.inc()
+
+    def _decode_loop(self):
+        while True:
+            raw, received_at, source, trace = self._raw.get()
+            try:
+                frame = decode_market_frame(raw, received_at, trace)
+            except Exception as e:
+                logger.warning("Could not decode frame: %s", e)
+                continue
+            if frame is None:
+                continue
+            if self._is_duplicate(frame, raw):
+                self.duplicates += 1
+                self.duplicates_metric.inc()
+                continue
+            if source is not None:
+                self._count_first_arrival(source)
+            trace.market_id = frame.market_id
+            trace.mark('decoded')
+
+            with self._pending_cond:
+                if frame.market_id in self._pending:
+                    self.superseded += 1
+                    self.superseded_metric.inc()
+                self._pending[frame.market_id] = frame
+                self._pending_cond.notify()
+
+    def _process_loop(self):
+        while True:
+            with self._pending_cond:
+                while not self._pending:
+                    self._pending_cond.wait()
+                # Oldest pending market first; its frame is the newest one received for it.
+                market_id = next(iter(self._pending))
+                frame = self._pending.pop(market_id)
+
+            mark(frame.trace, 'processing')
+            try:
+                self.handler(frame)
+            except Exception:
+                logger.exception("Handling update of market %s failed", market_id)
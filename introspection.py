@@ -0,0 +1,366 @@
+"""
+Live introspection of the bot's processes. It is off by default; setting
+`DEBUG_PORT` turns it on and serves `/debug` on that port, on localhost
+only, apart from the public `/metrics` listener:
+
+    DEBUG_PORT=8001 python main.py
+    curl 'localhost:8001/debug/state'                       # actor queues, book freshness, feed connections
+    curl 'localhost:8001/debug/profile?seconds=10' > stacks # collapsed stacks, e.g. for flamegraph.pl
+    curl 'localhost:8001/debug/profile?seconds=5&format=json&pid=1234'
+    curl 'localhost:8001/debug/gc'                          # collections, pauses, memory
+    curl 'localhost:8001/debug/allocations?seconds=5'       # top allocation sites over a window
+
+Actors live in forked processes, so every process that calls `start` serves
+its own introspection on a unix socket in `INTROSPECTION_DIR`, one per pid,
+and the web server in the main process queries all of them (or only `pid`)
+in parallel. Actors expose their state with `register`. Profiling samples
+the stacks of every thread of a process; it costs nothing until requested.
+While disabled, `start`, `register` and `clear` do nothing.
+"""
+import gc
+import glob
+import json
+import logging
+import os
+import resource
+import socket
+import socketserver
+import sys
+import tempfile
+import threading
+import time
+import tracemalloc
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Dict, List, Optional
+
+from twisted.internet.threads import deferToThread
+from twisted.web.resource import Resource
+from twisted.web.server import NOT_DONE_YET
+
+# Port of the localhost-only `/debug` listener; introspection is disabled when unset.
+DEBUG_PORT = int(os.environ['DEBUG_PORT']) if 'DEBUG_PORT' in os.environ else None
+ENABLED = DEBUG_PORT is not None
+INTROSPECTION_DIR = os.environ.get('INTROSPECTION_DIR',
+                                   os.path.join(tempfile.gettempdir(), f'bitpin-introspection-{os.getuid()}'))
+PROFILE_INTERVAL = 0.005
+MAX_DURATION = 60
+# Extra time a process gets to answer on top of the requested duration.
+QUERY_TIMEOUT = 10
+ALLOCATION_FRAMES = 1
+# Threads serving introspection are left out of profiles.
+THREAD_PREFIX = 'introspection'
+
+logger = logging.getLogger(__name__)
+
+
+def collapse(frame, thread_name: str) -> str:
+    """Stack of `frame` in the collapsed `root;...;leaf` format, rooted at the thread."""
+    names = []
+    while frame is not None:
+        code = frame.f_code
+        names.append(f'{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})')
+        frame = frame.f_back
+    names.append(thread_name)
+    return ';'.join(reversed(names))
+
+
+def sample_stacks(duration: float, interval: float = PROFILE_INTERVAL) -> dict:
+    """Samples the stacks of all threads but the introspection ones every `interval` for `duration` seconds."""
+    own = threading.get_ident()
+    thread_names = {}
+    stacks = Counter()
+    samples = 0
+    deadline = time.monotonic() + duration
+    while time.monotonic() < deadline:
+        for ident, frame in sys._current_frames().items():
+            if ident not in thread_names:
+                thread_names = {thread.ident: thread.name for thread in threading.enumerate()}
+            name = thread_names.get(ident, str(ident))
+            if ident == own or name.startswith(THREAD_PREFIX):
+                continue
+            stacks[collapse(frame, name)] += 1
+        samples += 1
+        time.sleep(interval)
+    return {'samples': samples, 'interval': interval, 'stacks': dict(stacks)}
+
+
+class GCPauses:
+    """Collection counts and pause times per generation, recorded through `gc.callbacks`."""
+
+    def __init__(self):
+        self.collections = [0, 0, 0]
+        self.total = [0., 0., 0.]
+        self.max = [0., 0., 0.]
+        self._started_at = None
+
+    def __call__(self, phase: str, info: dict):
+        if phase == 'start':
+            self._started_at = time.perf_counter()
+        elif self._started_at is not None:
+            pause = time.perf_counter() - self._started_at
+            generation = info['generation']
+            self.collections[generation] += 1
+            self.total[generation] += pause
+            self.max[generation] = max(self.max[generation], pause)
+            self._started_at = None
+
+    def stats(self) -> List[dict]:
+        return [{'collections': self.collections[i], 'pause_total': self.total[i], 'pause_max': self.max[i]}
+                for i in range(3)]
+
+
+def gc_stats(objects: bool = False, limit: int = 20) -> dict:
+    stats = {
+        'counts': gc.get_count(),
+        'thresholds': gc.get_threshold(),
+        'generations': gc.get_stats(),
+        'pauses': _pauses.stats(),
+        'allocated_blocks': sys.getallocatedblocks(),
+        'max_rss_kb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+    }
+    if objects:
+        # Walks every tracked object, so only on request.
+        types = Counter(type(obj).__name__ for obj in gc.get_objects())
+        stats['objects'] = dict(types.most_common(limit))
+    return stats
+
+
+def allocation_stats(duration: float, limit: int = 20) -> dict:
+    """Allocation sites of the memory allocated in the next `duration` seconds and still alive after it."""
+    started = not tracemalloc.is_tracing()
+    if started:
+        tracemalloc.start(ALLOCATION_FRAMES)
+    try:
+        before = tracemalloc.take_snapshot()
+        time.sleep(duration)
+        after = tracemalloc.take_snapshot()
+        traced, peak = tracemalloc.get_traced_memory()
+    finally:
+        if started:
+            tracemalloc.stop()
+
+    exclude = [tracemalloc.Filter(False, tracemalloc.__file__)]
+    diff = after.filter_traces(exclude).compare_to(before.filter_traces(exclude), 'lineno')
+    return {
+        'traced': traced,
+        'peak': peak,
+        'top': [{'where': str(stat.traceback[0]), 'size_diff': stat.size_diff, 'count_diff': stat.count_diff,
+                 'size': stat.size, 'count': stat.count} for stat in diff[:limit]],
+    }
+
+
+class Introspection:
+    """Per-process registry of state providers and the unix socket server answering for them."""
+
+    def __init__(self, directory: str = INTROSPECTION_DIR):
+        self.directory = directory
+        # What the process runs, e.g. the actors in it.
+        self.names: List[str] = []
+        self.providers: Dict[str, Callable[[], dict]] = {}
+        self.server = None
+        self._pid = None
+        self._lock = threading.Lock()
+        # Profiles and allocation traces of one process would distort each other.
+        self._busy = threading.Lock()
+
+    @property
+    def path(self) -> str:
+        return os.path.join(self.directory, f'{os.getpid()}.sock')
+
+    def start(self, name: str):
+        """Serves introspection for the current process, once per process."""
+        with self._lock:
+            if name not in self.names:
+                self.names.append(name)
+            if self._pid == os.getpid():
+                return
+            os.makedirs(self.directory, mode=0o700, exist_ok=True)
+            if os.path.exists(self.path):
+                os.unlink(self.path)
+            self.server = socketserver.ThreadingUnixStreamServer(self.path, _make_handler(self))
+            self.server.daemon_threads = True
+            threading.Thread(target=self.server.serve_forever, name=THREAD_PREFIX, daemon=True).start()
+            self._pid = os.getpid()
+            if _pauses not in gc.callbacks:
+                gc.callbacks.append(_pauses)
+
+    def register(self, name: str, provider: Callable[[], dict]):
+        self.providers[name] = provider
+
+    def _after_fork(self):
+        # Forked children inherit neither the server thread nor the parent's actors.
+        self._lock = threading.Lock()
+        self._busy = threading.Lock()
+        self.names = []
+        self.providers = {}
+        self.server = None
+        _pauses.__init__()
+
+    def handle(self, command: str, args: dict):
+        if command == 'state':
+            return {name: provider() for name, provider in list(self.providers.items())}
+        if command == 'gc':
+            return gc_stats(args.get('objects', False), args.get('limit', 20))
+        if command in ('profile', 'allocations'):
+            if not self._busy.acquire(blocking=False):
+                raise RuntimeError('another profile is running in this process')
+            try:
+                if command == 'profile':
+                    return sample_stacks(args['seconds'], args.get('interval', PROFILE_INTERVAL))
+                return allocation_stats(args['seconds'], args.get('limit', 20))
+            finally:
+                self._busy.release()
+        raise ValueError(f'unknown command {command!r}')
+
+
+def _make_handler(introspection: Introspection):
+    class Handler(socketserver.StreamRequestHandler):
+        def handle(self):
+            request = json.loads(self.rfile.readline())
+            try:
+                response = {'result': introspection.handle(request['command'], request.get('args', {}))}
+            except Exception as e:
+                logger.exception("Introspection %s failed", request.get('command'))
+                response = {'error': str(e)}
+            response.update(name=','.join(introspection.names), pid=os.getpid())
+            self.wfile.write(json.dumps(response, default=str).encode())
+
+    return Handler
+
+
+_pauses = GCPauses()
+introspection = Introspection()
+os.register_at_fork(after_in_child=introspection._after_fork)
+
+
+def start(name: str):
+    if ENABLED:
+        introspection.start(name)
+
+
+def register(name: str, provider: Callable[[], dict]):
+    """Adds `provider`'s state to `/debug/state`. Providers are called from the introspection thread."""
+    if ENABLED:
+        introspection.register(name, provider)
+
+
+def clear(directory: str = INTROSPECTION_DIR):
+    """Removes the sockets left behind by earlier runs."""
+    if not ENABLED:
+        return
+    for path in glob.glob(os.path.join(directory, '*.sock')):
+        os.unlink(path)
+
+
+def query(path: str, command: str, args: dict, timeout: float) -> Optional[dict]:
+    """Response of the process serving `path`, or None when it is gone."""
+    try:
+        with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+            sock.settimeout(timeout)
+            sock.connect(path)
+            sock.sendall(json.dumps({'command': command, 'args': args}).encode() + b'\n')
+            sock.shutdown(socket.SHUT_WR)
+            data = b''.join(iter(lambda: sock.recv(1 << 16), b''))
+    except (ConnectionRefusedError, FileNotFoundError):
+        # The process exited without removing its socket.
+        try:
+            os.unlink(path)
+        except FileNotFoundError:
+            pass
+        return None
+    except OSError as e:
+        return {'pid': int(os.path.basename(path).split('.')[0]), 'error': str(e)}
+    return json.loads(data)
+
+
+def query_all(command: str, args: dict, pid: Optional[int] = None, directory: str = INTROSPECTION_DIR) -> List[dict]:
+    """Runs `command` in every process serving introspection, or only in `pid`, concurrently."""
+    paths = sorted(glob.glob(os.path.join(directory, '*.sock')))
+    if pid is not None:
+        paths = [path for path in paths if os.path.basename(path) == f'{pid}.sock']
+    if not paths:
+        return []
+    timeout = args.get('seconds', 0) + QUERY_TIMEOUT
+    with ThreadPoolExecutor(len(paths), thread_name_prefix=f'{THREAD_PREFIX}-query') as pool:
+        responses = pool.map(lambda path: query(path, command, args, timeout), paths)
+        return [response for response in responses if response is not None]
+
+
+def to_collapsed(responses: List[dict]) -> str:
+    """Collapsed stacks of all profiled processes, each rooted at `name pid`."""
+    lines = []
+    for response in responses:
+        root = f"{response.get('name')} {response['pid']}"
+        if 'error' in response:
+            lines.append(f"# {root}: {response['error']}")
+            continue
+        for stack, count in sorted(response['result']['stacks'].items()):
+            lines.append(f'{root};{stack} {count}')
+    return '\n'.join(lines) + '\n'
+
+
+class DebugEndpoint(Resource):
+    """Runs `command` in the processes off the reactor thread; query arguments become its args."""
+    isLeaf = True
+
+    def __init__(self, command: str, timed: bool = False):
+        super().__init__()
+        self.command = command
+        self.timed = timed
+
+    def parse_args(self, raw: Dict[str, str]) -> dict:
+        args = {}
+        if self.timed:
+            args['seconds'] = min(float(raw.get('seconds', 5)), MAX_DURATION)
+        if 'interval' in raw:
+            args['interval'] = max(float(raw['interval']), 0.001)
+        if 'limit' in raw:
+            args['limit'] = int(raw['limit'])
+        if 'objects' in raw:
+            args['objects'] = raw['objects'] not in ('0', 'false')
+        return args
+
+    def render_GET(self, request):
+        raw = {key.decode(): values[0].decode() for key, values in request.args.items()}
+        try:
+            args = self.parse_args(raw)
+            pid = int(raw['pid']) if 'pid' in raw else None
+        except ValueError as e:
+            request.setResponseCode(400)
+            return f'{e}\n'.encode()
+        collapsed = self.command == 'profile' and raw.get('format', 'collapsed') == 'collapsed'
+
+        finished = []
+        request.notifyFinish().addBoth(finished.append)
+
+        def respond(responses):
+            if finished:
+                return
+            if collapsed:
+                request.setHeader(b'Content-Type', b'text/plain; charset=utf-8')
+                request.write(to_collapsed(responses).encode())
+            else:
+                request.setHeader(b'Content-Type', b'application/json')
+                request.write(json.dumps(responses, indent=1, default=str).encode())
+            request.finish()
+
+        def fail(failure):
+            logger.error("Debug endpoint %s failed: %s", self.command, failure.getErrorMessage())
+            if not finished:
+                request.setResponseCode(500)
+                request.write(f'{failure.getErrorMessage()}\n'.encode())
+                request.finish()
+
+        deferToThread(query_all, self.command, args, pid).addCallbacks(respond, fail)
+        return NOT_DONE_YET
+
+
+def debug_resource() -> Resource:
+    """The `/debug` tree, served on the `DEBUG_PORT` listener."""
+    root = Resource()
+    root.putChild(b'state', DebugEndpoint('state'))
+    root.putChild(b'gc', DebugEndpoint('gc'))
+    root.putChild(b'profile', DebugEndpoint('profile', timed=True))
+    root.putChild(b'allocations', DebugEndpoint('allocations', timed=True))
+    return root
@@ -0,0 +1,22 @@
+from typing import Dict, Sequence
+
+import numpy as np
+
+
+def summarize(samples: Sequence[float], elapsed: float = None) -> Dict[str, float]:
+    """p50/p90/p99/max of `samples` (seconds), plus throughput if the wall time `elapsed` is given."""
+    if len(samples) == 0:
+        return {'count': 0}
+    values = np.asarray(samples, dtype=np.float64)
+    p50, p90, p99 = np.percentile(values, [50, 90, 99])
+    summary = {
+        'count': int(len(values)),
+        'mean': float(values.mean()),
+        'p50': float(p50),
+        'p90': float(p90),
+        'p99': float(p99),
+        'max': float(values.max()),
+    }
+    if elapsed:
+        summary['throughput'] = len(values) / elapsed
+    return summary
@@ -0,0 +1,73 @@
+import time
+from collections import defaultdict
+from typing import Dict, Iterable, List, Optional
+
+from order import Order
+
+
+class BalanceLedger:
+    """
+    Wallet balances plus the amount of each token reserved by open orders.
+    Reservations are updated as orders are added or cancelled, and fills
+    are taken in by `reconcile`, so the tradable balance of a token is a
+    subtraction instead of a scan over open orders.
+    """
+
+    def __init__(self):
+        self.wallet: Dict[str, float] = defaultdict(float)
+        self.reserved: Dict[str, float] = defaultdict(float)
+        self.orders: Dict[str, Order] = {}
+        self.added_at: Dict[str, float] = {}
+
+    @staticmethod
+    def _key(order: Order) -> str:
+        return order.identifier if order.identifier is not None else f'local-{id(order)}'
+
+    def tradable(self, token: str) -> float:
+        return self.wallet.get(token, 0.) - self.reserved.get(token, 0.)
+
+    def add_order(self, order: Order):
+        key = self._key(order)
+        if key in self.orders:
+            self.remove_order(key)
+        token, amount = order.paid()
+        self.reserved[token] += amount
+        self.orders[key] = order
+        self.added_at.setdefault(key, time.monotonic())
+
+    def remove_order(self, identifier: str):
+        """Releases the reservation of a cancelled (or fully filled) order."""
+        order = self.orders.pop(identifier, None)
+        self.added_at.pop(identifier, None)
+        if order is None:
+            return
+        token, amount = order.paid()
+        self.reserved[token] -= amount
+        if self.reserved[token] <= 1e-12:
+            del self.reserved[token]
+
+    def reconcile(self, wallet: Dict[str, float], open_orders: Iterable[Order],
+                  snapshot_time: Optional[float] = None):
+        """
+        Replaces the ledger state with an authoritative wallet/open orders snapshot.
+        Orders added locally after `snapshot_time` (`time.monotonic()` when the
+        snapshot was requested) are kept, since the snapshot cannot contain them yet.
+        """
+        recent = []
+        if snapshot_time is not None:
+            recent = [order for key, order in self.orders.items() if self.added_at.get(key, 0.) > snapshot_time]
+
+        self.wallet.clear()
+        self.wallet.update(wallet)
+        self.reserved.clear()
+        self.orders.clear()
+        self.added_at.clear()
+        for order in open_orders:
+            self.add_order(order)
+        for order in recent:
+            if self._key(order) not in self.orders:
+                self.add_order(order)
+
+    @property
+    def open_orders(self) -> List[Order]:
+        return list(self.orders.values())
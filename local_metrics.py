@@ -0,0 +1,206 @@
+"""
+Process-local accumulators for metrics updated on every tick.
+
+In `PROMETHEUS_MULTIPROC_DIR` mode every update of a prometheus_client metric
+is a locked write to an mmap'd file, and `.labels(...)` is a dict lookup
+under another lock. `batched(metric, **labels)` binds the child once and
+returns an accumulator that only touches process memory; a flusher thread
+pushes what changed to the child every `METRICS_FLUSH_INTERVAL` seconds,
+and the multiprocess collector behind `/metrics` aggregates it as before.
+
+Accumulators are shared by the threads of a process and guard their state
+with a lock. Flushes push the difference to the last flushed state, so
+updates are never lost to a flush in progress. Counters and gauges go
+through the metrics' public API; histograms write their buckets directly,
+see `LocalHistogram`.
+"""
+import bisect
+import logging
+import os
+import threading
+from typing import Dict, List, Sequence, Tuple
+
+from prometheus_client import Counter, Gauge, Histogram
+
+import metrics
+
+METRICS_FLUSH_INTERVAL = float(os.environ.get('METRICS_FLUSH_INTERVAL', 1))
+
+logger = logging.getLogger(__name__)
+
+
+class LocalCounter:
+    def __init__(self, child):
+        self.child = child
+        self.value = 0.
+        self._flushed = 0.
+        self._lock = threading.Lock()
+
+    def inc(self, amount: float = 1.):
+        with self._lock:
+            self.value += amount
+
+    def flush(self):
+        with self._lock:
+            delta = self.value - self._flushed
+            self._flushed = self.value
+        if delta:
+            self.child.inc(delta)
+
+    def _after_fork(self):
+        # What the parent has not flushed yet is the parent's to flush.
+        self._lock = threading.Lock()
+        self._flushed = self.value
+
+
+class LocalGauge:
+    def __init__(self, child):
+        self.child = child
+        self.value = None
+        self._flushed = None
+
+    def set(self, value: float):
+        # A single store; the last value set wins, whichever thread set it.
+        self.value = value
+
+    def flush(self):
+        value = self.value
+        if value is not None and value != self._flushed:
+            self.child.set(value)
+            self._flushed = value
+
+    def _after_fork(self):
+        self._flushed = self.value
+
+
+class LocalHistogram:
+    """
+    Counts observations per bucket of `upper_bounds` along with their sum.
+    A flush adds each bucket's count and the sum to the child's values with
+    one increment apiece, as `Histogram.observe` itself does per observation.
+    That reaches into the child's `_buckets` and `_sum`, so `supports` checks
+    they look as expected and histograms are not batched otherwise.
+    """
+
+    def __init__(self, child, upper_bounds: Sequence[float]):
+        self.child = child
+        self.upper_bounds = list(upper_bounds)
+        self.counts = [0] * len(self.upper_bounds)
+        self.sum = 0.
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def supports(child, upper_bounds: Sequence[float]) -> bool:
+        buckets = getattr(child, '_buckets', None)
+        return (list(getattr(child, '_upper_bounds', ())) == list(upper_bounds)
+                and isinstance(buckets, list) and len(buckets) == len(upper_bounds)
+                and all(hasattr(value, 'inc') for value in buckets)
+                and hasattr(getattr(child, '_sum', None), 'inc'))
+
+    def observe(self, amount: float):
+        i = bisect.bisect_left(self.upper_bounds, amount)
+        with self._lock:
+            self.counts[i] += 1
+            self.sum += amount
+
+    def flush(self):
+        with self._lock:
+            counts, total = self.counts, self.sum
+            if not any(counts):
+                return
+            self._reset()
+        self.child._sum.inc(total)
+        for value, count in zip(self.child._buckets, counts):
+            if count:
+                value.inc(count)
+
+    def _reset(self):
+        self.counts = [0] * len(self.upper_bounds)
+        self.sum = 0.
+
+    def _after_fork(self):
+        self._lock = threading.Lock()
+        self._reset()
+
+
+def _accumulator(metric, child):
+    if isinstance(metric, Counter):
+        return LocalCounter(child)
+    if isinstance(metric, Gauge):
+        return LocalGauge(child)
+    if isinstance(metric, Histogram):
+        upper_bounds = metrics.HISTOGRAM_BUCKETS[metric]
+        if LocalHistogram.supports(child, upper_bounds):
+            return LocalHistogram(child, upper_bounds)
+        # The child is not laid out as expected, so it is observed directly.
+        return None
+    raise TypeError(f'Cannot batch {metric!r}')
+
+
+class MetricsFlusher:
+    def __init__(self, interval: float = METRICS_FLUSH_INTERVAL):
+        self.interval = interval
+        self.accumulators: Dict[Tuple, object] = {}
+        self._lock = threading.Lock()
+        self._stopped = threading.Event()
+        self._thread = None
+        self._pid = None
+
+    def batched(self, metric, **labels):
+        key = (id(metric), tuple(sorted(labels.items())))
+        accumulator = self.accumulators.get(key)
+        if accumulator is None:
+            with self._lock:
+                accumulator = self.accumulators.get(key)
+                if accumulator is None:
+                    child = metric.labels(**labels) if labels else metric
+                    accumulator = _accumulator(metric, child)
+                    if accumulator is None:
+                        return child
+                    self.accumulators[key] = accumulator
+        self._ensure_started()
+        return accumulator
+
+    def _ensure_started(self):
+        if self._pid == os.getpid():
+            return
+        with self._lock:
+            if self._pid == os.getpid():
+                return
+            self._pid = os.getpid()
+            self._thread = threading.Thread(target=self._flush_loop, name='metrics-flusher', daemon=True)
+            self._thread.start()
+
+    def _after_fork(self):
+        # Forked children inherit the accumulators, but not the thread flushing them.
+        self._lock = threading.Lock()
+        for accumulator in self.accumulators.values():
+            accumulator._after_fork()
+        if self._pid is not None:
+            self._ensure_started()
+
+    def flush(self):
+        with self._lock:
+            accumulators: List = list(self.accumulators.values())
+        for accumulator in accumulators:
+            try:
+                accumulator.flush()
+            except Exception:
+                logger.exception("Flushing %s failed", accumulator.child)
+
+    def _flush_loop(self):
+        while not self._stopped.wait(self.interval):
+            self.flush()
+
+    def stop(self):
+        self._stopped.set()
+        self.flush()
+
+
+flusher = MetricsFlusher()
+os.register_at_fork(after_in_child=flusher._after_fork)
+
+
+def batched(metric, **labels):
+    """Process-local accumulator bound to `metric` (with `labels`), flushed in the background."""
+    return flusher.batched(metric, **labels)
@@ -0,0 +1,164 @@
+"""
+Logging setup. Records are put on a bounded queue by the thread that logs
+them and formatted and written by a listener thread, so ticks never wait on
+formatting or stdout. Per-tick logging goes through `hot_path_logger`, whose
+level can be switched at runtime with `set_hot_path_level` or SIGUSR1:
+
+    pkill -USR1 -f main.py   # toggle hot path logging between HOT_PATH_LOG_LEVEL and DEBUG
+
+Structured events are logged with `log_event`. Their fields are formatted as
+`key=value` pairs on the listener thread, and each event type can be sampled
+and rate limited through `LOG_SAMPLING`, e.g. `event_delay=0.01,response_received=1/20`
+keeps 1% of `event_delay` and at most 20 `response_received` records a second.
+"""
+import logging
+import logging.handlers
+import os
+import queue
+import random
+import signal
+import sys
+import threading
+import time
+from typing import Dict, NamedTuple, Optional
+
+import metrics
+
+LOG_LEVEL = os.environ.get('LOG_LEVEL', 'INFO')
+HOT_PATH_LOG_LEVEL = os.environ.get('HOT_PATH_LOG_LEVEL', 'WARNING')
+LOG_SAMPLING = os.environ.get('LOG_SAMPLING', 'event_delay=0.01,market_updated=0.01,response_received=1/20')
+LOG_QUEUE_SIZE = 10000
+LOG_FORMAT = '%(asctime)s %(message)s'
+
+HOT_PATH = 'hot'
+
+
+class Sampling(NamedTuple):
+    rate: float = 1.
+    max_per_second: Optional[float] = None
+
+
+def parse_sampling(spec: str) -> Dict[str, Sampling]:
+    rules = {}
+    for item in filter(None, (part.strip() for part in spec.split(','))):
+        event, value = item.split('=')
+        rate, _, max_per_second = value.partition('/')
+        rules[event] = Sampling(float(rate), float(max_per_second) if max_per_second else None)
+    return rules
+
+
+class SamplingFilter(logging.Filter):
+    """Samples records per event type, the `event` of `log_event` records or the message template otherwise."""
+
+    def __init__(self, rules: Dict[str, Sampling]):
+        super().__init__()
+        self.rules = rules
+        self._windows: Dict[str, list] = {}
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        event = getattr(record, 'event', record.msg)
+        rule = self.rules.get(event)
+        if rule is None:
+            return True
+        if rule.rate < 1. and random.random() >= rule.rate:
+            return False
+        if rule.max_per_second is not None:
+            window = self._windows.setdefault(event, [0., 0])
+            now = time.monotonic()
+            if now - window[0] >= 1.:
+                window[0], window[1] = now, 0
+            window[1] += 1
+            return window[1] <= rule.max_per_second
+        return True
+
+
+class StructuredFormatter(logging.Formatter):
+    def format(self, record: logging.LogRecord) -> str:
+        message = super().format(record)
+        fields = getattr(record, 'fields', None)
+        if fields:
+            message += ' ' + ' '.join(f'{key}={value}' for key, value in fields.items())
+        return message
+
+
+class AsyncQueueHandler(logging.handlers.QueueHandler):
+    """
+    Non-blocking handler: records go on a bounded queue and are dropped, and
+    counted, when it is full. Formatting is left to the listener thread. The
+    listener is (re)started lazily in the current process, as lyrid forks its
+    actor processes after logging is configured.
+    """
+
+    def __init__(self, handler: logging.Handler, maxsize: int = LOG_QUEUE_SIZE):
+        super().__init__(queue.Queue(maxsize))
+        self.handler = handler
+        self.listener = None
+        self._pid = None
+        self._start_lock = threading.Lock()
+
+    def _ensure_listener(self):
+        with self._start_lock:
+            if self._pid == os.getpid():
+                return
+            # A forked child inherits the queue contents, but not the listener thread.
+            self.queue = queue.Queue(self.queue.maxsize)
+            self.listener = logging.handlers.QueueListener(self.queue, self.handler, respect_handler_level=True)
+            self.listener.start()
+            self._pid = os.getpid()
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        return record
+
+    def enqueue(self, record: logging.LogRecord):
+        if self._pid != os.getpid():
+            self._ensure_listener()
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            metrics.log_records_dropped.inc()
+
+    def close(self):
+        if self.listener is not None and self._pid == os.getpid():
+            self.listener.stop()
+        super().close()
+
+
+def hot_path_logger(name: str) -> logging.Logger:
+    """Logger for per-tick messages, below the `hot` logger so its level can be switched at runtime."""
+    return logging.getLogger(f'{HOT_PATH}.{name}')
+
+
+def set_hot_path_level(level):
+    logging.getLogger(HOT_PATH).setLevel(level)
+
+
+def log_event(logger: logging.Logger, event: str, level: int = logging.INFO, **fields):
+    """Logs `event` with `fields` formatted lazily as `key=value` pairs."""
+    if logger.isEnabledFor(level):
+        logger.log(level, event, extra={'event': event, 'fields': fields})
+
+
+def _toggle_hot_path_level(signum, frame):
+    hot = logging.getLogger(HOT_PATH)
+    hot.setLevel(logging.DEBUG if hot.level != logging.DEBUG else HOT_PATH_LOG_LEVEL)
+
+
+def configure(level=LOG_LEVEL, hot_path_level=HOT_PATH_LOG_LEVEL, sampling: str = LOG_SAMPLING, stream=None):
+    """Installs the queued handler on the root logger, replacing any configured handlers."""
+    handler = logging.StreamHandler(stream or sys.stdout)
+    handler.setFormatter(StructuredFormatter(LOG_FORMAT))
+
+    queue_handler = AsyncQueueHandler(handler)
+    queue_handler.addFilter(SamplingFilter(parse_sampling(sampling)))
+
+    root = logging.getLogger()
+    for old_handler in root.handlers[:]:
+        root.removeHandler(old_handler)
+        old_handler.close()
+    root.addHandler(queue_handler)
+    root.setLevel(level)
+    set_hot_path_level(hot_path_level)
+
+    if threading.current_thread() is threading.main_thread():
+        signal.signal(signal.SIGUSR1, _toggle_hot_path_level)
+    return queue_handler
@@ -1,4 +1,4 @@
-import logging
+import log_config
 
 # import logging_loki
 #
@@ -6,7 +6,7 @@ import logging
 #     url="http://localhost:9010/loki/api/v1/push",
 #     tags={"app": "trader"},
 # )
-logging.basicConfig(level=logging.INFO,  format='%(asctime)s %(message)s', force=True)
+log_config.configure()
 
 if __name__ == '__main__':
     import actor
@@ -0,0 +1,64 @@
+from collections import defaultdict
+from itertools import combinations
+from typing import Dict, List, Tuple
+
+MarketMapping = Dict[Tuple[str, str], int]
+TriangleTokens = Tuple[str, str, str]
+
+
+def build_graph(market_mapping: MarketMapping) -> Dict[str, set]:
+    """Undirected token graph, with an edge for every market regardless of its base/quote order."""
+    graph = defaultdict(set)
+    for base, quote in market_mapping:
+        graph[base].add(quote)
+        graph[quote].add(base)
+    return graph
+
+
+def _orient_triangle(tokens, market_mapping: MarketMapping):
+    """
+    Finds `(main, secondary, base)` such that (base, main), (base, secondary)
+    and (secondary, main) are all markets, or returns None if the markets
+    form a directed cycle instead.
+    """
+    for base in tokens:
+        for main in tokens:
+            if main == base:
+                continue
+            secondary = next(t for t in tokens if t not in (main, base))
+            if ((base, main) in market_mapping and (base, secondary) in market_mapping
+                    and (secondary, main) in market_mapping):
+                return main, secondary, base
+    return None
+
+
+def discover_triangles(market_mapping: MarketMapping) -> List[TriangleTokens]:
+    """All tradable 3-cycles of the market graph as `(main, secondary, base)` tuples."""
+    graph = build_graph(market_mapping)
+    triangles = []
+    for a in sorted(graph):
+        for b, c in combinations(sorted(n for n in graph[a] if n > a), 2):
+            if c not in graph[b]:
+                continue
+            triangle = _orient_triangle((a, b, c), market_mapping)
+            if triangle is not None:
+                triangles.append(triangle)
+    return sorted(triangles)
+
+
+def triangle_markets(triangle: TriangleTokens, market_mapping: MarketMapping) -> Tuple[int, int, int]:
+    main, secondary, base = triangle
+    return (
+        market_mapping[(base, main)],
+        market_mapping[(base, secondary)],
+        market_mapping[(secondary, main)],
+    )
+
+
+def build_market_index(triangles: List[TriangleTokens], market_mapping: MarketMapping) -> Dict[int, List[int]]:
+    """Maps each market id to the indices of the triangles that trade on it."""
+    index = defaultdict(list)
+    for i, triangle in enumerate(triangles):
+        for market_id in triangle_markets(triangle, market_mapping):
+            index[market_id].append(i)
+    return dict(index)
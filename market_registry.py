@@ -0,0 +1,156 @@
+import json
+import logging
+import os
+import sys
+from dataclasses import asdict, dataclass
+from functools import cached_property
+from typing import Dict, Iterable, Optional, Tuple
+
+from fixed_point import MarketScale
+
+MARKET_CACHE_PATH = os.environ.get('MARKET_CACHE_PATH', 'markets_cache.json')
+
+logger = logging.getLogger(__name__)
+
+
+@dataclass(frozen=True)
+class Market:
+    id: int
+    base: str
+    quote: str
+    tick_size: Optional[float] = None
+    lot_size: Optional[float] = None
+
+    @property
+    def symbol(self) -> Tuple[str, str]:
+        return self.base, self.quote
+
+    @property
+    def code(self) -> str:
+        return f'{self.base}_{self.quote}'
+
+    @cached_property
+    def scale(self) -> MarketScale:
+        """Fixed-point representation of the market's prices and amounts."""
+        return MarketScale.from_steps(self.tick_size, self.lot_size)
+
+
+def _make_market(market_id, base, quote, tick_size=None, lot_size=None) -> Market:
+    return Market(
+        id=int(market_id),
+        base=sys.intern(base),
+        quote=sys.intern(quote),
+        tick_size=tick_size,
+        lot_size=lot_size,
+    )
+
+
+def _precision_to_step(precision) -> Optional[float]:
+    if precision is None:
+        return None
+    return 10. ** -int(precision)
+
+
+def market_from_exchange(item: dict) -> Market:
+    """Builds a `Market` from an entry of the exchange's market list endpoint."""
+    tick_size = item.get('price_tick') or _precision_to_step(item.get('price_precision'))
+    lot_size = item.get('amount_tick') or _precision_to_step(item.get('amount_precision'))
+    return _make_market(
+        item['id'],
+        item['currency1']['code'],
+        item['currency2']['code'],
+        float(tick_size) if tick_size is not None else None,
+        float(lot_size) if lot_size is not None else None,
+    )
+
+
+class MarketRegistry:
+    """
+    Bidirectional market id <-> (base, quote) lookup. Market ids are always
+    stored as `int`, which is the only key type used for markets elsewhere.
+    """
+
+    def __init__(self, markets: Iterable[Market] = ()):
+        self.by_id: Dict[int, Market] = {}
+        self.by_symbol: Dict[Tuple[str, str], Market] = {}
+        for market in markets:
+            self.add(market)
+
+    def add(self, market: Market):
+        self.by_id[market.id] = market
+        self.by_symbol[market.symbol] = market
+
+    def get(self, market_id: int) -> Optional[Market]:
+        return self.by_id.get(market_id)
+
+    def get_by_symbol(self, base: str, quote: str) -> Optional[Market]:
+        return self.by_symbol.get((base, quote))
+
+    def id_of(self, base: str, quote: str) -> Optional[int]:
+        market = self.by_symbol.get((base, quote))
+        return market.id if market is not None else None
+
+    def symbol_of(self, market_id: int) -> Tuple[str, str] | Tuple[None, None]:
+        market = self.by_id.get(market_id)
+        return market.symbol if market is not None else (None, None)
+
+    def __contains__(self, market_id):
+        return market_id in self.by_id
+
+    def __iter__(self):
+        return iter(self.by_id.values())
+
+    def __len__(self):
+        return len(self.by_id)
+
+    @classmethod
+    def from_mapping(cls, market_mapping: Dict[Tuple[str, str], int]) -> 'MarketRegistry':
+        return cls(_make_market(market_id, base, quote) for (base, quote), market_id in market_mapping.items())
+
+    def update_from_exchange(self, items: Iterable[dict]):
+        for item in items:
+            self.add(market_from_exchange(item))
+
+    def save(self, path: str = MARKET_CACHE_PATH):
+        tmp_path = f'{path}.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump([asdict(market) for market in self], f, indent=1)
+        os.replace(tmp_path, path)
+
+    def load(self, path: str = MARKET_CACHE_PATH) -> bool:
+        """Adds the markets cached at `path`. Returns False if there is no usable cache."""
+        try:
+            with open(path) as f:
+                items = json.load(f)
+        except FileNotFoundError:
+            return False
+        except (OSError, ValueError) as e:
+            logger.warning("Could not read market cache %s: %s", path, e)
+            return False
+
+        for item in items:
+            self.add(_make_market(item['id'], item['base'], item['quote'], item.get('tick_size'),
+                                  item.get('lot_size')))
+        return True
+
+
+def load_registry(market_mapping: Dict[Tuple[str, str], int], path: str = MARKET_CACHE_PATH) -> MarketRegistry:
+    """
+    Registry of the traded markets, enriched with tick/lot sizes from the local
+    cache when one exists. Never touches the network.
+    """
+    registry = MarketRegistry()
+    registry.load(path)
+    for (base, quote), market_id in market_mapping.items():
+        if market_id not in registry:
+            registry.add(_make_market(market_id, base, quote))
+    return registry
+
+
+if __name__ == '__main__':
+    from bitpin_proxy import get_bitpin_proxy
+    from utils import market_registry
+
+    market_registry.update_from_exchange(get_bitpin_proxy().get_markets())
+    market_registry.save()
+    print(f'Saved {len(market_registry)} markets to {MARKET_CACHE_PATH}')
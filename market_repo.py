@@ -1,60 +1,183 @@
-import json
 import logging
+import os
+import threading
+import time
 from collections import defaultdict
 from datetime import datetime
+from typing import Dict, List
 
 import websocket
 
 import metrics
-from bitpin_proxy import bitpin_proxy
-from utils import MARKET_MAPPING
-
-BITPIN_WS_ADDR = 'wss://ws.bitpin.org'
+from feed_recorder import FEED_RECORD_PATH, FeedRecorder
+from feed_supervisor import FEED_ENDPOINTS, FeedManager
+from ingestion import IngestionPipeline, MarketFrame
+from local_metrics import batched
+from log_config import hot_path_logger, log_event
+from orderbook import OrderBook
+from price_table import PriceTable
+from snapshot_loader import fetch_snapshots, load_snapshots, save_snapshots, snapshot_path
+from tracing import ClockOffsetEstimator, mark, parse_event_time
+from utils import MARKET_MAPPING, get_market_scale, market_registry
+
+BITPIN_WS_ADDR = os.environ.get('BITPIN_WS_ADDR', 'wss://ws.bitpin.org')
 
 websocket.setdefaulttimeout(20)
-logging.basicConfig(level=logging.INFO,  format='%(asctime)s %(message)s')
 
 logger = logging.getLogger(__name__)
+hot_logger = hot_path_logger(__name__)
 
 
 class MarketRepository:
-    def __init__(self, u=False):
+    def __init__(self, u=False, price_table: PriceTable = None, proxy=None):
         self.data = {}
+        # Proxy the order lists are fetched through; the process wide one when not given.
+        self.proxy = proxy
         self.market_prices = defaultdict(dict)
+        self.books = {}
+        self.price_table = price_table if price_table is not None else PriceTable(MARKET_MAPPING.values())
         self.callbacks = []
-
-        self.ws = websocket.WebSocketApp(BITPIN_WS_ADDR,
-                                         on_message=self._on_message,
-                                         on_error=self._on_error,
-                                         on_close=self._on_close)
-        self.ws.on_open = self._on_open
+        self.pipeline = IngestionPipeline(self.handle_market_frame)
+        self.recorder = None
+        self.clock_offset = ClockOffsetEstimator()
+        self.clock_offset_metric = batched(metrics.exchange_clock_offset)
+        self.market_metrics = {}
+        for market_id in MARKET_MAPPING.values():
+            market = market_registry.get(market_id)
+            if market is not None:
+                self.market_metrics[market_id] = _MarketMetrics(market.code)
+
+        # market id -> time since which the market is excluded from evaluation
+        self.stale_since: Dict[int, float] = {}
+        # Serializes book and price table writes; the table's sequence lock allows one writer at a time.
+        self._write_lock = threading.Lock()
+        self.feed = FeedManager(self, FEED_ENDPOINTS or [BITPIN_WS_ADDR])
 
         if u:
             self.update_by_order_list()
 
-    def only_data(self):
-        m = MarketRepository()
-        m.data = self.data
-        m.market_prices = self.market_prices
-        m.ws = None
-        return m
-
     def handle_currency_price_info_update_event(self, bitpin_resp: dict):
         self.data = bitpin_resp
         for cb in self.callbacks:
             cb(self)
 
-    def update_by_order_list(self):
-        for _, market_id in MARKET_MAPPING.items():
-            res = bitpin_proxy.get_open_orders(market_id, 'buy')
-            sorted_bids = sorted(res['orders'], key=lambda order: float(order['price']), reverse=True)
-            res = bitpin_proxy.get_open_orders(market_id, 'sell')
-            sorted_asks = sorted(res['orders'], key=lambda order: float(order['price']))
-
-            self.market_prices[market_id] = {
-                'best_bid': sorted_bids[0],
-                'best_ask': sorted_asks[0],
+    def update_by_order_list(self, warm_start=True):
+        """
+        Fills the books from the order list endpoint. With `warm_start`, books
+        are first filled from the persisted snapshot and refreshed in the
+        background. Warm started markets stay stale, out of the price table
+        and of evaluation, until data newer than the snapshot arrives.
+        """
+        if warm_start:
+            snapshots = load_snapshots(snapshot_path(self.proxy))
+            if snapshots:
+                logger.info("Warm starting %d markets from disk", len(snapshots))
+                self.mark_stale(snapshots, since=time.time())
+                self.apply_snapshots(snapshots)
+                threading.Thread(target=self.refresh_snapshots, name='snapshot-refresh', daemon=True).start()
+                return
+
+        self.refresh_snapshots()
+
+    def refresh_snapshots(self):
+        started = datetime.now()
+        snapshots = fetch_snapshots(MARKET_MAPPING.values(), proxy=self.proxy)
+        # Markets that got a websocket update while fetching already have a newer book.
+        self.apply_snapshots(snapshots, not_updated_since=started)
+        try:
+            save_snapshots(snapshots, snapshot_path(self.proxy))
+        except OSError as e:
+            logger.warning("Could not persist snapshots: %s", e)
+
+    def apply_snapshots(self, snapshots, not_updated_since=None):
+        for market_id, snapshot in snapshots.items():
+            book = self.books.get(market_id)
+            if not_updated_since and book is not None and book.update_time and book.update_time > not_updated_since:
+                continue
+            self.apply_book_snapshot(market_id, snapshot['buy'], snapshot['sell'],
+                                     datetime.fromtimestamp(snapshot['time']), as_of=snapshot['time'])
+
+    def resync(self, market_ids):
+        """Refetches the books of `market_ids`, keeping those the websocket updated in the meantime."""
+        started = datetime.now()
+        self.apply_snapshots(fetch_snapshots(market_ids, proxy=self.proxy), not_updated_since=started)
+
+    def mark_stale(self, market_ids, since: float = None):
+        """Takes markets out of evaluation until data received after `since` is applied to them."""
+        since = since if since is not None else time.time()
+        with self._write_lock:
+            for market_id in market_ids:
+                if market_id not in self.stale_since:
+                    self.stale_since[market_id] = since
+                    self.price_table.invalidate(market_id)
+
+    def stale_markets(self) -> Dict[int, float]:
+        with self._write_lock:
+            return dict(self.stale_since)
+
+    def markets_not_updated_since(self, timestamp: float) -> List[int]:
+        """Fresh markets whose book was last updated before `timestamp`, or never."""
+        threshold = datetime.fromtimestamp(timestamp)
+        stale = []
+        for market_id in self.price_table.market_ids:
+            if market_id in self.stale_since:
+                continue
+            book = self.books.get(market_id)
+            if book is None or book.update_time is None or book.update_time < threshold:
+                stale.append(market_id)
+        return stale
+
+    def book_freshness(self) -> Dict[int, dict]:
+        """Per market, seconds since its book was updated, since when it is stale if it is, and its depth."""
+        now = datetime.now()
+        stale = self.stale_markets()
+        freshness = {}
+        for market_id in self.price_table.market_ids:
+            book = self.books.get(market_id)
+            market = market_registry.get(market_id)
+            update_time = book.update_time if book is not None else None
+            freshness[market_id] = {
+                'market': market.code if market is not None else None,
+                'age': (now - update_time).total_seconds() if update_time is not None else None,
+                'stale_for': now.timestamp() - stale[market_id] if market_id in stale else None,
+                'levels': (len(book.bids), len(book.asks)) if book is not None else (0, 0),
             }
+        return freshness
+
+    def get_book(self, market_id: int) -> OrderBook:
+        book = self.books.get(market_id)
+        if book is None:
+            book = self.books[market_id] = OrderBook(market_id, get_market_scale(market_id))
+        return book
+
+    def apply_book_snapshot(self, market_id: int, bids, asks, update_time=None, as_of: float = None):
+        """
+        Applies a snapshot to the market's book and refreshes `market_prices`.
+        Returns which of `best_bid`/`best_ask` changed. `as_of` is when the
+        data was received; a stale market stays out of the price table until
+        it gets data received after it became stale.
+        """
+        with self._write_lock:
+            book = self.get_book(market_id)
+            bid_changed, ask_changed = book.apply_snapshot(bids, asks, update_time)
+            changed = []
+            if bid_changed:
+                self.market_prices[market_id]['best_bid'] = _level_to_dict(book.best_bid(), book.update_time)
+                changed.append('best_bid')
+            if ask_changed:
+                self.market_prices[market_id]['best_ask'] = _level_to_dict(book.best_ask(), book.update_time)
+                changed.append('best_ask')
+
+            stale_since = self.stale_since.get(market_id)
+            if stale_since is not None:
+                if (as_of if as_of is not None else time.time()) < stale_since:
+                    return changed
+                del self.stale_since[market_id]
+                # Both sides were cleared from the table while stale.
+                changed = ['best_bid', 'best_ask']
+            if changed:
+                self.price_table.update(market_id, book.best_bid(), book.best_ask())
+            return changed
 
     def add_callback(self, f):
         self.callbacks.append(f)
@@ -77,86 +200,98 @@ class MarketRepository:
 
         return float(self.data[market_id].get('price'))
 
-    def get_market_ask(self, base, quote):
-        market_id = MARKET_MAPPING.get((base, quote))
-        if market_id not in self.market_prices:
-            market_id = str(market_id)
+    def get_market_depth(self, base, quote, side, n_levels=10):
+        """Cumulative `(price, amount)` for the first `n_levels` of a side ('bid' or 'ask')."""
+        book = self.books.get(market_registry.id_of(base, quote))
+        if book is None:
+            return []
+        return book.side(side).cumulative_depth(n_levels)
 
-        return self.market_prices[market_id].get('best_ask')
+    def get_market_ask(self, base, quote):
+        return self.market_prices[market_registry.id_of(base, quote)].get('best_ask')
 
     def get_market_bid(self, base, quote):
-        market_id = MARKET_MAPPING.get((base, quote))
-        if market_id not in self.market_prices:
-            market_id = str(market_id)
-
-        return self.market_prices[market_id].get('best_bid')
+        return self.market_prices[market_registry.id_of(base, quote)].get('best_bid')
 
     def run(self):
         # print("Running market repo")
-        self.ws.run_forever(
-            ping_interval=10,
-            ping_payload='{ "message" : "PING"}'
-        )
-
-    def _on_message(self, ws, message):
-        # print(f"Received message: {message[:50]}")
-        data = json.loads(message)
-        match data.get("event"):
-            case "market_update":
-                self.handle_market_update_event(data)
-            # case "currency_price_info_update":
-            #     self.handle_currency_price_info_update_event(data)
-
-    def _on_error(self, ws, error: Exception):
-        # print(f"Encountered error: {error}")
-        import traceback
-        traceback.print_exception(error)
-
-    def _on_close(self, ws, close_status_code, close_msg):
-        # print("Connection closed")
-        pass
-
-    def _on_open(self, ws):
-#         print("Connection opened")
-        self.ws.send(f'{{"method":"sub_to_market_list", "ids":[{",".join(str(i) for i in MARKET_MAPPING.values())}]}}')
+        self.pipeline.start()
+        if FEED_RECORD_PATH and self.recorder is None:
+            self.recorder = FeedRecorder(FEED_RECORD_PATH)
+        self.feed.run()
+
+    def close(self):
+        if self.recorder is not None:
+            self.recorder.close()
+
+    def _on_message(self, ws, message, source: str = None):
+        received_at = time.time()
+        if self.recorder is not None:
+            self.recorder.record(message, received_at)
+        # Decoding and processing happen on the pipeline's threads so the socket keeps being read.
+        self.pipeline.submit(message, received_at, source)
+
+    def subscribe(self, ws, market_ids=None):
+        market_ids = market_ids if market_ids is not None else MARKET_MAPPING.values()
+        ws.send(f'{{"method":"sub_to_market_list", "ids":[{",".join(str(i) for i in market_ids)}]}}')
 
     def handle_market_update_event(self, data):
-        event_time = data.get('event_time')
-
-        if event_time:
-            if event_time[-1] == 'Z':
-                event_time = event_time[:-1]
-
-            event_delay = (datetime.now() - datetime.fromisoformat(event_time)).total_seconds()
-            logger.info("Event delay: %f", event_delay)
-            metrics.market_update_delay.labels(market=data['market']['code']).observe(event_delay)
-
-        market_id = int(data['market']['id'])
-        sorted_bids = sorted(data['buy'], key=lambda order: float(order['price']), reverse=True)
-        sorted_asks = sorted(data['sell'], key=lambda order: float(order['price']))
-        updated = False
-        if self.market_prices.get(market_id, {}).get('best_bid') != sorted_bids[0]:
-            # print(f'new best bid: \n{self.market_prices.get(market_id, {}).get("best_bid")} \n{sorted_bids[0]}')
-            best_bid: dict = sorted_bids[0].copy()
-            best_bid['update_time'] = datetime.now()
-            self.market_prices[market_id]['best_bid'] = best_bid
-            metrics.best_price.labels(market=data['market']['code'], type='bid').set(float(best_bid.get('price')))
-            metrics.best_amount.labels(market=data['market']['code'], type='bid').set(
-                float(best_bid.get('remain')))
-            updated = True
-        if self.market_prices.get(market_id, {}).get('best_ask') != sorted_asks[0]:
-            # print(f'new best ask: \n{self.market_prices.get(market_id, {}).get("best_ask")} \n{sorted_asks[0]}')
-            best_ask: dict = sorted_asks[0].copy()
-            best_ask['update_time'] = datetime.now()
-            self.market_prices[market_id]['best_ask'] = best_ask
-            metrics.best_price.labels(market=data['market']['code'], type='ask').set(float(best_ask.get('price')))
-            metrics.best_amount.labels(market=data['market']['code'], type='ask').set(
-                float(best_ask.get('remain')))
-            updated = True
-
-        if updated:
-            self._call_callbacks(market_id)
-
-    def _call_callbacks(self, market_id: int):
+        market = data['market']
+        self.handle_market_frame(MarketFrame(
+            market_id=int(market['id']),
+            market_code=market.get('code'),
+            buy=data['buy'],
+            sell=data['sell'],
+            event_time=data.get('event_time'),
+            received_at=time.time(),
+        ))
+
+    def handle_market_frame(self, frame: MarketFrame):
+        market_id = frame.market_id
+        market_metrics = self.market_metrics.get(market_id)
+        if market_metrics is None:
+            market_metrics = self.market_metrics[market_id] = _MarketMetrics(frame.market_code)
+
+        if frame.event_time:
+            event_time = parse_event_time(frame.event_time)
+            event_delay = frame.received_at - event_time
+            excess_delay = self.clock_offset.observe(event_time, frame.received_at)
+            log_event(hot_logger, 'event_delay', market=frame.market_code, delay=event_delay, excess=excess_delay)
+            market_metrics.update_delay.observe(event_delay)
+            self.clock_offset_metric.set(self.clock_offset.offset)
+
+        changed = self.apply_book_snapshot(market_id, frame.buy, frame.sell, as_of=frame.received_at)
+        if 'best_bid' in changed and self.market_prices[market_id]['best_bid'] is not None:
+            best_bid = self.market_prices[market_id]['best_bid']
+            market_metrics.bid_price.set(best_bid['price'])
+            market_metrics.bid_amount.set(best_bid['remain'])
+        if 'best_ask' in changed and self.market_prices[market_id]['best_ask'] is not None:
+            best_ask = self.market_prices[market_id]['best_ask']
+            market_metrics.ask_price.set(best_ask['price'])
+            market_metrics.ask_amount.set(best_ask['remain'])
+
+        mark(frame.trace, 'book_applied')
+        if changed:
+            self._call_callbacks(market_id, frame.trace)
+
+    def _call_callbacks(self, market_id: int, trace=None):
         for cb in self.callbacks:
-            cb(self, market_id=market_id)
+            cb(self, market_id=market_id, trace=trace)
+
+
+class _MarketMetrics:
+    """Per-market metric children, bound once instead of looked up with `.labels` on every update."""
+
+    def __init__(self, code: str):
+        self.update_delay = batched(metrics.market_update_delay, market=code)
+        self.bid_price = batched(metrics.best_price, market=code, type='bid')
+        self.bid_amount = batched(metrics.best_amount, market=code, type='bid')
+        self.ask_price = batched(metrics.best_price, market=code, type='ask')
+        self.ask_amount = batched(metrics.best_amount, market=code, type='ask')
+
+
+def _level_to_dict(level, update_time):
+    if level is None:
+        return None
+    price, remain = level
+    return {'price': price, 'remain': remain, 'update_time': update_time}
@@ -1,5 +1,19 @@
+from typing import Dict, Sequence, Tuple
+
 from prometheus_client import Counter, Gauge, Histogram, Summary
 
+# Bucket upper bounds of every histogram, for accumulators that aggregate observations before they reach it.
+HISTOGRAM_BUCKETS: Dict[Histogram, Tuple[float, ...]] = {}
+
+
+def histogram(name: str, documentation: str, buckets: Sequence[float] = Histogram.DEFAULT_BUCKETS,
+              **kwargs) -> Histogram:
+    metric = Histogram(name, documentation, buckets=buckets, **kwargs)
+    bounds = tuple(float(bound) for bound in buckets)
+    HISTOGRAM_BUCKETS[metric] = bounds if bounds[-1] == float('inf') else bounds + (float('inf'),)
+    return metric
+
+
 best_price = Gauge("best_price", "Best price for a market", labelnames=['market', 'type'],
                    multiprocess_mode='mostrecent')
 best_amount = Gauge("best_amount", "Best amount for a market", labelnames=['market', 'type'],
@@ -8,10 +22,46 @@ best_amount = Gauge("best_amount", "Best amount for a market", labelnames=['mark
 calc_duration = Summary("calc_duration", "Duration of calculation + order placement")
 order_placement_duration = Summary("order_duration", "Duration of order placement")
 
-market_update_delay = Histogram('market_update_delay_seconds',
+market_update_delay = histogram('market_update_delay_seconds',
                                 'Delay of market update messages arriving in the websocket',
                                 labelnames=['market'])
 proxy_requests = Counter('proxy_requests', "State of requests sent",
                          labelnames=['path', 'method', 'status_code', 'retry'])
 wallet_value = Gauge("wallet_value", "Amount of money in the wallet", labelnames=['currency'],
                      multiprocess_mode='mostrecent')
+
+calc_queue_delay = histogram('calc_queue_delay_seconds', 'Time a market waited in queue before being evaluated',
+                             buckets=(.0005, .001, .0025, .005, .01, .025, .05, .1, .25, .5, 1., 2.5, 5., float('inf')))
+calc_queue_length = Gauge('calc_queue_length', 'Markets waiting to be evaluated', multiprocess_mode='mostrecent')
+calc_queue_dropped = Gauge('calc_queue_dropped', 'Queued markets dropped for exceeding the maximum queue delay',
+                           multiprocess_mode='mostrecent')
+tick_stage_duration = histogram('tick_stage_duration_seconds', 'Time from the previous stage of a tick to this one',
+                                labelnames=['stage'],
+                                buckets=(.00005, .0001, .00025, .0005, .001, .0025, .005, .01, .025, .05, .1, .25,
+                                         .5, 1., 2.5, 5., float('inf')))
+tick_total_duration = histogram('tick_total_duration_seconds', 'Time from receiving a frame to the end of its tick',
+                                buckets=(.0001, .00025, .0005, .001, .0025, .005, .01, .025, .05, .1, .25, .5, 1.,
+                                         2.5, 5., float('inf')))
+exchange_clock_offset = Gauge('exchange_clock_offset_seconds',
+                              'Estimated local minus exchange clock, including the minimum network latency',
+                              multiprocess_mode='mostrecent')
+superseded_market_updates = Counter('superseded_market_updates', 'Market updates replaced by a newer one before processing')
+proxy_throttle_wait = histogram('proxy_throttle_wait_seconds', 'Time a request waited for rate limit budget',
+                                labelnames=['priority'],
+                                buckets=(.001, .005, .01, .05, .1, .25, .5, 1., 2.5, 5., 10., 30., float('inf')))
+proxy_rate_limited = Counter('proxy_rate_limited', 'Responses with status 429', labelnames=['host', 'endpoint'])
+proxy_host_failovers = Counter('proxy_host_failovers', 'Requests that failed to connect to a host',
+                               labelnames=['host'])
+log_records_dropped = Counter('log_records_dropped', 'Log records dropped because the log queue was full')
+feed_disconnects = Counter('feed_disconnects', 'Market websocket connections lost or closed',
+                           labelnames=['endpoint'])
+feed_recovery_duration = histogram('feed_recovery_duration_seconds',
+                                   'Time from losing the market websocket until every market is fresh again',
+                                   buckets=(.1, .25, .5, 1., 2.5, 5., 10., 30., 60., 120., float('inf')))
+feed_stale_markets = Gauge('feed_stale_markets', 'Markets excluded from evaluation until they are resynced',
+                           multiprocess_mode='mostrecent')
+feed_resyncs = Counter('feed_resyncs', 'Stale markets resynced from the order list endpoint')
+duplicate_market_updates = Counter('duplicate_market_updates',
+                                   'Market updates dropped for being older than, or a repeat of, one already received')
+feed_first_arrivals = Counter('feed_first_arrivals', 'Market updates an endpoint delivered first',
+                              labelnames=['endpoint'])
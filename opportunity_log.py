@@ -0,0 +1,111 @@
+import csv
+import logging
+import os
+import queue
+import threading
+import time
+from datetime import datetime
+from typing import List, Optional
+
+OPPORTUNITY_LOG_PATH = os.environ.get('OPPORTUNITY_LOG_PATH', 'log_file.csv')
+MAX_FILE_BYTES = 64 * 1024 * 1024
+POLL_INTERVAL = 1.
+MAX_BATCH = 1024
+
+COLUMNS = [
+    'timestamp',
+    'market_id',
+    'base',
+    'main_market_optimal_position',
+    'main_market_order_amount',
+    'main_market_price',
+    'secondary_market_optimal_position',
+    'secondary_market_order_amount',
+    'secondary_market_price',
+    'secondary_quote_optimal_position',
+    'secondary_quote_order_amount',
+    'secondary_quote_price',
+    'expected_profit',
+]
+
+logger = logging.getLogger(__name__)
+
+_STOP = object()
+
+
+class OpportunityLog:
+    """
+    CSV log of found opportunities. `log` only enqueues; a background thread
+    drains the queue in batches, flushes once per batch and rotates the file
+    once it grows past `max_bytes`.
+    """
+
+    def __init__(self, path: str = OPPORTUNITY_LOG_PATH, max_bytes: int = MAX_FILE_BYTES):
+        self.path = path
+        self.max_bytes = max_bytes
+        self._queue = queue.SimpleQueue()
+        self._file = None
+        self._writer = None
+        self._thread = threading.Thread(target=self._run, name='opportunity-log', daemon=True)
+        self._thread.start()
+
+    def log(self, row: dict, market_id: Optional[int] = None):
+        self._queue.put((time.time(), market_id, row))
+
+    def close(self, timeout: Optional[float] = None):
+        self._queue.put(_STOP)
+        self._thread.join(timeout)
+
+    def _has_header(self) -> bool:
+        with open(self.path, newline='') as f:
+            return next(csv.reader(f), None) == COLUMNS
+
+    def _open(self):
+        if os.path.exists(self.path) and os.path.getsize(self.path) > 0 and not self._has_header():
+            # Written in an older layout; keep it aside instead of mixing layouts.
+            os.replace(self.path, self._rotated_path())
+        is_new = not os.path.exists(self.path) or os.path.getsize(self.path) == 0
+        self._file = open(self.path, mode='a', newline='')
+        self._writer = csv.writer(self._file)
+        if is_new:
+            self._writer.writerow(COLUMNS)
+
+    def _rotated_path(self) -> str:
+        return f'{self.path}.{datetime.now():%Y%m%d%H%M%S%f}'
+
+    def _rotate(self):
+        self._file.close()
+        os.replace(self.path, self._rotated_path())
+        self._open()
+
+    def _write(self, batch: List[tuple]):
+        for timestamp, market_id, row in batch:
+            self._writer.writerow([datetime.fromtimestamp(timestamp).isoformat(), market_id] +
+                                  [row.get(column) for column in COLUMNS[2:]])
+        self._file.flush()
+        if self._file.tell() >= self.max_bytes:
+            self._rotate()
+
+    def _run(self):
+        self._open()
+        stopping = False
+        while not stopping:
+            batch = []
+            try:
+                item = self._queue.get(timeout=POLL_INTERVAL)
+                while item is not _STOP:
+                    batch.append(item)
+                    if len(batch) >= MAX_BATCH:
+                        break
+                    item = self._queue.get_nowait()
+                stopping = item is _STOP
+            except queue.Empty:
+                pass
+
+            if batch:
+                try:
+                    self._write(batch)
+                except OSError as e:
+                    logger.error("Writing %d opportunities failed: %s", len(batch), e)
+
+        self._file.close()
@@ -0,0 +1,122 @@
+from bisect import bisect_left, insort
+from datetime import datetime
+from typing import Dict, Iterable, List, Optional, Tuple
+
+from fixed_point import DEFAULT_SCALE, MarketScale
+
+Level = Tuple[float, float]
+# A level in the market's fixed-point units, `(price units, amount units)`.
+UnitLevel = Tuple[int, int]
+
+
+class OrderBookSide:
+    """
+    One side of a book. Levels are held as integers in the units of `scale`.
+    Prices are kept in `keys` sorted ascending with bid prices negated, so
+    the best level of either side is always `keys[0]`.
+    """
+
+    def __init__(self, is_bid: bool, scale: MarketScale = DEFAULT_SCALE):
+        self.is_bid = is_bid
+        self.scale = scale
+        self.levels: Dict[int, int] = {}
+        self.keys: List[int] = []
+
+    def _key(self, price: int) -> int:
+        return -price if self.is_bid else price
+
+    def set_level(self, price: int, remain: int):
+        if remain <= 0:
+            self.remove_level(price)
+            return
+        if price not in self.levels:
+            insort(self.keys, self._key(price))
+        self.levels[price] = remain
+
+    def remove_level(self, price: int):
+        if self.levels.pop(price, None) is not None:
+            key = self._key(price)
+            del self.keys[bisect_left(self.keys, key)]
+
+    def apply_snapshot(self, orders: Iterable[dict]):
+        """Turns the side into `orders`, touching only the levels that changed."""
+        parse_price, parse_amount = self.scale.parse_price, self.scale.parse_amount
+        new_levels: Dict[int, int] = {}
+        for order in orders:
+            price = parse_price(order['price'])
+            new_levels[price] = new_levels.get(price, 0) + parse_amount(order['remain'])
+
+        for price in [p for p in self.levels if p not in new_levels]:
+            self.remove_level(price)
+        for price, remain in new_levels.items():
+            if self.levels.get(price) != remain:
+                self.set_level(price, remain)
+
+    def best_units(self) -> Optional[UnitLevel]:
+        if not self.keys:
+            return None
+        price = self._key(self.keys[0])
+        return price, self.levels[price]
+
+    def best(self) -> Optional[Level]:
+        level = self.best_units()
+        return self._to_float(level) if level is not None else None
+
+    def _to_float(self, level: UnitLevel) -> Level:
+        return self.scale.price(level[0]), self.scale.amount(level[1])
+
+    def depth(self, n: int) -> List[Level]:
+        return [self._to_float((self._key(k), self.levels[self._key(k)])) for k in self.keys[:n]]
+
+    def cumulative_depth(self, n: int) -> List[Level]:
+        """`(price, total amount available up to and including price)` for the first `n` levels."""
+        total = 0.
+        result = []
+        for price, remain in self.depth(n):
+            total += remain
+            result.append((price, total))
+        return result
+
+    def amount_up_to(self, price_limit: float) -> float:
+        """Total amount that can be taken without crossing `price_limit`."""
+        limit_key = self._key(self.scale.price_units(price_limit))
+        total = 0
+        for key in self.keys:
+            if key > limit_key:
+                break
+            total += self.levels[self._key(key)]
+        return self.scale.amount(total)
+
+    def __len__(self):
+        return len(self.keys)
+
+
+class OrderBook:
+    def __init__(self, market_id: int, scale: MarketScale = DEFAULT_SCALE):
+        self.market_id = market_id
+        self.scale = scale
+        self.bids = OrderBookSide(is_bid=True, scale=scale)
+        self.asks = OrderBookSide(is_bid=False, scale=scale)
+        self.update_time: Optional[datetime] = None
+
+    def apply_snapshot(self, buy: Iterable[dict], sell: Iterable[dict],
+                       update_time: Optional[datetime] = None) -> Tuple[bool, bool]:
+        """
+        Applies a full `buy`/`sell` snapshot as a diff against the current book.
+        Returns whether the best bid and the best ask changed, compared exactly
+        in fixed-point units.
+        """
+        old_bid, old_ask = self.bids.best_units(), self.asks.best_units()
+        self.bids.apply_snapshot(buy)
+        self.asks.apply_snapshot(sell)
+        self.update_time = update_time or datetime.now()
+        return self.bids.best_units() != old_bid, self.asks.best_units() != old_ask
+
+    def best_bid(self) -> Optional[Level]:
+        return self.bids.best()
+
+    def best_ask(self) -> Optional[Level]:
+        return self.asks.best()
+
+    def side(self, side: str) -> OrderBookSide:
+        return self.bids if side in ('bid', 'buy') else self.asks
@@ -0,0 +1,141 @@
+import os
+import sys
+import threading
+import time
+from multiprocessing import resource_tracker
+from multiprocessing.shared_memory import SharedMemory
+from typing import Iterable, Optional, Tuple
+
+import numpy as np
+
+BID_PRICE, BID_SIZE, ASK_PRICE, ASK_SIZE, SEQ, TIMESTAMP = range(6)
+N_FIELDS = 6
+
+PRICE_TABLE_NAME = os.environ.get('PRICE_TABLE_NAME', 'trader_price_table')
+
+_register_lock = threading.Lock()
+
+
+def _attach_untracked(name: str) -> SharedMemory:
+    """
+    Opens an existing segment without registering it with the resource
+    tracker, which would unlink it, or warn about a leak, when this process
+    exits. Only the process that created the table unlinks it.
+    """
+    if sys.version_info >= (3, 13):
+        return SharedMemory(name=name, track=False)
+    # Unregistering afterwards is not enough: forked processes share one tracker,
+    # so that would also drop the creator's registration.
+    with _register_lock:
+        register = resource_tracker.register
+        resource_tracker.register = lambda *args, **kwargs: None
+        try:
+            return SharedMemory(name=name)
+        finally:
+            resource_tracker.register = register
+
+
+class PriceTable:
+    """
+    Dense top-of-book table, one row per market. Missing levels are NaN so
+    that every comparison against them is False in vectorized code.
+
+    The table can live in shared memory so that one process writes it and
+    others read it without copying. Rows are written under a per-row
+    sequence lock: `SEQ` is odd while a row is being written.
+    """
+
+    def __init__(self, market_ids: Iterable[int], buffer=None):
+        self.market_ids = list(market_ids)
+        self.index = {market_id: i for i, market_id in enumerate(self.market_ids)}
+        shape = (len(self.market_ids), N_FIELDS)
+        if buffer is None:
+            self.values = np.full(shape, np.nan)
+            self.values[:, SEQ] = 0
+        else:
+            self.values = np.ndarray(shape, dtype=np.float64, buffer=buffer)
+        self._shm: Optional[SharedMemory] = None
+
+    @staticmethod
+    def _size(market_ids) -> int:
+        return len(market_ids) * N_FIELDS * np.dtype(np.float64).itemsize
+
+    @classmethod
+    def create_shared(cls, market_ids: Iterable[int], name: str = PRICE_TABLE_NAME) -> 'PriceTable':
+        market_ids = list(market_ids)
+        try:
+            # Left behind by a process that did not shut down cleanly.
+            SharedMemory(name=name).unlink()
+        except FileNotFoundError:
+            pass
+        shm = SharedMemory(name=name, create=True, size=cls._size(market_ids))
+        table = cls(market_ids, buffer=shm.buf)
+        table.values[:] = np.nan
+        table.values[:, SEQ] = 0
+        table._shm = shm
+        return table
+
+    @classmethod
+    def attach(cls, market_ids: Iterable[int], name: str = PRICE_TABLE_NAME) -> 'PriceTable':
+        market_ids = list(market_ids)
+        shm = _attach_untracked(name)
+        if shm.size < cls._size(market_ids):
+            shm.close()
+            raise ValueError(f"Shared price table {name} does not fit {len(market_ids)} markets")
+        table = cls(market_ids, buffer=shm.buf)
+        table._shm = shm
+        return table
+
+    def close(self, unlink=False):
+        if self._shm is None:
+            return
+        self.values = None
+        self._shm.close()
+        if unlink:
+            self._shm.unlink()
+        self._shm = None
+
+    def row(self, market_id: int) -> int:
+        return self.index[market_id]
+
+    def update(self, market_id: int, bid: Optional[Tuple[float, float]], ask: Optional[Tuple[float, float]]) -> int:
+        """Writes a row and returns its new sequence number (0 for unknown markets)."""
+        i = self.index.get(market_id)
+        if i is None:
+            return 0
+        row = self.values[i]
+        seq = row[SEQ]
+        row[SEQ] = seq + 1
+        row[BID_PRICE], row[BID_SIZE] = bid if bid is not None else (np.nan, np.nan)
+        row[ASK_PRICE], row[ASK_SIZE] = ask if ask is not None else (np.nan, np.nan)
+        row[TIMESTAMP] = time.time()
+        row[SEQ] = seq + 2
+        return int(seq + 2)
+
+    def invalidate(self, market_id: int) -> int:
+        """Clears a row's prices, so every triangle using the market is skipped until it is updated again."""
+        return self.update(market_id, None, None)
+
+    def seq(self, market_id: int) -> int:
+        return int(self.values[self.index[market_id], SEQ])
+
+    def snapshot(self, max_retries: int = 100) -> np.ndarray:
+        """A consistent copy of the table, re-reading rows that were being written."""
+        before = self.values[:, SEQ].copy()
+        snapshot = self.values.copy()
+        for _ in range(max_retries):
+            torn = (before % 2 == 1) | (before != self.values[:, SEQ])
+            if not torn.any():
+                break
+            before[torn] = self.values[torn, SEQ]
+            snapshot[torn] = self.values[torn]
+        snapshot[:, SEQ] = before
+        return snapshot
+
+    def best_bid(self, market_id: int) -> Optional[Tuple[float, float]]:
+        price, size = self.values[self.index[market_id], BID_PRICE:BID_SIZE + 1]
+        return None if np.isnan(price) else (float(price), float(size))
+
+    def best_ask(self, market_id: int) -> Optional[Tuple[float, float]]:
+        price, size = self.values[self.index[market_id], ASK_PRICE:ASK_SIZE + 1]
+        return None if np.isnan(price) else (float(price), float(size))
@@ -0,0 +1,220 @@
+import logging
+import os
+import re
+import threading
+import time
+from enum import IntEnum
+from typing import Dict, List, Mapping, Optional, Tuple
+
+import metrics
+
+# Bitpin does not publish per-endpoint limits, so the starting budgets below are
+# conservative guesses: well under what the public market data endpoints have
+# been seen to accept, and lowest for the authenticated and login endpoints.
+# Each is replaced by the exchange's `X-RateLimit-*` headers as soon as a
+# response carries them. `RATE_LIMITS` overrides them as `endpoint=rate/burst`
+# pairs, e.g. `/v2/mth/actives/{id}/=20/40,default=5/10`, rates per second.
+DEFAULT_LIMITS = {
+    # Order lists: a cold start or resync fetches two per market in parallel.
+    '/v2/mth/actives/{id}/': (20., 40.),
+    '/v1/mkt/markets/': (2., 5.),
+    '/v1/odr/orders/': (10., 20.),
+    '/v1/wlt/wallets/': (5., 10.),
+    '/v1/usr/api/login/': (.5, 3.),
+    '/v1/usr/refresh_token/': (.5, 3.),
+    'default': (5., 10.),
+}
+# Window the exchange's `X-RateLimit-Limit` applies to, used to turn it into a refill rate.
+RATE_LIMIT_WINDOW = float(os.environ.get('RATE_LIMIT_WINDOW', 60))
+HOST_COOLDOWN = 5.
+DEFAULT_RETRY_AFTER = 1.
+
+logger = logging.getLogger(__name__)
+
+
+class Priority(IntEnum):
+    ORDER = 0
+    ORDER_STATUS = 1
+    WALLET = 2
+    SNAPSHOT = 3
+
+
+# Share of a bucket each priority has to leave for the ones above it. Order
+# legs are never held back by the client; what they use is paid back by the rest.
+RESERVED_SHARE = {
+    Priority.ORDER: 0.,
+    Priority.ORDER_STATUS: .2,
+    Priority.WALLET: .4,
+    Priority.SNAPSHOT: .6,
+}
+
+
+class RateLimitExceeded(Exception):
+    pass
+
+
+def parse_limits(spec: str) -> Dict[str, Tuple[float, float]]:
+    limits = {}
+    for item in filter(None, (part.strip() for part in spec.split(','))):
+        endpoint, value = item.rsplit('=', 1)
+        rate, _, burst = value.partition('/')
+        limits[endpoint] = (float(rate), float(burst) if burst else float(rate))
+    return limits
+
+
+LIMITS = {**DEFAULT_LIMITS, **parse_limits(os.environ.get('RATE_LIMITS', ''))}
+
+
+def endpoint_of(path: str) -> str:
+    """Rate limit key of `path`: the query string is dropped and ids are collapsed."""
+    return re.sub(r'/\d+(?=/|$)', '/{id}', path.split('?', 1)[0])
+
+
+def _header(headers: Mapping[str, str], name: str) -> Optional[float]:
+    value = headers.get(f'X-RateLimit-{name}') or headers.get(f'RateLimit-{name}')
+    try:
+        return float(value) if value is not None else None
+    except ValueError:
+        return None
+
+
+def _retry_after(headers: Mapping[str, str]) -> float:
+    try:
+        return float(headers.get('Retry-After'))
+    except (TypeError, ValueError):
+        return DEFAULT_RETRY_AFTER
+
+
+class TokenBucket:
+    def __init__(self, rate: float, capacity: float):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+        self.blocked_until = 0.
+        # Most urgent priority that used the bucket; lower ones only leave room for it.
+        self.top_priority = Priority.SNAPSHOT
+
+    def refill(self, now: float):
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def wait_time(self, priority: Priority, now: float) -> float:
+        """Seconds until a request of `priority` may be sent."""
+        self.refill(now)
+        if now < self.blocked_until:
+            return self.blocked_until - now
+        if priority == Priority.ORDER:
+            return 0.
+        reserved = RESERVED_SHARE[priority] - RESERVED_SHARE[min(priority, self.top_priority)]
+        missing = self.capacity * reserved + 1 - self.tokens
+        return max(0., missing / self.rate)
+
+    def take(self, priority: Priority):
+        # Order legs may overdraw the bucket; lower priorities wait until it is paid back.
+        self.tokens -= 1
+        self.top_priority = min(self.top_priority, priority)
+
+    def learn(self, headers: Mapping[str, str], now: float):
+        limit = _header(headers, 'Limit')
+        if limit:
+            self.capacity = limit
+            self.rate = limit / RATE_LIMIT_WINDOW
+        remaining = _header(headers, 'Remaining')
+        if remaining is not None:
+            self.refill(now)
+            self.tokens = min(self.tokens, remaining)
+            reset = _header(headers, 'Reset')
+            if remaining <= 0 and reset is not None:
+                # Either seconds until the reset or its unix timestamp.
+                self.blocked_until = now + (reset - time.time() if reset > 1e9 else reset)
+
+
+class RequestScheduler:
+    """
+    Client-side rate limiting of the REST calls, with one token bucket per
+    host and endpoint. Budgets start at the endpoint's `LIMITS` and are
+    corrected from the rate limit headers of the responses.
+
+    Requests wait in `acquire` until their bucket has tokens above the share
+    reserved for the higher priorities that use the same endpoint, and behind any higher priority request
+    waiting for the same endpoint. `Priority.ORDER` never waits. Hosts are
+    tried in order; a host that rate limits an endpoint or fails to connect
+    is skipped until its back off has passed.
+    """
+
+    def __init__(self, hosts: List[str]):
+        self.hosts = list(hosts)
+        self.buckets: Dict[Tuple[str, str], TokenBucket] = {}
+        self.host_cooldown = {host: 0. for host in self.hosts}
+        self._waiting: Dict[Tuple[str, Priority], int] = {}
+        self._cond = threading.Condition()
+
+    def _bucket(self, host: str, endpoint: str) -> TokenBucket:
+        bucket = self.buckets.get((host, endpoint))
+        if bucket is None:
+            bucket = self.buckets[(host, endpoint)] = TokenBucket(*LIMITS.get(endpoint, LIMITS['default']))
+        return bucket
+
+    def _best_host(self, endpoint: str, priority: Priority, now: float) -> Tuple[str, float]:
+        best_host, best_wait = None, None
+        for host in self.hosts:
+            wait = max(self._bucket(host, endpoint).wait_time(priority, now), self.host_cooldown[host] - now)
+            if best_wait is None or wait < best_wait:
+                best_host, best_wait = host, wait
+            if wait <= 0:
+                break
+        return best_host, best_wait
+
+    def _higher_priority_waiting(self, endpoint: str, priority: Priority) -> bool:
+        return any(self._waiting.get((endpoint, p)) for p in Priority if p < priority)
+
+    def acquire(self, path: str, priority: Priority, timeout: Optional[float] = None) -> str:
+        """Blocks until a request to `path` may be sent and returns the host to send it to."""
+        endpoint = endpoint_of(path)
+        started = time.monotonic()
+        deadline = started + timeout if timeout is not None else None
+        key = (endpoint, priority)
+
+        with self._cond:
+            self._waiting[key] = self._waiting.get(key, 0) + 1
+            try:
+                while True:
+                    now = time.monotonic()
+                    host, wait = self._best_host(endpoint, priority, now)
+                    if priority == Priority.ORDER or (wait <= 0 and
+                                                      not self._higher_priority_waiting(endpoint, priority)):
+                        self._bucket(host, endpoint).take(priority)
+                        metrics.proxy_throttle_wait.labels(priority=priority.name).observe(now - started)
+                        return host
+                    if deadline is not None and now >= deadline:
+                        raise RateLimitExceeded(f'No budget for {endpoint} within {timeout}s')
+                    wait = wait if wait > 0 else None
+                    if deadline is not None:
+                        wait = min(wait or deadline - now, deadline - now)
+                    self._cond.wait(wait)
+            finally:
+                self._waiting[key] -= 1
+                self._cond.notify_all()
+
+    def record(self, host: str, path: str, status: int, headers: Mapping[str, str]):
+        """Updates the budget of the endpoint from a response."""
+        endpoint = endpoint_of(path)
+        now = time.monotonic()
+        with self._cond:
+            bucket = self._bucket(host, endpoint)
+            bucket.learn(headers, now)
+            if status == 429:
+                retry_after = _retry_after(headers)
+                logger.warning("Rate limited on %s%s, backing off for %.1fs", host, endpoint, retry_after)
+                metrics.proxy_rate_limited.labels(host=host, endpoint=endpoint).inc()
+                bucket.tokens = min(bucket.tokens, 0.)
+                bucket.blocked_until = max(bucket.blocked_until, now + retry_after)
+            self._cond.notify_all()
+
+    def host_failed(self, host: str, cooldown: float = HOST_COOLDOWN):
+        logger.warning("Request to %s failed, failing over for %.1fs", host, cooldown)
+        metrics.proxy_host_failovers.labels(host=host).inc()
+        with self._cond:
+            self.host_cooldown[host] = time.monotonic() + cooldown
+            self._cond.notify_all()
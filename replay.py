@@ -0,0 +1,145 @@
+"""
+Replays a feed recorded with `FEED_RECORD_PATH` through MarketRepository and
+TriangleCalculator with a stubbed BitpinProxy, and reports per-frame latency.
+
+    python replay.py feed.bin.gz [--speed 1] [--wallet IRT=1e9 --wallet USDT=1e4]
+
+`feed.bin.gz` is either one recorded segment or the `FEED_RECORD_PATH` the
+segments of several runs were written under.
+"""
+import argparse
+import json
+import logging
+import time
+from typing import Dict, List, Optional
+
+import log_config
+from feed_recorder import read_frames
+from ingestion import decode_market_frame
+from latency_stats import summarize
+
+logger = logging.getLogger(__name__)
+
+
+class StubBitpinProxy:
+    """Offline stand-in for `BitpinProxy`/`AsyncBitpinProxy` that accepts every order."""
+
+    def __init__(self, wallet: Dict[str, float] = None):
+        self.wallet = dict(wallet or {})
+        self.placed_orders: List[dict] = []
+        self.access_token = 'stub'
+
+    def _ensure_access(self):
+        pass
+
+    def refresh(self):
+        pass
+
+    def get_my_open_orders(self):
+        return []
+
+    def get_wallet_info(self):
+        return dict(self.wallet)
+
+    def place_order(self, **order):
+        self.placed_orders.append(order)
+        return {'identifier': order.get('identifier')}
+
+    def place_orders_sync(self, orders: List[dict], trace=None) -> list:
+        return [self.place_order(**order) for order in orders]
+
+
+def install_stub_proxy(wallet: Dict[str, float] = None) -> StubBitpinProxy:
+    """Makes the process wide proxies a `StubBitpinProxy`, and the trader agent one using it."""
+    from async_bitpin_proxy import set_async_bitpin_proxy
+    from bitpin_proxy import set_bitpin_proxy
+    from trader import TraderAgent, set_trader_agent
+
+    stub = StubBitpinProxy(wallet)
+    set_bitpin_proxy(stub)
+    set_async_bitpin_proxy(stub)
+
+    agent = TraderAgent(stub, stub)
+    agent.update_orders_and_wallet()
+    set_trader_agent(agent)
+    return stub
+
+
+class ReplayDriver:
+    """
+    Feeds recorded frames into a MarketRepository and evaluates the triangles
+    of every updated market. With `speed` set, the original inter-arrival
+    times are reproduced (divided by `speed`); otherwise frames are replayed
+    as fast as possible.
+    """
+
+    def __init__(self, path: str, speed: Optional[float] = None, wallet: Dict[str, float] = None):
+        self.path = path
+        self.speed = speed
+        self.proxy = install_stub_proxy(wallet)
+
+        from calculator import TriangleCalculator
+        from market_repo import MarketRepository
+        from opportunity_log import OpportunityLog
+
+        self.market_repo = MarketRepository()
+        self.calculator = TriangleCalculator(OpportunityLog('replay_opportunities.csv'))
+        self.market_repo.add_callback(self._market_updated)
+
+        self.frame_latencies: List[float] = []
+        self.calc_latencies: List[float] = []
+        self.frames = 0
+
+    def _market_updated(self, market_repo, market_id, trace=None):
+        start = time.perf_counter()
+        self.calculator.calculate(market_repo.price_table, market_id=market_id)
+        self.calc_latencies.append(time.perf_counter() - start)
+
+    def run(self) -> dict:
+        first_recorded = None
+        started = time.perf_counter()
+        for received_at, raw in read_frames(self.path):
+            if self.speed:
+                if first_recorded is None:
+                    first_recorded = received_at
+                delay = (received_at - first_recorded) / self.speed - (time.perf_counter() - started)
+                if delay > 0:
+                    time.sleep(delay)
+
+            start = time.perf_counter()
+            frame = decode_market_frame(raw, received_at)
+            if frame is not None:
+                self.market_repo.handle_market_frame(frame)
+                self.frame_latencies.append(time.perf_counter() - start)
+            self.frames += 1
+
+        elapsed = time.perf_counter() - started
+        return {
+            'recording': self.path,
+            'frames': self.frames,
+            'elapsed': elapsed,
+            'frame': summarize(self.frame_latencies, elapsed),
+            'calculate': summarize(self.calc_latencies),
+            'placed_orders': len(self.proxy.placed_orders),
+        }
+
+
+def _parse_wallet(items) -> Dict[str, float]:
+    wallet = {}
+    for item in items or []:
+        token, amount = item.split('=')
+        wallet[token] = float(amount)
+    return wallet
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('path')
+    parser.add_argument('--speed', type=float, default=None,
+                        help='Replay at this multiple of real time. As fast as possible when omitted.')
+    parser.add_argument('--wallet', action='append', help='TOKEN=AMOUNT balance of the stubbed wallet.')
+    args = parser.parse_args()
+
+    log_config.configure(level=logging.WARNING)
+    report = ReplayDriver(args.path, speed=args.speed, wallet=_parse_wallet(args.wallet)).run()
+    print(json.dumps(report, indent=2))
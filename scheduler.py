@@ -0,0 +1,105 @@
+import heapq
+import itertools
+import time
+from collections import OrderedDict
+from enum import Enum
+from typing import Dict, List, Optional, Tuple
+
+
+class Policy(str, Enum):
+    LIFO = 'lifo'  # Most recently updated market first
+    FIFO = 'fifo'  # Oldest pending market first; re-marking keeps its place
+    EDGE = 'edge'  # Highest expected edge first
+    STALENESS = 'staleness'  # Market that was evaluated longest ago first
+
+
+class DirtyMarketScheduler:
+    """
+    Set of markets waiting to be evaluated. Marking an already pending market
+    coalesces into the existing entry in O(1), so each market is evaluated at
+    most once per pop no matter how many updates arrived for it.
+    """
+
+    def __init__(self, policy: Policy = Policy.LIFO, max_delay: Optional[float] = None):
+        self.policy = Policy(policy)
+        self.max_delay = max_delay
+        self.dropped = 0
+        # Dropped since the last `take_dropped`, for callers keeping per-market state.
+        self._dropped_ids: List[int] = []
+
+        self._pending: 'OrderedDict[int, float]' = OrderedDict()  # market id -> first queued time
+        self._last_marked: Dict[int, float] = {}
+        self._heap = []
+        self._counter = itertools.count()
+        self.edges: Dict[int, float] = {}
+        self.last_evaluated: Dict[int, float] = {}
+
+    def mark(self, market_id: int):
+        now = time.monotonic()
+        self._last_marked[market_id] = now
+        if market_id in self._pending:
+            if self.policy == Policy.LIFO:
+                self._pending.move_to_end(market_id)
+            return
+        self._pending[market_id] = now
+
+        if self.policy in (Policy.EDGE, Policy.STALENESS):
+            heapq.heappush(self._heap, (self._priority(market_id), next(self._counter), market_id))
+
+    def _priority(self, market_id: int) -> float:
+        if self.policy == Policy.EDGE:
+            return -self.edges.get(market_id, 0.)
+        return self.last_evaluated.get(market_id, 0.)
+
+    def _pop_next(self) -> Optional[Tuple[int, float]]:
+        if not self._pending:
+            return None
+        if self.policy == Policy.LIFO:
+            return self._pending.popitem(last=True)
+        if self.policy == Policy.FIFO:
+            return self._pending.popitem(last=False)
+
+        # Pending markets are never re-pushed, so the heap holds exactly one entry per pending market.
+        _, _, market_id = heapq.heappop(self._heap)
+        return market_id, self._pending.pop(market_id)
+
+    def pop(self) -> Optional[Tuple[int, float]]:
+        """
+        Next market to evaluate and how long it waited, skipping markets whose
+        latest update is older than `max_delay`. Markets that keep updating are
+        never skipped, however long they have been queued.
+        """
+        while True:
+            entry = self._pop_next()
+            if entry is None:
+                return None
+            market_id, queued_at = entry
+            now = time.monotonic()
+            last_marked = self._last_marked.pop(market_id, queued_at)
+            if self.max_delay is not None and now - last_marked > self.max_delay:
+                self.dropped += 1
+                self._dropped_ids.append(market_id)
+                continue
+            return market_id, now - queued_at
+
+    def take_dropped(self) -> List[int]:
+        """Markets dropped since the last call."""
+        dropped, self._dropped_ids = self._dropped_ids, []
+        return dropped
+
+    def evaluated(self, market_id: int, edge: Optional[float] = None):
+        """Records an evaluation so EDGE and STALENESS policies can rank the market next time."""
+        self.last_evaluated[market_id] = time.monotonic()
+        if edge is not None:
+            self.edges[market_id] = edge
+
+    def pending(self) -> Tuple[Tuple[int, float], ...]:
+        """
+        `(market id, first queued time)` of each pending market. Like the rest
+        of the scheduler it is not thread safe; other threads read a copy
+        taken on the owning thread.
+        """
+        return tuple(self._pending.items())
+
+    def __len__(self):
+        return len(self._pending)
@@ -0,0 +1,456 @@
+"""
+Local stand-in for the Bitpin REST API and market websocket, to load test
+the whole pipeline and measure its latency without touching the exchange.
+
+    python simulator.py [--port 8900] [--rate 200] [--latency 0.005 --jitter 0.002]
+                        [--error-rate 0.01] [--rate-limit 600] [--disconnect-every 30]
+
+    BITPIN_URL=http://localhost:8900 BITPIN_FALLBACK_URL= BITPIN_WS_ADDR=ws://localhost:8900/ws \\
+        BITPIN_API_KEY=sim BITPIN_SECRET_KEY=sim python main.py
+
+It serves the endpoints `BitpinProxy` uses and broadcasts `market_update`
+events of the traded markets at `--rate` events a second to every
+connection subscribed to them, so redundant connections see the same
+events. Market orders fill at once against the simulated book and move the
+wallet; limit orders stay open. Faults can be changed while it runs:
+
+    curl -X POST localhost:8900/sim/faults -d '{"latency": 0.05, "error_rate": 0.2}'
+    curl -X POST localhost:8900/sim/disconnect     # drop every websocket connection
+    curl localhost:8900/sim/stats
+"""
+import argparse
+import asyncio
+import base64
+import json
+import logging
+import math
+import random
+import time
+import uuid
+from dataclasses import asdict, dataclass, fields
+from datetime import datetime, timezone
+from typing import Dict, List, Optional, Set, Tuple
+
+from aiohttp import WSMsgType, web
+
+import log_config
+from rate_limiter import RATE_LIMIT_WINDOW, endpoint_of
+
+USDT_IRT_PRICE = 60000.
+DEFAULT_PORT = 8900
+TOKEN_LIFETIME = 900.
+REFRESH_TOKEN_LIFETIME = 86400.
+
+logger = logging.getLogger(__name__)
+
+
+@dataclass
+class Faults:
+    # Seconds added to every REST response, plus up to `jitter` more.
+    latency: float = 0.
+    jitter: float = 0.
+    # Share of REST requests answered with a 429.
+    error_rate: float = 0.
+    # Requests per endpoint and `RATE_LIMIT_WINDOW`; 0 disables rate limiting.
+    rate_limit: int = 0
+    # Mean seconds between dropping a random websocket connection; 0 never drops.
+    disconnect_every: float = 0.
+
+    def update(self, values: dict):
+        for field in fields(self):
+            if field.name in values:
+                setattr(self, field.name, type(field.default)(values[field.name]))
+
+
+def _make_token(kind: str, lifetime: float) -> Tuple[str, float]:
+    """An unsigned JWT, enough for `auth.jwt_expiry`."""
+    expires_at = time.time() + lifetime
+    parts = [{'alg': 'none', 'typ': 'JWT'}, {'token_type': kind, 'exp': int(expires_at), 'jti': uuid.uuid4().hex}]
+    encoded = [base64.urlsafe_b64encode(json.dumps(part).encode()).rstrip(b'=').decode() for part in parts]
+    return '.'.join(encoded + ['']), expires_at
+
+
+def _step_of(price: float) -> float:
+    return 10. ** math.floor(math.log10(price * 1e-4))
+
+
+class SimulatedMarket:
+    def __init__(self, market_id: int, base: str, quote: str, tick_size: float = None, lot_size: float = None):
+        self.id = market_id
+        self.base = base
+        self.quote = quote
+        self.tick_size = tick_size
+        self.lot_size = lot_size
+        self.mid = None
+        self.buy: List[dict] = []
+        self.sell: List[dict] = []
+
+    @property
+    def code(self) -> str:
+        return f'{self.base}_{self.quote}'
+
+    def set_mid(self, mid: float, depth: int, spread: float, rng: random.Random):
+        """Rebuilds both sides of the book around `mid`."""
+        tick = self.tick_size or _step_of(mid)
+        lot = self.lot_size or 1e-6
+        step = max(tick, round(mid * spread / 4 / tick) * tick)
+        best_bid = math.floor(mid * (1 - spread / 2) / tick) * tick
+        best_ask = math.ceil(mid * (1 + spread / 2) / tick) * tick
+        self.mid = mid
+
+        def level(price):
+            amount = round(rng.lognormvariate(0, 1) / lot) * lot or lot
+            return {'price': f'{price:.10g}', 'remain': f'{amount:.10g}'}
+
+        self.buy = [level(best_bid - i * step) for i in range(depth)]
+        self.sell = [level(best_ask + i * step) for i in range(depth)]
+
+    def to_exchange(self) -> dict:
+        return {
+            'id': self.id,
+            'code': self.code,
+            'currency1': {'code': self.base},
+            'currency2': {'code': self.quote},
+            'price_tick': str(self.tick_size or _step_of(self.mid)),
+            'amount_tick': str(self.lot_size or 1e-6),
+        }
+
+
+class BitpinSimulator:
+    """
+    Simulated exchange state and the aiohttp application serving it.
+
+    Every token has a fair USDT price following a random walk, and each
+    market's mid price is the fair cross rate off by a random `dislocation`,
+    so triangles are briefly profitable now and then.
+    """
+
+    def __init__(self, markets: List[SimulatedMarket], rate: float = 100., depth: int = 20,
+                 spread: float = 0.002, volatility: float = 0.0005, dislocation: float = 0.0005,
+                 wallet: Dict[str, float] = None, faults: Faults = None, token_lifetime: float = TOKEN_LIFETIME,
+                 seed: Optional[int] = None):
+        self.markets = {market.id: market for market in markets}
+        self.rate = rate
+        self.depth = depth
+        self.spread = spread
+        self.volatility = volatility
+        self.dislocation = dislocation
+        self.faults = faults if faults is not None else Faults()
+        self.token_lifetime = token_lifetime
+        self.rng = random.Random(seed)
+
+        tokens = {token for market in markets for token in (market.base, market.quote)}
+        self.fair_usdt = {token: 10. ** self.rng.uniform(-2, 4) for token in tokens}
+        self.fair_usdt.update({'USDT': 1., 'IRT': 1. / USDT_IRT_PRICE})
+        for market in markets:
+            self._move(market)
+
+        self.wallet = dict(wallet) if wallet is not None else {token: 0. for token in tokens}
+        self.orders: Dict[str, dict] = {}
+        self.access_tokens: Dict[str, float] = {}
+        self.refresh_tokens: Dict[str, float] = {}
+        self.subscribers: Dict[web.WebSocketResponse, Set[int]] = {}
+        # endpoint -> [window start, requests in the window]
+        self.windows: Dict[str, list] = {}
+        self.stats = {'requests': 0, 'rate_limited': 0, 'events': 0, 'event_sends': 0, 'orders': 0,
+                      'disconnects': 0}
+
+    def _move(self, market: SimulatedMarket):
+        for token in (market.base, market.quote):
+            if token not in ('USDT', 'IRT'):
+                self.fair_usdt[token] *= math.exp(self.rng.gauss(0, self.volatility))
+        fair = self.fair_usdt[market.base] / self.fair_usdt[market.quote]
+        market.set_mid(fair * (1 + self.rng.gauss(0, self.dislocation)), self.depth, self.spread, self.rng)
+
+    def _irt_value(self, token: str) -> float:
+        return self.fair_usdt[token] * USDT_IRT_PRICE if token in self.fair_usdt else 0.
+
+    # Market data
+
+    def market_update_event(self, market: SimulatedMarket) -> str:
+        event_time = datetime.now(timezone.utc).strftime('%Y-%m-%dT%H:%M:%S.%fZ')
+        return json.dumps({
+            'event': 'market_update',
+            'market': {'id': market.id, 'code': market.code},
+            'buy': market.buy,
+            'sell': market.sell,
+            'event_time': event_time,
+        })
+
+    async def _emit_loop(self):
+        """Moves a random market and broadcasts it, `rate` times a second on average."""
+        markets = list(self.markets.values())
+        next_at = time.monotonic()
+        while True:
+            next_at += self.rng.expovariate(self.rate)
+            delay = next_at - time.monotonic()
+            if delay > 0:
+                await asyncio.sleep(delay)
+            market = self.rng.choice(markets)
+            self._move(market)
+            self.stats['events'] += 1
+            subscribers = [ws for ws, ids in self.subscribers.items() if market.id in ids]
+            if not subscribers:
+                continue
+            event = self.market_update_event(market)
+            for ws in subscribers:
+                try:
+                    await ws.send_str(event)
+                    self.stats['event_sends'] += 1
+                except (ConnectionResetError, RuntimeError):
+                    self.subscribers.pop(ws, None)
+
+    async def _disconnect_loop(self):
+        while True:
+            if self.faults.disconnect_every <= 0:
+                await asyncio.sleep(1)
+                continue
+            await asyncio.sleep(self.rng.expovariate(1 / self.faults.disconnect_every))
+            if self.subscribers:
+                await self.disconnect([self.rng.choice(list(self.subscribers))])
+
+    async def disconnect(self, connections=None):
+        for ws in list(connections if connections is not None else self.subscribers):
+            self.subscribers.pop(ws, None)
+            self.stats['disconnects'] += 1
+            await ws.close()
+
+    async def handle_ws(self, request: web.Request) -> web.WebSocketResponse:
+        ws = web.WebSocketResponse()
+        await ws.prepare(request)
+        self.subscribers[ws] = set()
+        try:
+            async for msg in ws:
+                if msg.type != WSMsgType.TEXT:
+                    continue
+                try:
+                    data = json.loads(msg.data)
+                except ValueError:
+                    continue
+                if data.get('method') == 'sub_to_market_list':
+                    self.subscribers.setdefault(ws, set()).update(int(i) for i in data.get('ids', ()))
+        finally:
+            self.subscribers.pop(ws, None)
+        return ws
+
+    # REST
+
+    @web.middleware
+    async def fault_middleware(self, request: web.Request, handler):
+        if request.path.startswith('/sim/') or request.path == '/ws':
+            return await handler(request)
+        self.stats['requests'] += 1
+        faults = self.faults
+        if faults.latency or faults.jitter:
+            await asyncio.sleep(faults.latency + self.rng.uniform(0, faults.jitter))
+
+        headers = {}
+        if faults.rate_limit:
+            now = time.time()
+            window = self.windows.setdefault(endpoint_of(request.path), [now, 0])
+            if now - window[0] >= RATE_LIMIT_WINDOW:
+                window[0], window[1] = now, 0
+            window[1] += 1
+            reset = window[0] + RATE_LIMIT_WINDOW - now
+            headers = {
+                'X-RateLimit-Limit': str(faults.rate_limit),
+                'X-RateLimit-Remaining': str(max(faults.rate_limit - window[1], 0)),
+                'X-RateLimit-Reset': f'{reset:.3f}',
+            }
+            if window[1] > faults.rate_limit:
+                return self._rate_limited(headers, reset)
+        if faults.error_rate and self.rng.random() < faults.error_rate:
+            return self._rate_limited(headers, 1.)
+
+        response = await handler(request)
+        response.headers.update(headers)
+        return response
+
+    def _rate_limited(self, headers: dict, retry_after: float) -> web.Response:
+        self.stats['rate_limited'] += 1
+        return web.json_response({'detail': 'Request was throttled.'}, status=429,
+                                 headers={**headers, 'Retry-After': f'{retry_after:.3f}'})
+
+    def _authorized(self, request: web.Request) -> bool:
+        token = request.headers.get('Authorization', '')[len('Bearer '):]
+        return self.access_tokens.get(token, 0.) > time.time()
+
+    def _issue_access_token(self) -> str:
+        token, expires_at = _make_token('access', self.token_lifetime)
+        self.access_tokens[token] = expires_at
+        return token
+
+    async def login(self, request: web.Request) -> web.Response:
+        body = await request.json()
+        if not body.get('api_key') or not body.get('secret_key'):
+            return web.json_response({'detail': 'Invalid credentials.'}, status=401)
+        refresh, expires_at = _make_token('refresh', REFRESH_TOKEN_LIFETIME)
+        self.refresh_tokens[refresh] = expires_at
+        return web.json_response({'access': self._issue_access_token(), 'refresh': refresh})
+
+    async def refresh_token(self, request: web.Request) -> web.Response:
+        body = await request.json()
+        if self.refresh_tokens.get(body.get('refresh'), 0.) <= time.time():
+            return web.json_response({'detail': 'Token is invalid or expired.'}, status=401)
+        return web.json_response({'access': self._issue_access_token()})
+
+    async def get_markets(self, request: web.Request) -> web.Response:
+        return web.json_response({'results': [market.to_exchange() for market in self.markets.values()],
+                                  'next': None})
+
+    async def get_actives(self, request: web.Request) -> web.Response:
+        market = self.markets.get(int(request.match_info['market_id']))
+        if market is None:
+            return web.json_response({'detail': 'Not found.'}, status=404)
+        side = market.sell if request.query.get('type') == 'sell' else market.buy
+        return web.json_response({'orders': side})
+
+    async def get_orders(self, request: web.Request) -> web.Response:
+        if not self._authorized(request):
+            return web.json_response({'detail': 'Unauthorized.'}, status=401)
+        state = request.query.get('state')
+        return web.json_response({'results': [order for order in self.orders.values()
+                                              if state is None or order['state'] == state]})
+
+    async def place_order(self, request: web.Request) -> web.Response:
+        if not self._authorized(request):
+            return web.json_response({'detail': 'Unauthorized.'}, status=401)
+        body = await request.json()
+        market = self.markets.get(int(body.get('market', 0)))
+        if market is None:
+            return web.json_response({'detail': 'Unknown market.'}, status=400)
+        amount = float(body['amount1'])
+        price = float(body['price'])
+        side = body['type']
+
+        if body.get('mode') == 'market':
+            price = float((market.sell if side == 'buy' else market.buy)[0]['price'])
+        paid, cost = (market.quote, amount * price) if side == 'buy' else (market.base, amount)
+        if self.wallet.get(paid, 0.) < cost:
+            return web.json_response({'detail': f'Insufficient {paid} balance.'}, status=400)
+
+        order = {
+            'id': len(self.orders) + 1,
+            'identifier': body.get('identifier') or uuid.uuid4().hex,
+            'market': {'id': market.id, 'code': market.code},
+            'type': side,
+            'mode': body.get('mode', 'limit'),
+            'price': str(price),
+            'amount1': str(amount),
+            'remain_amount': str(amount),
+            'state': 'active',
+        }
+        if order['mode'] == 'market':
+            received, gain = (market.base, amount) if side == 'buy' else (market.quote, amount * price)
+            self.wallet[paid] -= cost
+            self.wallet[received] = self.wallet.get(received, 0.) + gain
+            order.update(remain_amount='0', state='done')
+        self.orders[order['identifier']] = order
+        self.stats['orders'] += 1
+        return web.json_response(order, status=201)
+
+    async def get_wallets(self, request: web.Request) -> web.Response:
+        if not self._authorized(request):
+            return web.json_response({'detail': 'Unauthorized.'}, status=401)
+        results = []
+        for token, total in self.wallet.items():
+            value = total * self._irt_value(token)
+            results.append({
+                'currency': {'code': token},
+                'total': str(total),
+                'frozen': '0',
+                'value': str(value),
+                'usdt_value': str(value / USDT_IRT_PRICE),
+            })
+        return web.json_response({'results': results})
+
+    # Control
+
+    async def get_stats(self, request: web.Request) -> web.Response:
+        return web.json_response({**self.stats, 'connections': len(self.subscribers)})
+
+    async def set_faults(self, request: web.Request) -> web.Response:
+        if request.method == 'POST':
+            self.faults.update(json.loads(await request.text()))
+            logger.info("Faults: %s", self.faults)
+        return web.json_response(asdict(self.faults))
+
+    async def drop_connections(self, request: web.Request) -> web.Response:
+        count = len(self.subscribers)
+        await self.disconnect()
+        return web.json_response({'disconnected': count})
+
+    async def _background(self, app: web.Application):
+        tasks = [asyncio.create_task(self._emit_loop()), asyncio.create_task(self._disconnect_loop())]
+        yield
+        for task in tasks:
+            task.cancel()
+        await self.disconnect()
+
+    def app(self) -> web.Application:
+        app = web.Application(middlewares=[self.fault_middleware])
+        app.add_routes([
+            web.post('/v1/usr/api/login/', self.login),
+            web.post('/v1/usr/refresh_token/', self.refresh_token),
+            web.get('/v1/mkt/markets/', self.get_markets),
+            web.get('/v2/mth/actives/{market_id}/', self.get_actives),
+            web.get('/v1/odr/orders/', self.get_orders),
+            web.post('/v1/odr/orders/', self.place_order),
+            web.get('/v1/wlt/wallets/', self.get_wallets),
+            web.get('/ws', self.handle_ws),
+            web.get('/sim/stats', self.get_stats),
+            web.get('/sim/faults', self.set_faults),
+            web.post('/sim/faults', self.set_faults),
+            web.post('/sim/disconnect', self.drop_connections),
+        ])
+        app.cleanup_ctx.append(self._background)
+        return app
+
+
+def traded_markets() -> List[SimulatedMarket]:
+    from utils import MARKET_MAPPING, market_registry
+
+    markets = []
+    for (base, quote), market_id in MARKET_MAPPING.items():
+        known = market_registry.get(market_id)
+        markets.append(SimulatedMarket(market_id, base, quote, known and known.tick_size, known and known.lot_size))
+    return markets
+
+
+def _parse_wallet(items) -> Dict[str, float]:
+    wallet = {}
+    for item in items or []:
+        token, amount = item.split('=')
+        wallet[token] = float(amount)
+    return wallet
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--port', type=int, default=DEFAULT_PORT)
+    parser.add_argument('--rate', type=float, default=100., help='market_update events a second, over all markets.')
+    parser.add_argument('--depth', type=int, default=20, help='Levels per book side.')
+    parser.add_argument('--dislocation', type=float, default=0.0005,
+                        help='Relative standard deviation of market prices from the fair cross rate.')
+    parser.add_argument('--wallet', action='append', help='TOKEN=AMOUNT starting balance.')
+    parser.add_argument('--token-lifetime', type=float, default=TOKEN_LIFETIME)
+    parser.add_argument('--seed', type=int, default=None)
+    parser.add_argument('--latency', type=float, default=0.)
+    parser.add_argument('--jitter', type=float, default=0.)
+    parser.add_argument('--error-rate', type=float, default=0.)
+    parser.add_argument('--rate-limit', type=int, default=0)
+    parser.add_argument('--disconnect-every', type=float, default=0.)
+    args = parser.parse_args()
+
+    log_config.configure()
+    simulator = BitpinSimulator(
+        traded_markets(),
+        rate=args.rate,
+        depth=args.depth,
+        dislocation=args.dislocation,
+        wallet=_parse_wallet(args.wallet) or {'IRT': 1e9, 'USDT': 1e4},
+        faults=Faults(args.latency, args.jitter, args.error_rate, args.rate_limit, args.disconnect_every),
+        token_lifetime=args.token_lifetime,
+        seed=args.seed,
+    )
+    web.run_app(simulator.app(), port=args.port, print=None, access_log=None)
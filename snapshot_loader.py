@@ -0,0 +1,80 @@
+import hashlib
+import json
+import logging
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from typing import Dict, Iterable, Optional
+
+from bitpin_proxy import BitpinProxy, get_bitpin_proxy
+
+# Base path of the persisted snapshots; each endpoint gets its own file (see `snapshot_path`).
+SNAPSHOT_PATH = os.environ.get('SNAPSHOT_PATH', 'market_snapshot.json')
+SNAPSHOT_MAX_AGE = float(os.environ.get('SNAPSHOT_MAX_AGE', 300))
+MAX_PARALLEL_FETCHES = 8
+FETCH_TIMEOUT = 5
+
+logger = logging.getLogger(__name__)
+
+# market id -> {'buy': [...], 'sell': [...], 'time': unix timestamp of the fetch}
+Snapshots = Dict[int, dict]
+
+
+def _fetch_market(proxy: BitpinProxy, market_id: int, timeout: float) -> dict:
+    return {
+        'buy': proxy.get_open_orders(market_id, 'buy', timeout=timeout)['orders'],
+        'sell': proxy.get_open_orders(market_id, 'sell', timeout=timeout)['orders'],
+        'time': time.time(),
+    }
+
+
+def fetch_snapshots(market_ids: Iterable[int], max_workers: int = MAX_PARALLEL_FETCHES,
+                    timeout: float = FETCH_TIMEOUT, proxy: BitpinProxy = None) -> Snapshots:
+    """
+    Fetches the order lists of all markets concurrently, through `proxy` or
+    the process wide one. Markets that fail or time out are logged and left
+    out of the result.
+    """
+    proxy = proxy if proxy is not None else get_bitpin_proxy()
+    snapshots = {}
+    with ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='snapshot') as executor:
+        futures = {executor.submit(_fetch_market, proxy, market_id, timeout): market_id for market_id in market_ids}
+        for future in as_completed(futures):
+            market_id = futures[future]
+            try:
+                snapshots[market_id] = future.result()
+            except Exception as e:
+                logger.warning("Fetching snapshot of market %s failed: %s", market_id, e)
+    return snapshots
+
+
+def snapshot_path(proxy: BitpinProxy = None, path: str = SNAPSHOT_PATH) -> str:
+    """Where the snapshots of the endpoint `proxy` (or the process wide one) talks to are persisted."""
+    proxy = proxy if proxy is not None else get_bitpin_proxy()
+    root, ext = os.path.splitext(path)
+    return f'{root}.{hashlib.sha256(proxy.base_url.encode()).hexdigest()[:12]}{ext}'
+
+
+def save_snapshots(snapshots: Snapshots, path: str = SNAPSHOT_PATH):
+    tmp_path = f'{path}.tmp'
+    with open(tmp_path, 'w') as f:
+        json.dump({str(market_id): snapshot for market_id, snapshot in snapshots.items()}, f)
+    os.replace(tmp_path, path)
+
+
+def load_snapshots(path: str = SNAPSHOT_PATH, max_age: Optional[float] = SNAPSHOT_MAX_AGE) -> Snapshots:
+    """Snapshots persisted by `save_snapshots`, dropping those older than `max_age` seconds."""
+    try:
+        with open(path) as f:
+            data = json.load(f)
+    except FileNotFoundError:
+        return {}
+    except (OSError, ValueError) as e:
+        logger.warning("Could not read snapshot file %s: %s", path, e)
+        return {}
+
+    now = time.time()
+    return {
+        int(market_id): snapshot for market_id, snapshot in data.items()
+        if max_age is None or now - snapshot['time'] <= max_age
+    }
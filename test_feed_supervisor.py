@@ -0,0 +1,95 @@
+import base64
+import hashlib
+import socket
+import threading
+import time
+
+import feed_supervisor
+from feed_supervisor import FeedSupervisor
+
+WS_GUID = '258EAFA5-E914-47DA-95CA-C5AB0DC85B11'
+
+
+class AcceptThenClosePeer:
+    """Completes the websocket handshake and closes the connection right away."""
+
+    def __init__(self):
+        self.sock = socket.create_server(('127.0.0.1', 0))
+        self.sock.settimeout(0.2)
+        self.accepted = 0
+        self._stopped = threading.Event()
+        self._thread = threading.Thread(target=self._serve, daemon=True)
+        self._thread.start()
+
+    @property
+    def addr(self) -> str:
+        return f'ws://127.0.0.1:{self.sock.getsockname()[1]}/'
+
+    def _serve(self):
+        while not self._stopped.is_set():
+            try:
+                conn, _ = self.sock.accept()
+            except socket.timeout:
+                continue
+            with conn:
+                request = b''
+                while b'\r\n\r\n' not in request:
+                    request += conn.recv(4096)
+                key = next(line.split(b':', 1)[1].strip() for line in request.split(b'\r\n')
+                           if line.lower().startswith(b'sec-websocket-key:'))
+                accept = base64.b64encode(hashlib.sha1(key + WS_GUID.encode()).digest())
+                conn.sendall(b'HTTP/1.1 101 Switching Protocols\r\nUpgrade: websocket\r\n'
+                             b'Connection: Upgrade\r\nSec-WebSocket-Accept: ' + accept + b'\r\n\r\n')
+                self.accepted += 1
+
+    def close(self):
+        self._stopped.set()
+        self._thread.join()
+        self.sock.close()
+
+
+class StubRepository:
+    def subscribe(self, ws, market_ids):
+        pass
+
+    def _on_message(self, ws, message, source=None):
+        pass
+
+
+def test_accept_then_close_backs_off(monkeypatch):
+    monkeypatch.setattr(feed_supervisor, 'MIN_BACKOFF', 0.1)
+    peer = AcceptThenClosePeer()
+    supervisor = FeedSupervisor(StubRepository(), peer.addr, [1])
+    thread = threading.Thread(target=supervisor.run, daemon=True)
+    thread.start()
+    try:
+        time.sleep(2)
+    finally:
+        supervisor.stop()
+        thread.join(5)
+        peer.close()
+
+    # Backing off from 0.1s doubling, 2s leave room for about six attempts;
+    # resetting on every open would reconnect every 0.05-0.1s.
+    assert 3 <= peer.accepted <= 8
+    assert supervisor.failures >= 3
+
+
+def test_message_resets_backoff():
+    supervisor = FeedSupervisor(StubRepository(), 'ws://unused', [1])
+    supervisor.failures = 5
+    supervisor._on_message(None, '{}')
+    assert supervisor.failures == 0
+
+
+def test_healthy_connection_resets_backoff():
+    supervisor = FeedSupervisor(StubRepository(), 'ws://unused', [1])
+    supervisor.failures = 5
+    supervisor.connected_at = supervisor.last_message_at = time.time()
+    supervisor._disconnected()
+    assert supervisor.failures == 5
+
+    supervisor.connected_at = time.time() - 2 * feed_supervisor.HEARTBEAT_TIMEOUT
+    supervisor.last_message_at = time.time()
+    supervisor._disconnected()
+    assert supervisor.failures == 0
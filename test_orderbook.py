@@ -0,0 +1,32 @@
+from market_repo import MarketRepository
+from orderbook import OrderBook
+from utils import MARKET_MAPPING
+
+BIDS = [{'price': '100', 'remain': '1'}, {'price': '99', 'remain': '2'}, {'price': '98', 'remain': '3'}]
+ASKS = [{'price': '101', 'remain': '0.5'}, {'price': '102', 'remain': '1.5'}]
+
+
+def test_cumulative_depth():
+    book = OrderBook(1)
+    book.apply_snapshot(BIDS, ASKS)
+
+    assert book.side('bid').cumulative_depth(2) == [(100., 1.), (99., 3.)]
+    assert book.side('sell').cumulative_depth(10) == [(101., .5), (102., 2.)]
+
+
+def test_amount_up_to():
+    book = OrderBook(1)
+    book.apply_snapshot(BIDS, ASKS)
+
+    assert book.bids.amount_up_to(99) == 3.
+    assert book.asks.amount_up_to(101.5) == .5
+    assert book.asks.amount_up_to(100) == 0.
+
+
+def test_market_depth():
+    market_repo = MarketRepository()
+    market_repo.apply_book_snapshot(MARKET_MAPPING[('USDT', 'IRT')], BIDS, ASKS)
+
+    assert market_repo.get_market_depth('USDT', 'IRT', 'bid', n_levels=2) == [(100., 1.), (99., 3.)]
+    assert market_repo.get_market_depth('USDT', 'IRT', 'ask') == [(101., .5), (102., 2.)]
+    assert market_repo.get_market_depth('NOT', 'IRT', 'ask') == []
@@ -0,0 +1,59 @@
+import asyncio
+
+import pytest
+
+from async_bitpin_proxy import AsyncBitpinProxy
+from bitpin_proxy import OrderRejected
+from order import Order
+from replay import StubBitpinProxy
+from trader import TraderAgent
+
+
+class RejectingProxy(StubBitpinProxy):
+    """Rejects the orders on `rejected_markets` and fails those on `failed_markets`."""
+
+    def __init__(self, wallet, rejected_markets=(), failed_markets=()):
+        super().__init__(wallet)
+        self.rejected_markets = set(rejected_markets)
+        self.failed_markets = set(failed_markets)
+
+    def place_orders_sync(self, orders, trace=None) -> list:
+        results = []
+        for order in orders:
+            if order['market_id'] in self.rejected_markets:
+                results.append(OrderRejected(400, {'detail': 'invalid amount'}))
+            elif order['market_id'] in self.failed_markets:
+                results.append(ConnectionError('connection reset'))
+            else:
+                results.append(self.place_order(**order))
+        return results
+
+
+def test_only_accepted_legs_are_reserved():
+    proxy = RejectingProxy({'IRT': 1e9, 'USDT': 1e4, 'NOT': 1e4}, rejected_markets=[772], failed_markets=[773])
+    agent = TraderAgent(proxy, proxy)
+    agent.update_orders_and_wallet()
+    order_set = [
+        Order(market=('USDT', 'IRT'), side='buy', amount=10, price=60000),
+        Order(market=('NOT', 'IRT'), side='buy', amount=100, price=1000),
+        Order(market=('NOT', 'USDT'), side='sell', amount=100, price=0.02),
+    ]
+
+    agent._place_orders(order_set)
+
+    assert [order.market for order in agent.open_orders] == [('USDT', 'IRT')]
+    assert agent.get_tradable_balance('IRT') == 1e9 - 10 * 60000
+    assert agent.get_tradable_balance('NOT') == 1e4
+
+
+@pytest.mark.parametrize('status', [400, 401, 429])
+def test_async_place_order_raises_on_error_status(status):
+    proxy = AsyncBitpinProxy.__new__(AsyncBitpinProxy)
+
+    async def send_request(*args, **kwargs):
+        return status, {'detail': 'nope'}
+
+    proxy._send_request = send_request
+    with pytest.raises(OrderRejected) as rejected:
+        asyncio.run(proxy.place_order(5, 10, 60000, 'buy'))
+    assert rejected.value.status == status
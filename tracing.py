@@ -0,0 +1,95 @@
+import time
+from collections import deque
+from dataclasses import dataclass, field
+from datetime import datetime, timezone
+from typing import List, Optional, Tuple
+
+import metrics
+from local_metrics import batched
+
+
+@dataclass
+class TraceContext:
+    """
+    Per-tick trace, created when a frame is received and carried along with
+    the update. Stages are stamped with `time.monotonic()`, which is one
+    system-wide clock on Linux, so stamps from different actor processes can
+    be subtracted from each other.
+    """
+    market_id: Optional[int] = None
+    stamps: List[Tuple[str, float]] = field(default_factory=list)
+
+    @classmethod
+    def start(cls, stage: str = 'frame_received', market_id: Optional[int] = None) -> 'TraceContext':
+        trace = cls(market_id=market_id)
+        trace.mark(stage)
+        return trace
+
+    def mark(self, stage: str):
+        self.stamps.append((stage, time.monotonic()))
+
+    def durations(self) -> List[Tuple[str, float]]:
+        """Time spent reaching each stage from the previous one."""
+        return [(stage, t - prev_t) for (_, prev_t), (stage, t) in zip(self.stamps, self.stamps[1:])]
+
+    def total(self) -> float:
+        return self.stamps[-1][1] - self.stamps[0][1] if self.stamps else 0.
+
+    def finish(self):
+        """Records every stage duration and the end-to-end time of the trace."""
+        for stage, duration in self.durations():
+            _stage_metric(stage).observe(duration)
+        _stage_metric(None).observe(self.total())
+
+
+_stage_metrics = {}
+
+
+def _stage_metric(stage: Optional[str]):
+    """Bound histogram of `stage`, or of the total duration for None."""
+    metric = _stage_metrics.get(stage)
+    if metric is None:
+        if stage is None:
+            metric = batched(metrics.tick_total_duration)
+        else:
+            metric = batched(metrics.tick_stage_duration, stage=stage)
+        _stage_metrics[stage] = metric
+    return metric
+
+
+def mark(trace: Optional[TraceContext], stage: str):
+    if trace is not None:
+        trace.mark(stage)
+
+
+def parse_event_time(event_time: str) -> float:
+    """Exchange `event_time` (UTC ISO-8601, optionally with a trailing Z) as a unix timestamp."""
+    if event_time[-1] == 'Z':
+        event_time = event_time[:-1]
+    parsed = datetime.fromisoformat(event_time)
+    if parsed.tzinfo is None:
+        parsed = parsed.replace(tzinfo=timezone.utc)
+    return parsed.timestamp()
+
+
+class ClockOffsetEstimator:
+    """
+    Estimates `local clock - exchange clock + minimum network latency` as the
+    lowest `received_at - event_time` over a sliding window. Delays above that
+    floor are queueing on the exchange or on the network path.
+    """
+
+    def __init__(self, window: int = 1000):
+        self.samples = deque(maxlen=window)
+        self.offset: Optional[float] = None
+
+    def observe(self, event_time: float, received_at: float) -> float:
+        """Adds a sample and returns the delay in excess of the estimated offset."""
+        delay = received_at - event_time
+        if len(self.samples) == self.samples.maxlen and self.samples[0] == self.offset:
+            self.samples.popleft()
+            self.offset = min(self.samples) if self.samples else None
+        self.samples.append(delay)
+        if self.offset is None or delay < self.offset:
+            self.offset = delay
+        return delay - self.offset
@@ -1,15 +1,20 @@
 import logging
+import threading
 import uuid
-from collections import defaultdict
-from typing import List
+from typing import List, Optional
 
 import metrics
-from bitpin_proxy import bitpin_proxy
+from async_bitpin_proxy import AsyncBitpinProxy, get_async_bitpin_proxy
+from bitpin_proxy import BitpinProxy, OrderRejected, get_bitpin_proxy
+from ledger import BalanceLedger
+from log_config import hot_path_logger, log_event
 from order import Order
+from tracing import TraceContext, mark
+from user_stream import UserDataStream
 from utils import MARKET_MAPPING
-logging.basicConfig(level=logging.INFO,  format='%(asctime)s %(message)s')
 
 logger = logging.getLogger(__name__)
+hot_logger = hot_path_logger(__name__)
 
 
 def _get_order_set_base_tokens(order_set):
@@ -23,38 +28,84 @@ def _get_order_set_base_tokens(order_set):
 
 
 class TraderAgent:
-    def __init__(self):
-        self.open_orders = []
-        self.wallet = defaultdict(float)
-
-        self.update_orders_and_wallet()
+    """
+    Tracks the wallet and open orders and places order sets. Creating one
+    does not touch the network: `start` does the first sync. Proxies that are
+    not injected are the process wide ones, resolved on first use.
+    """
+
+    def __init__(self, proxy: BitpinProxy = None, async_proxy: AsyncBitpinProxy = None):
+        self.ledger = BalanceLedger()
+        self.lock = threading.RLock()
+        self.user_stream = None
+        self._proxy = proxy
+        self._async_proxy = async_proxy
+
+    @property
+    def proxy(self) -> BitpinProxy:
+        return self._proxy if self._proxy is not None else get_bitpin_proxy()
+
+    @property
+    def async_proxy(self) -> AsyncBitpinProxy:
+        return self._async_proxy if self._async_proxy is not None else get_async_bitpin_proxy()
+
+    @property
+    def open_orders(self) -> List[Order]:
+        return self.ledger.open_orders
+
+    @property
+    def wallet(self):
+        return self.ledger.wallet
 
     def update_orders_and_wallet(self):
-        self.open_orders = bitpin_proxy.get_my_open_orders()
-        self.wallet.clear()
-        self.wallet.update(bitpin_proxy.get_wallet_info())
+        open_orders = self.proxy.get_my_open_orders()
+        self.apply_snapshot(self.proxy.get_wallet_info(), open_orders)
+
+    def start(self):
+        """Syncs the wallet and open orders, then keeps them fresh in the background."""
+        if self.user_stream is not None:
+            return self.user_stream
+        try:
+            self.update_orders_and_wallet()
+        except Exception as e:
+            logger.warning("Syncing wallet and open orders failed, retrying in the background: %s", e)
+            self.start_user_stream().request_refresh()
+        return self.start_user_stream()
+
+    def start_user_stream(self):
+        """Keeps the wallet and open orders fresh in the background from now on."""
+        if self.user_stream is None:
+            self.user_stream = UserDataStream(self, self.proxy).start()
+        return self.user_stream
 
-        logger.info("Open orders: %s", str(self.open_orders))
-        logger.info("Wallet: %s", str(self.wallet))
+    def apply_snapshot(self, wallet, open_orders, snapshot_time=None):
+        with self.lock:
+            self.ledger.reconcile(wallet, open_orders, snapshot_time)
 
-    def place_order_set(self, order_set: List[Order]):
-        logger.info('Placing orders: %s', str(order_set))
+        if hot_logger.isEnabledFor(logging.DEBUG):
+            # Copies, since the records are formatted on the log thread.
+            hot_logger.debug("Open orders: %s", list(self.open_orders))
+            hot_logger.debug("Wallet: %s", dict(self.wallet))
+
+    def place_order_set(self, order_set: List[Order], trace: Optional[TraceContext] = None):
+        log_event(logger, 'placing_orders', orders=list(order_set))
 
         orders_placed = False
-        with metrics.order_placement_duration.time():
+        with metrics.order_placement_duration.time(), self.lock:
             if self.verify_order_set(order_set):
-                for order in order_set:
-                    self._place_order(order)
+                mark(trace, 'verified')
+                self._place_orders(order_set, trace)
                 orders_placed = True
 
         if orders_placed:
-            self.update_orders_and_wallet()
-
-    def _place_order(self, order: Order):
-        logger.info('Placing order: %s', str(order))
-        order.identifier = str(uuid.uuid4())
-
-        bitpin_proxy.place_order(
+            if self.user_stream is not None:
+                self.user_stream.request_refresh()
+            else:
+                self.update_orders_and_wallet()
+
+    @staticmethod
+    def _order_request(order: Order) -> dict:
+        return dict(
             market_id=MARKET_MAPPING.get(order.market),
             base_amount=order.amount,
             price=order.price,
@@ -62,24 +113,39 @@ class TraderAgent:
             identifier=order.identifier,
             mode='market',  # Testing market mode to prevent open orders
         )
-        # TODO: Check order is placed
 
-        self.open_orders.append(order)
+    def _place_orders(self, order_set: List[Order], trace: Optional[TraceContext] = None):
+        """Sends all legs of an order set concurrently, so they land within one round trip."""
+        payloads = []
+        for order in order_set:
+            order.identifier = str(uuid.uuid4())
+            payloads.append(self._order_request(order))
+
+        results = self.async_proxy.place_orders_sync(payloads, trace)
+        for order, result in zip(order_set, results):
+            # Only legs the exchange accepted reserve balance.
+            if isinstance(result, OrderRejected):
+                logger.error('Order %s was rejected: %s', str(order), result)
+                continue
+            if isinstance(result, Exception):
+                logger.error('Placing order %s failed: %s', str(order), result)
+                continue
+            self.ledger.add_order(order)
 
     def verify_order_set(self, order_set: List[Order]) -> bool:
-        logger.info('Verifying orders: %s', str(order_set))
+        hot_logger.debug('Verifying orders: %s', order_set)
 
         order_set_tokens = _get_order_set_base_tokens(order_set)
 
         for oo in self.open_orders:
             if oo.market[0] in order_set_tokens or oo.market[1] in order_set_tokens:
-                logger.info('There is already an open order for the base token :(')
+                hot_logger.info('There is already an open order for the base token :(')
                 # return False  # Skip for now...
 
         for order in order_set:
             token, amount = order.paid()
             if self.get_tradable_balance(token) < amount:
-                logger.info(
+                hot_logger.info(
                     'There is not enough tradable balance for %s (balance=%f,amount=%f) :(',
                     token,
                     self.get_tradable_balance(token),
@@ -87,12 +153,28 @@ class TraderAgent:
                 )
                 return False
 
-        logger.info('Orders verified')
+        hot_logger.debug('Orders verified')
 
         return True
 
     def get_tradable_balance(self, token: str) -> float:
-        return self.wallet[token] - sum(o.paid()[1] for o in self.open_orders if o.paid()[0] == token)
+        return self.ledger.tradable(token)
+
+
+_trader_agent: Optional[TraderAgent] = None
+_trader_agent_lock = threading.Lock()
+
+
+def get_trader_agent() -> TraderAgent:
+    """The process wide agent, created on first use and not yet started."""
+    global _trader_agent
+    if _trader_agent is None:
+        with _trader_agent_lock:
+            if _trader_agent is None:
+                _trader_agent = TraderAgent()
+    return _trader_agent
 
 
-trader_agent = TraderAgent()
+def set_trader_agent(agent: TraderAgent):
+    global _trader_agent
+    _trader_agent = agent
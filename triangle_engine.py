@@ -0,0 +1,105 @@
+from typing import Dict, Iterable, Optional, Sequence, Tuple
+
+import numpy as np
+
+from price_table import ASK_PRICE, ASK_SIZE, BID_PRICE, BID_SIZE
+
+CURRENCY_SAFETY_MARGIN = 0.995
+
+# Direction of a triangle trade, named after the side taken on the (base, main) market.
+SELL_MAIN = 0
+BUY_MAIN = 1
+
+OPPORTUNITY_DTYPE = np.dtype([
+    ('triangle', np.int32),
+    ('direction', np.int8),
+    ('profit_per_unit', np.float64),
+    ('amount', np.float64),
+    ('expected_profit', np.float64),
+    ('main_price', np.float64),
+    ('secondary_price', np.float64),
+    ('quote_price', np.float64),
+])
+
+
+class TriangleEngine:
+    """
+    Evaluates every triangle in both directions in one vectorized pass.
+
+    A triangle `(main, secondary, base)` trades on three markets:
+    (base, main), (base, secondary) and (secondary, main). Either base is sold
+    for main and bought back with secondary (SELL_MAIN), or the reverse (BUY_MAIN).
+    """
+
+    def __init__(self, triangles: Sequence[Tuple[str, str, str]], market_index: Dict[int, int],
+                 market_mapping: Dict[Tuple[str, str], int]):
+        """`market_index` maps market ids to rows of the `PriceTable` that will be evaluated."""
+        self.triangles = list(triangles)
+        self.tokens = sorted({token for triangle in self.triangles for token in triangle})
+        self.token_index = {token: i for i, token in enumerate(self.tokens)}
+
+        def market_rows(pairs):
+            return np.array([market_index[market_mapping[pair]] for pair in pairs], dtype=np.intp)
+
+        def token_rows(tokens):
+            return np.array([self.token_index[token] for token in tokens], dtype=np.intp)
+
+        self.main_market = market_rows([(base, main) for main, _, base in self.triangles])
+        self.secondary_market = market_rows([(base, secondary) for main, secondary, base in self.triangles])
+        self.quote_market = market_rows([(secondary, main) for main, secondary, _ in self.triangles])
+        self.main_token = token_rows([main for main, _, _ in self.triangles])
+        self.secondary_token = token_rows([secondary for _, secondary, _ in self.triangles])
+        self.base_token = token_rows([base for _, _, base in self.triangles])
+
+    def balance_vector(self, get_balance) -> np.ndarray:
+        return np.array([get_balance(token) for token in self.tokens], dtype=np.float64)
+
+    def evaluate(self, values: np.ndarray, balances: Optional[np.ndarray] = None,
+                 subset: Optional[Iterable[int]] = None) -> np.ndarray:
+        """
+        Evaluates `values` (`PriceTable.values`) and returns the profitable triangles
+        as an `OPPORTUNITY_DTYPE` array ranked by expected profit.
+        `balances` is indexed like `self.tokens`; without it, sizing is bounded by book depth only.
+        """
+        idx = np.arange(len(self.triangles)) if subset is None else np.fromiter(subset, dtype=np.intp)
+        if balances is None:
+            balances = np.full(len(self.tokens), np.inf)
+
+        m1, m2, m3 = values[self.main_market[idx]], values[self.secondary_market[idx]], values[self.quote_market[idx]]
+        bal_main = balances[self.main_token[idx]]
+        bal_secondary = balances[self.secondary_token[idx]]
+        bal_base = balances[self.base_token[idx]]
+
+        with np.errstate(invalid='ignore', divide='ignore'):
+            sell_edge = m1[:, BID_PRICE] - m2[:, ASK_PRICE] * m3[:, ASK_PRICE]
+            sell_amount = np.minimum.reduce([
+                m1[:, BID_SIZE],
+                m2[:, ASK_SIZE],
+                bal_base,
+                np.minimum(bal_main / m3[:, ASK_PRICE], bal_secondary) * CURRENCY_SAFETY_MARGIN / m2[:, ASK_PRICE],
+            ])
+
+            buy_edge = m2[:, BID_PRICE] * m3[:, BID_PRICE] - m1[:, ASK_PRICE]
+            buy_amount = np.minimum.reduce([
+                m1[:, ASK_SIZE],
+                m2[:, BID_SIZE],
+                bal_base,
+                np.minimum(bal_secondary * m3[:, BID_PRICE], bal_main) * CURRENCY_SAFETY_MARGIN / m1[:, ASK_PRICE],
+            ])
+
+        is_sell = sell_edge > 0
+        is_buy = ~is_sell & (buy_edge > 0)
+        profitable = is_sell | is_buy
+
+        result = np.empty(np.count_nonzero(profitable), dtype=OPPORTUNITY_DTYPE)
+        sell = is_sell[profitable]
+        result['triangle'] = idx[profitable]
+        result['direction'] = np.where(sell, SELL_MAIN, BUY_MAIN)
+        result['profit_per_unit'] = np.where(sell, sell_edge[profitable], buy_edge[profitable])
+        result['amount'] = np.where(sell, sell_amount[profitable], buy_amount[profitable])
+        result['expected_profit'] = result['profit_per_unit'] * result['amount']
+        result['main_price'] = np.where(sell, m1[profitable, BID_PRICE], m1[profitable, ASK_PRICE])
+        result['secondary_price'] = np.where(sell, m2[profitable, ASK_PRICE], m2[profitable, BID_PRICE])
+        result['quote_price'] = np.where(sell, m3[profitable, ASK_PRICE], m3[profitable, BID_PRICE])
+
+        return result[np.argsort(-result['expected_profit'], kind='stable')]
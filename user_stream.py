@@ -0,0 +1,57 @@
+import logging
+import os
+import threading
+import time
+
+from bitpin_proxy import BitpinProxy
+
+POLL_INTERVAL = float(os.environ.get('USER_STREAM_POLL_INTERVAL', 5))
+
+logger = logging.getLogger(__name__)
+
+
+class UserDataStream:
+    """
+    Keeps a `TraderAgent`'s wallet and open orders current off the decision path.
+
+    A poller thread reconciles against the REST snapshots every `poll_interval`
+    seconds, or right away when `request_refresh` is called.
+    """
+
+    def __init__(self, agent, proxy: BitpinProxy, poll_interval: float = POLL_INTERVAL):
+        self.agent = agent
+        self.proxy = proxy
+        self.poll_interval = poll_interval
+        self._refresh = threading.Event()
+        self._stopped = threading.Event()
+        self._threads = []
+
+    def start(self):
+        self._threads.append(threading.Thread(target=self._poll_loop, name='user-stream-poller', daemon=True))
+        for thread in self._threads:
+            thread.start()
+        return self
+
+    def stop(self):
+        self._stopped.set()
+        self._refresh.set()
+
+    def request_refresh(self):
+        self._refresh.set()
+
+    def poll_once(self):
+        snapshot_time = time.monotonic()
+        open_orders = self.proxy.get_my_open_orders()
+        wallet = self.proxy.get_wallet_info()
+        self.agent.apply_snapshot(wallet, open_orders, snapshot_time)
+
+    def _poll_loop(self):
+        while not self._stopped.is_set():
+            self._refresh.wait(self.poll_interval)
+            self._refresh.clear()
+            if self._stopped.is_set():
+                break
+            try:
+                self.poll_once()
+            except Exception as e:
+                logger.warning("Refreshing wallet and open orders failed: %s", e)
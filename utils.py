@@ -1,12 +1,16 @@
 from typing import Tuple
 
+from fixed_point import DEFAULT_SCALE, MarketScale
+from market_registry import load_registry
+
 
 def get_market_base_and_quote(market_id: int) -> Tuple[str, str] | Tuple[None, None]:
-    try:
-        market = next(filter(lambda m: m[1] == market_id, MARKET_MAPPING.items()))
-        return market[0]
-    except StopIteration:
-        return None, None
+    return market_registry.symbol_of(market_id)
+
+
+def get_market_scale(market_id: int) -> MarketScale:
+    market = market_registry.get(market_id)
+    return market.scale if market is not None else DEFAULT_SCALE
 
 
 MARKET_MAPPING = {
@@ -24,3 +28,5 @@ MARKET_MAPPING = {
     ('DOGE', 'IRT'): 62,
     ('DOGE', 'USDT'): 63,
 }
+
+market_registry = load_registry(MARKET_MAPPING)